@@ -0,0 +1,319 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Tuple, Dict, Callable
+
+import redis.asyncio as redis
+from pika import BlockingConnection, URLParameters
+
+from common.constants import PROCESSING_QUEUE_NAME, RESULT_EXCHANGE_NAME
+from common.meteo_data import Results, WireFormat, decode_message
+from common.meteo_utils import MeteoDataProcessor
+from common.sharding import series_metric
+from common.store_strategy import StoreStrategy, Rollup, sharded_store_strategy
+from fakes import FakeBroker, FakeAsyncConnection, FakeRedis
+from fleet import SensorFleet
+from proxy.tumbling_window import TumblingWindow
+from server import Server
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BenchmarkConfig:
+    sensors: int
+    interval: int
+    prefetch_count: int
+    window_interval: int
+    duration: float
+    warmup: float
+    rabbitmq_address: Optional[str] = None
+    redis_address: Optional[str] = None
+    batch_size: Optional[int] = None
+    simulate_processing: bool = False
+    wire_format: WireFormat = WireFormat.Json
+
+
+@dataclass
+class BenchmarkResult:
+    sensors: int
+    interval: int
+    prefetch_count: int
+    window_interval: int
+    offered_rate: float
+    processed_rate: float
+    backlog_start: int
+    backlog_end: int
+    backlog_growth: float
+    windows: int
+    latency_p50: Optional[float]
+    latency_p95: Optional[float]
+    latency_p99: Optional[float]
+    readings_without_results: int
+
+
+class RecordingStoreStrategy(StoreStrategy):
+    """
+    Store strategy wrapper that records the key, the reading timestamp and the store time of every stored point.
+    """
+
+    def __init__(self, store: StoreStrategy):
+        self._store = store
+        self.points: List[Tuple[str, float, float]] = []
+
+    async def store(self, key: str, timestamp_ns: int, value: float) -> int:
+        res = await self._store.store(key, timestamp_ns, value)
+        self.points.append((key, timestamp_ns / 1e9, time.time()))
+        return res
+
+    async def store_many(self, key: str, points: List[Tuple[int, float]]) -> int:
+        res = await self._store.store_many(key, points)
+        now = time.time()
+        self.points.extend((key, timestamp_ns / 1e9, now) for timestamp_ns, _ in points)
+        return res
+
+    async def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+        return await self._store.get(key, start, end)
+
+    async def get_many(self, keys: List[str], start: float, end: float) -> Dict[str, List[Tuple[float, float]]]:
+        return await self._store.get_many(keys, start, end)
+
+    async def get_series(self, key: str, start: float, end: float, step: Optional[float] = None) -> List[Rollup]:
+        return await self._store.get_series(key, start, end, step)
+
+    async def maintain(
+            self,
+            keys: List[str],
+            now: Optional[float] = None,
+            last_seen: Optional[Dict[str, float]] = None
+    ):
+        await self._store.maintain(keys, now, last_seen)
+
+
+class _InstantProcessor(MeteoDataProcessor):
+    def _simulate_execution_time(self):
+        pass
+
+
+class _LoopThread:
+    """
+    Runs a component on its own event loop in a background thread.
+    """
+
+    def __init__(self, name: str, run: Callable[[asyncio.AbstractEventLoop], None],
+                 stop: Optional[Callable[[], None]] = None):
+        self._loop = asyncio.new_event_loop()
+        self._run = run
+        self._stop = stop
+        self._thread = threading.Thread(target=self._target, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+
+    def _target(self):
+        asyncio.set_event_loop(self._loop)
+        self._run(self._loop)
+        if self._stop is not None:
+            self._stop()
+        # cancel whatever the component left running, e.g. the sensor scheduler
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+
+
+def run_benchmark(config: BenchmarkConfig) -> BenchmarkResult:
+    logger.info(f"Running benchmark {config}")
+    broker = FakeBroker() if config.rabbitmq_address is None else None
+    fake_redis = FakeRedis() if config.redis_address is None else None
+    processor = MeteoDataProcessor() if config.simulate_processing else _InstantProcessor()
+
+    def create_store() -> StoreStrategy:
+        # every component has its own client, as they run in different event loops
+        if fake_redis is not None:
+            return sharded_store_strategy([fake_redis])
+        return sharded_store_strategy([redis.from_url(config.redis_address, db=0)])
+
+    # processing server
+    server_store = RecordingStoreStrategy(create_store())
+    server = Server(
+        processor,
+        None,
+        config.rabbitmq_address,
+        store_strategy=server_store,
+        prefetch_count=config.prefetch_count,
+        batch_size=config.batch_size,
+    )
+    server_thread = _LoopThread('server', *_component_callbacks(server, broker))
+
+    # sensors
+    fleet = SensorFleet('benchmark', config.rabbitmq_address, config.sensors, interval=config.interval,
+                        wire_format=config.wire_format)
+    fleet_thread = _LoopThread('sensors', *_component_callbacks(fleet, broker))
+
+    # proxy and results consumer
+    results: List[Tuple[float, Results]] = []
+
+    def on_results(body: bytes, content_type: Optional[str]):
+        results.append((time.time(), decode_message(body, content_type)))
+
+    if broker is not None:
+        broker.bind(RESULT_EXCHANGE_NAME, lambda body, properties: on_results(body, properties.content_type))
+        sink = None
+    else:
+        sink = _ResultsConsumer(config.rabbitmq_address, on_results)
+    tumbling_window = TumblingWindow(None, config.rabbitmq_address, config.window_interval,
+                                     store_strategy=create_store(), wire_format=config.wire_format)
+    proxy_thread = _LoopThread('proxy', *_component_callbacks(tumbling_window, broker))
+
+    backlog = _BacklogMonitor(broker, config.rabbitmq_address)
+    # do not inherit the backlog of a previous run
+    backlog.purge()
+
+    threads = [server_thread, fleet_thread, proxy_thread]
+    for thread in threads:
+        thread.start()
+    if sink is not None:
+        sink.start()
+
+    time.sleep(config.warmup)
+    measure_start = time.time()
+    backlog_start = backlog.depth()
+    time.sleep(config.duration)
+    measure_end = time.time()
+    backlog_end = backlog.depth()
+    # keep the proxy running until the windows of the measured readings have been published
+    time.sleep(2 * config.window_interval / 1000)
+
+    for thread in reversed(threads):
+        thread.stop()
+    if sink is not None:
+        sink.stop()
+    backlog.close()
+
+    stored = [p for p in server_store.points if measure_start <= p[2] < measure_end]
+    latencies, uncovered = _latencies(server_store.points, results, measure_start, measure_end)
+    windows = sum(1 for t, _ in results if measure_start <= t < measure_end)
+    return BenchmarkResult(
+        sensors=config.sensors,
+        interval=config.interval,
+        prefetch_count=config.prefetch_count,
+        window_interval=config.window_interval,
+        offered_rate=config.sensors * 1000 / config.interval,
+        processed_rate=len(stored) / (measure_end - measure_start),
+        backlog_start=backlog_start,
+        backlog_end=backlog_end,
+        backlog_growth=(backlog_end - backlog_start) / (measure_end - measure_start),
+        windows=windows,
+        latency_p50=_percentile(latencies, 50),
+        latency_p95=_percentile(latencies, 95),
+        latency_p99=_percentile(latencies, 99),
+        readings_without_results=uncovered,
+    )
+
+
+def _component_callbacks(component, broker: Optional[FakeBroker]):
+    """
+    Returns the run and stop callbacks of a component with the pika asyncio callbacks of Server, SensorFleet
+    and TumblingWindow.
+    With a fake broker, the fake connection is handed straight to the component's connection open callback.
+    """
+    if broker is None:
+        return lambda loop: component.run(), component.stop
+
+    def run(loop: asyncio.AbstractEventLoop):
+        connection = FakeAsyncConnection(broker, loop)
+        component._connection = connection
+        component._ioloop = loop
+        loop.call_soon(component._on_connection_open, connection)
+        loop.run_forever()
+
+    return run, None
+
+
+def _latencies(
+        points: List[Tuple[str, float, float]],
+        results: List[Tuple[float, Results]],
+        start: float,
+        end: float
+) -> Tuple[List[float], int]:
+    """
+    Computes the delay from each reading timestamp to the first published Results that includes it.
+    A window's Results includes a reading if it is the first one published with a last timestamp
+    not older than the reading, as windows are published in order.
+    :return: sorted latencies in milliseconds, number of readings not included in any Results.
+    """
+    latencies, uncovered = [], 0
+    for key in ('wellness', 'pollution'):
+        published, last_timestamps = [], []
+        for t, r in results:
+            timestamp = r.wellness_timestamp if key == 'wellness' else r.pollution_timestamp
+            if timestamp:
+                published.append(t)
+                last_timestamps.append(max(timestamp, last_timestamps[-1]) if last_timestamps else timestamp)
+        for k, timestamp, _ in points:
+            if series_metric(k) != key or not start <= timestamp < end:
+                continue
+            i = bisect.bisect_left(last_timestamps, timestamp)
+            if i == len(last_timestamps):
+                uncovered += 1
+            else:
+                latencies.append((published[i] - timestamp) * 1000)
+    latencies.sort()
+    return latencies, uncovered
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class _BacklogMonitor:
+    def __init__(self, broker: Optional[FakeBroker], rabbitmq_address: Optional[str]):
+        self._broker = broker
+        self._connection = None
+        if broker is None:
+            self._connection = BlockingConnection(URLParameters(rabbitmq_address))
+            self._channel = self._connection.channel()
+
+    def depth(self) -> int:
+        if self._broker is not None:
+            return self._broker.queue_depth(PROCESSING_QUEUE_NAME)
+        return self._channel.queue_declare(queue=PROCESSING_QUEUE_NAME).method.message_count
+
+    def purge(self):
+        if self._connection is not None:
+            self._channel.queue_declare(queue=PROCESSING_QUEUE_NAME)
+            self._channel.queue_purge(queue=PROCESSING_QUEUE_NAME)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+
+class _ResultsConsumer:
+    def __init__(self, rabbitmq_address: str, on_results: Callable[[bytes, Optional[str]], None]):
+        self._connection = BlockingConnection(URLParameters(rabbitmq_address))
+        self._channel = self._connection.channel()
+        self._channel.exchange_declare(exchange=RESULT_EXCHANGE_NAME, exchange_type='fanout')
+        queue = self._channel.queue_declare(queue='', exclusive=True).method.queue
+        self._channel.queue_bind(exchange=RESULT_EXCHANGE_NAME, queue=queue)
+        self._channel.basic_consume(queue, lambda ch, method, properties, body: on_results(body, properties.content_type), auto_ack=True)
+        self._thread = threading.Thread(target=self._channel.start_consuming, name='results', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+        self._thread.join(timeout=5)
+        self._connection.close()
@@ -0,0 +1,286 @@
+import asyncio
+import bisect
+import threading
+from asyncio import AbstractEventLoop
+from collections import deque, defaultdict
+from typing import Dict, List, Tuple, Optional, Callable, Deque
+
+from pika.spec import Basic, BasicProperties
+
+
+class FakeBroker:
+    """
+    In-process stand-in for RabbitMQ, with the default exchange, fanout exchanges and per-consumer prefetch.
+    Thread-safe, so publishers and consumers can run in different threads and event loops.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque[Tuple[bytes, BasicProperties]]] = defaultdict(deque)
+        self._exchanges: Dict[str, List[Callable[[bytes, BasicProperties], None]]] = defaultdict(list)
+        self._consumers: Dict[str, List['_FakeConsumer']] = defaultdict(list)
+        self.published = 0
+
+    def queue_depth(self, queue: str) -> int:
+        with self._lock:
+            return len(self._queues[queue])
+
+    def bind(self, exchange: str, callback: Callable[[bytes, BasicProperties], None]):
+        with self._lock:
+            self._exchanges[exchange].append(callback)
+
+    def publish(self, exchange: str, routing_key: str, body: bytes, properties: Optional[BasicProperties] = None):
+        properties = properties or BasicProperties()
+        with self._lock:
+            self.published += 1
+            if exchange:
+                callbacks = list(self._exchanges[exchange])
+                consumers = []
+            else:
+                callbacks = []
+                self._queues[routing_key].append((body, properties))
+                consumers = list(self._consumers[routing_key])
+        for callback in callbacks:
+            callback(body, properties)
+        for consumer in consumers:
+            consumer.wakeup()
+
+    def _add_consumer(self, queue: str, consumer: '_FakeConsumer'):
+        with self._lock:
+            self._consumers[queue].append(consumer)
+
+    def _get(self, queue: str) -> Optional[Tuple[bytes, BasicProperties]]:
+        with self._lock:
+            q = self._queues[queue]
+            return q.popleft() if q else None
+
+    def _requeue(self, queue: str, messages: List[Tuple[bytes, BasicProperties]]):
+        with self._lock:
+            self._queues[queue].extendleft(reversed(messages))
+
+
+class FakeConnection:
+    """
+    Stand-in for a pika BlockingConnection.
+    """
+
+    def __init__(self, broker: FakeBroker):
+        self._broker = broker
+
+    def channel(self) -> 'FakeChannel':
+        return FakeChannel(self._broker)
+
+    def close(self):
+        pass
+
+
+class FakeChannel:
+    """
+    Stand-in for a pika BlockingChannel, only able to declare and publish.
+    """
+
+    def __init__(self, broker: FakeBroker):
+        self._broker = broker
+
+    def queue_declare(self, queue: str, **kwargs):
+        pass
+
+    def exchange_declare(self, exchange: str, **kwargs):
+        pass
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties: Optional[BasicProperties] = None):
+        self._broker.publish(exchange, routing_key, body, properties)
+
+
+class FakeAsyncConnection:
+    """
+    Stand-in for a pika AsyncioConnection running on the given event loop.
+    """
+
+    def __init__(self, broker: FakeBroker, loop: AbstractEventLoop):
+        self._broker = broker
+        self.ioloop = loop
+        self.is_open = True
+        self.is_closing = False
+        self.is_closed = False
+
+    def channel(self, on_open_callback: Callable[['FakeAsyncChannel'], None]):
+        channel = FakeAsyncChannel(self._broker, self.ioloop)
+        self.ioloop.call_soon(on_open_callback, channel)
+        return channel
+
+    def close(self):
+        self.is_open = False
+        self.is_closed = True
+
+
+class FakeAsyncChannel(FakeChannel):
+    """
+    Stand-in for a pika asynchronous Channel, also able to consume with prefetch and (multiple) acks.
+    """
+
+    def __init__(self, broker: FakeBroker, loop: AbstractEventLoop):
+        super().__init__(broker)
+        self._loop = loop
+        self._consumer: Optional[_FakeConsumer] = None
+        self._prefetch_count = 0
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def queue_declare(self, queue: str, callback=None, **kwargs):
+        if callback is not None:
+            self._loop.call_soon(callback, None)
+
+    def exchange_declare(self, exchange: str, callback=None, **kwargs):
+        if callback is not None:
+            self._loop.call_soon(callback, None)
+
+    def basic_qos(self, prefetch_count: int = 0, callback=None, **kwargs):
+        self._prefetch_count = prefetch_count
+        if callback is not None:
+            self._loop.call_soon(callback, None)
+
+    def basic_consume(self, queue: str, on_message_callback, **kwargs) -> str:
+        self._consumer = _FakeConsumer(self._broker, self, queue, on_message_callback, self._prefetch_count)
+        self._broker._add_consumer(queue, self._consumer)
+        self._consumer.wakeup()
+        return 'fake-consumer'
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        self._consumer.settle(delivery_tag, multiple, requeue=False)
+
+    def basic_nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        self._consumer.settle(delivery_tag, multiple, requeue=requeue)
+
+    def basic_cancel(self, consumer_tag: str, callback=None):
+        self._consumer = None
+        if callback is not None:
+            self._loop.call_soon(callback, None)
+
+    def close(self):
+        pass
+
+
+class _FakeConsumer:
+    def __init__(self, broker: FakeBroker, channel: FakeAsyncChannel, queue: str, on_message, prefetch_count: int):
+        self._broker = broker
+        self._channel = channel
+        self._queue = queue
+        self._on_message = on_message
+        self._prefetch_count = prefetch_count
+        self._unacked: Dict[int, Tuple[bytes, BasicProperties]] = {}
+        self._delivery_tag = 0
+        self._scheduled = False
+        self.acked = 0
+
+    def wakeup(self):
+        # may be called from any thread, deliveries always happen in the consumer's event loop
+        if not self._scheduled:
+            self._scheduled = True
+            self._channel._loop.call_soon_threadsafe(self._deliver)
+
+    def settle(self, delivery_tag: int, multiple: bool, requeue: bool):
+        tags = [t for t in self._unacked if t <= delivery_tag] if multiple else [delivery_tag]
+        messages = [self._unacked.pop(t) for t in sorted(tags) if t in self._unacked]
+        if requeue:
+            self._broker._requeue(self._queue, messages)
+        else:
+            self.acked += len(messages)
+        self.wakeup()
+
+    def _deliver(self):
+        self._scheduled = False
+        while not self._prefetch_count or len(self._unacked) < self._prefetch_count:
+            message = self._broker._get(self._queue)
+            if message is None:
+                return
+            body, properties = message
+            self._delivery_tag += 1
+            self._unacked[self._delivery_tag] = message
+            method = Basic.Deliver(consumer_tag='fake-consumer', delivery_tag=self._delivery_tag,
+                                   routing_key=self._queue)
+            self._on_message(self._channel, method, properties, body)
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the subset of redis.asyncio.Redis used by SortedSetStoreStrategy.
+    Thread-safe, so it can be shared by clients running in different event loops.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # per key, the scores and members sorted by score, and the score of each member
+        self._scores: Dict[str, List[float]] = defaultdict(list)
+        self._members: Dict[str, List[bytes]] = defaultdict(list)
+        self._index: Dict[str, Dict[bytes, float]] = defaultdict(dict)
+
+    async def zadd(self, key: str, mapping: Dict[str, float]) -> int:
+        return self._zadd(key, mapping)
+
+    async def zrange(self, key: str, start: float, end: float, byscore: bool = False, withscores: bool = False):
+        return self._zrange(key, start, end, byscore, withscores)
+
+    def pipeline(self, transaction: bool = True) -> '_FakePipeline':
+        return _FakePipeline(self)
+
+    def _zadd(self, key: str, mapping: Dict[str, float]) -> int:
+        added = 0
+        with self._lock:
+            scores, members, index = self._scores[key], self._members[key], self._index[key]
+            for member, score in mapping.items():
+                member = member.encode() if isinstance(member, str) else member
+                score = float(score)
+                if member in index:
+                    i = bisect.bisect_left(scores, index[member])
+                    while members[i] != member:
+                        i += 1
+                    del scores[i], members[i]
+                else:
+                    added += 1
+                i = bisect.bisect_right(scores, score)
+                scores.insert(i, score)
+                members.insert(i, member)
+                index[member] = score
+        return added
+
+    def _zrange(self, key: str, start: float, end: float, byscore: bool, withscores: bool):
+        if not byscore:
+            raise NotImplementedError("Only ranges by score are supported")
+        with self._lock:
+            scores, members = self._scores[key], self._members[key]
+            lo = bisect.bisect_left(scores, float(start))
+            hi = bisect.bisect_right(scores, float(end))
+            if withscores:
+                return list(zip(members[lo:hi], scores[lo:hi]))
+            return members[lo:hi]
+
+
+class _FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self._commands = []
+
+    def zadd(self, key: str, mapping: Dict[str, float]):
+        self._commands.append((self._redis._zadd, (key, mapping)))
+        return self
+
+    def zrange(self, key: str, start: float, end: float, byscore: bool = False, withscores: bool = False):
+        self._commands.append((self._redis._zrange, (key, start, end, byscore, withscores)))
+        return self
+
+    async def execute(self):
+        commands, self._commands = self._commands, []
+        # yield once, as a round trip would
+        await asyncio.sleep(0)
+        return [fn(*args) for fn, args in commands]
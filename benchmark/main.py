@@ -0,0 +1,103 @@
+import dataclasses
+import itertools
+import json
+import logging
+import os
+import sys
+from typing import Optional
+
+import click
+
+# Server and SensorFleet are imported the same way their own entry points import them
+sys.path[1:1] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), d)
+                 for d in ('server', 'sensor')]
+
+from common.log import setup_logger, LOGGER_LEVEL_CHOICES
+from common.meteo_data import WireFormat
+from benchmark import BenchmarkConfig, run_benchmark
+
+logger = logging.getLogger(__name__)
+
+
+def _int_list(ctx, param, value):
+    try:
+        return [int(x) for x in str(value).split(',')]
+    except ValueError:
+        raise click.BadParameter("must be a comma separated list of integers")
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option('--rabbitmq-address', type=str, default=os.environ.get('RABBITMQ_ADDRESS'),
+              help="Use a local RabbitMQ instance instead of the in-process fake broker")
+@click.option('--redis-address', type=str, default=os.environ.get('REDIS_ADDRESS'),
+              help="Use a local Redis instance instead of the in-process fake store")
+@click.option('--debug', is_flag=True, help="Enable debug logging")
+@click.option('--log-level', type=click.Choice(LOGGER_LEVEL_CHOICES), default='warning', help="Set the log level")
+@click.option('--log-sample-rate', type=float, default=None,
+              help="Log only this fraction of the per-message debug lines (all by default)")
+@click.option('--sensors', default='10,100', callback=_int_list, help="Sensor counts to sweep")
+@click.option('--interval', default='1000', callback=_int_list, help="Sensor publish intervals in ms to sweep")
+@click.option('--prefetch-count', default='32', callback=_int_list, help="Server prefetch counts to sweep")
+@click.option('--window-interval', default='2000', callback=_int_list,
+              help="Tumbling window intervals in ms to sweep")
+@click.option('--duration', type=float, default=20, help="Set the measured duration of each run in s")
+@click.option('--warmup', type=float, default=6, help="Set the warmup time of each run in s")
+@click.option('--batch-size', type=int, default=None, help="Run the server in batching mode")
+@click.option('--wire-format', type=click.Choice([e.value for e in WireFormat]), default=WireFormat.Json.value,
+              help="Set the message wire format of sensors and proxy")
+@click.option('--simulate-processing', is_flag=True, help="Keep the simulated processing time of the server")
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help="Write the results as JSON lines")
+def main(
+        rabbitmq_address: Optional[str],
+        redis_address: Optional[str],
+        log_level: str,
+        sensors, interval, prefetch_count, window_interval,
+        duration: float,
+        warmup: float,
+        batch_size: Optional[int],
+        simulate_processing: bool,
+        wire_format: str,
+        output: Optional[str],
+        debug: bool = False,
+        log_sample_rate: Optional[float] = None,
+):
+    setup_logger(log_level=logging.DEBUG if debug else log_level.upper(), sample_rate=log_sample_rate)
+
+    header = (f"{'sensors':>8} {'interval':>8} {'prefetch':>8} {'window':>7} {'offered/s':>10} {'processed/s':>11} "
+              f"{'backlog/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'missing':>7}")
+    click.echo(header)
+    out = open(output, 'w') if output else None
+    try:
+        for s, i, p, w in itertools.product(sensors, interval, prefetch_count, window_interval):
+            result = run_benchmark(BenchmarkConfig(
+                sensors=s,
+                interval=i,
+                prefetch_count=p,
+                window_interval=w,
+                duration=duration,
+                warmup=warmup,
+                rabbitmq_address=rabbitmq_address,
+                redis_address=redis_address,
+                batch_size=batch_size,
+                simulate_processing=simulate_processing,
+                wire_format=WireFormat(wire_format),
+            ))
+            click.echo(
+                f"{s:>8} {i:>8} {p:>8} {w:>7} {result.offered_rate:>10.1f} {result.processed_rate:>11.1f} "
+                f"{result.backlog_growth:>9.1f} {_ms(result.latency_p50):>8} {_ms(result.latency_p95):>8} "
+                f"{_ms(result.latency_p99):>8} {result.readings_without_results:>7}"
+            )
+            if out is not None:
+                out.write(json.dumps(dataclasses.asdict(result)) + '\n')
+                out.flush()
+    finally:
+        if out is not None:
+            out.close()
+
+
+def _ms(value: Optional[float]) -> str:
+    return '-' if value is None else f"{value:.0f}"
+
+
+if __name__ == '__main__':
+    main()
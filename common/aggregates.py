@@ -0,0 +1,229 @@
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Optional
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+# number of equal-width buckets the timestamps of a window are counted in
+DEFAULT_TIMESTAMP_BUCKETS = 16
+
+# statistics that can be published for each window, besides the mean and the last timestamp
+STATISTICS = ('count', 'min', 'max', 'stddev', 'p50', 'p95', 'p99')
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative error guarantees (DDSketch).
+    Values are counted in logarithmic buckets: bucket i holds the values in (gamma^(i-1), gamma^i], with
+    gamma = (1 + a) / (1 - a), so any quantile is estimated within a relative accuracy a. Positive and
+    negative values have separate buckets, indexed by their magnitude. Sketches merge by adding their
+    bucket counts, and memory is bounded by collapsing the buckets of the smallest magnitudes once there
+    are more than max_buckets.
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY, max_buckets: int = DEFAULT_MAX_BUCKETS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be between 0 and 1")
+        self._relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._max_buckets = max_buckets
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    @property
+    def relative_accuracy(self) -> float:
+        return self._relative_accuracy
+
+    def index(self, value: float) -> int:
+        """
+        :return: the index of the bucket of the magnitude of a non-zero value.
+        """
+        return math.ceil(math.log(abs(value)) / self._log_gamma)
+
+    def add(self, value: float, count: int = 1):
+        if value > 0:
+            self._add_to(self.positive, self.index(value), count)
+        elif value < 0:
+            self._add_to(self.negative, self.index(value), count)
+        else:
+            self.zero_count += count
+        self.count += count
+
+    def add_buckets(self, positive: Dict[int, int], negative: Dict[int, int], zero_count: int):
+        for buckets, other in ((self.positive, positive), (self.negative, negative)):
+            for i, count in other.items():
+                buckets[i] = buckets.get(i, 0) + count
+            self._collapse(buckets)
+        self.zero_count += zero_count
+        self.count += sum(positive.values()) + sum(negative.values()) + zero_count
+
+    def merge(self, other: 'QuantileSketch'):
+        if other._gamma != self._gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracies")
+        self.add_buckets(other.positive, other.negative, other.zero_count)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        # from the most negative value to the most positive one
+        for i in sorted(self.negative, reverse=True):
+            seen += self.negative[i]
+            if seen > rank:
+                return -self._value(i)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return self._value(i)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+    def _value(self, index: int) -> float:
+        # the estimate with the lowest relative error for the values in the bucket
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def _add_to(self, buckets: Dict[int, int], index: int, count: int):
+        if index in buckets:
+            buckets[index] += count
+        else:
+            buckets[index] = count
+            self._collapse(buckets)
+
+    def _collapse(self, buckets: Dict[int, int]):
+        if len(buckets) <= self._max_buckets:
+            return
+        indexes = sorted(buckets)
+        excess = indexes[:len(indexes) - self._max_buckets + 1]
+        buckets[excess[-1]] += sum(buckets.pop(i) for i in excess[:-1])
+
+
+class TimestampHistogram:
+    """
+    Counts of the timestamps of the points of a time range in equal-width buckets, from which the delays
+    from the points to a later time are estimated within half a bucket width, in constant memory.
+    Timestamps outside the range are counted in its first or last bucket.
+    """
+
+    def __init__(self, start: float, end: float, buckets: int = DEFAULT_TIMESTAMP_BUCKETS):
+        self.start = start
+        self.end = end
+        self._width = (end - start) / buckets
+        self.counts: List[int] = [0] * buckets
+
+    def index(self, timestamp: float) -> int:
+        return min(max(int((timestamp - self.start) / self._width), 0), len(self.counts) - 1)
+
+    def add(self, timestamp: float, count: int = 1):
+        self.counts[self.index(timestamp)] += count
+
+    def add_buckets(self, buckets: Dict[int, int]):
+        for i, count in buckets.items():
+            self.counts[i] += count
+
+    def merge(self, other: 'TimestampHistogram'):
+        if (other.start, other.end, len(other.counts)) != (self.start, self.end, len(self.counts)):
+            raise ValueError("Cannot merge timestamp histograms of different buckets")
+        self.add_buckets(dict(enumerate(other.counts)))
+
+    def copy(self) -> 'TimestampHistogram':
+        histogram = TimestampHistogram(self.start, self.end, len(self.counts))
+        histogram.counts = list(self.counts)
+        return histogram
+
+    def delays(self, at: float) -> List[Tuple[float, int]]:
+        """
+        :return: the delay from the middle of each non-empty bucket to the given time, and its count.
+        """
+        return [(at - self.start - (i + 0.5) * self._width, count) for i, count in enumerate(self.counts) if count]
+
+
+@dataclass(slots=True)
+class Aggregate:
+    """
+    Mergeable aggregate of the points of a key: count, sum, sum of squares, extremes, last timestamp
+    and a quantile sketch of the values, with a histogram of the timestamps when read from window aggregates.
+    """
+    count: int = 0
+    sum: float = 0.0
+    sum_sq: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+    last_timestamp: float = 0.0
+    sketch: QuantileSketch = field(default_factory=QuantileSketch)
+    timestamps: Optional[TimestampHistogram] = None
+
+    @classmethod
+    def from_points(cls, points: List[Tuple[float, float]]) -> 'Aggregate':
+        """
+        :param points: (value, timestamp) tuples.
+        """
+        aggregate = cls()
+        for value, timestamp in points:
+            aggregate.add(float(value), timestamp)
+        return aggregate
+
+    def add(self, value: float, timestamp: float):
+        self.count += 1
+        self.sum += value
+        self.sum_sq += value * value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last_timestamp = max(self.last_timestamp, timestamp)
+        self.sketch.add(value)
+
+    def merge(self, other: 'Aggregate'):
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.last_timestamp = max(self.last_timestamp, other.last_timestamp)
+        self.sketch.merge(other.sketch)
+        if other.timestamps is not None:
+            if self.timestamps is None:
+                self.timestamps = other.timestamps.copy()
+            else:
+                self.timestamps.merge(other.timestamps)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0
+
+    @property
+    def stddev(self) -> float:
+        if not self.count:
+            return 0
+        # population standard deviation, clamped as rounding can make the variance slightly negative
+        return math.sqrt(max(self.sum_sq / self.count - self.mean ** 2, 0))
+
+    def quantile(self, q: float) -> float:
+        value = self.sketch.quantile(q)
+        if value is None:
+            return 0
+        # the exact extremes are known, so the estimate never goes beyond them
+        return min(max(value, self.min), self.max)
+
+    def statistic(self, name: str) -> float:
+        """
+        :param name: one of STATISTICS.
+        :return: the statistic, 0 for an empty aggregate as with the mean.
+        """
+        if name == 'count':
+            return self.count
+        if not self.count:
+            return 0
+        if name == 'min':
+            return self.min
+        if name == 'max':
+            return self.max
+        if name == 'stddev':
+            return self.stddev
+        if name.startswith('p') and name[1:].isdigit():
+            return self.quantile(int(name[1:]) / 100)
+        raise ValueError(f"Unknown statistic {name}")
@@ -1,2 +1,6 @@
 PROCESSING_QUEUE_NAME = 'sensor_data'
+PROCESSING_EXCHANGE_NAME = 'sensor_data'
+# routes by the hash of the routing key, provided by the rabbitmq_consistent_hash_exchange plugin
+PROCESSING_EXCHANGE_TYPE = 'x-consistent-hash'
 RESULT_EXCHANGE_NAME = 'result_exchange'
+RESULTS_STREAM_NAME = 'results'
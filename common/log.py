@@ -1,19 +1,65 @@
+import atexit
 import logging
 import os
+import queue
+import random
 from logging import config
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
 LOGGER_LEVEL = 'info'
 LOGGER_STREAM = 'ext://sys.stderr'
 LOGGER_FORMAT = "%(asctime)s [%(levelname)s] %(filename)s:%(lineno)s -- %(message)s"
 LOGGER_FORMAT_SHORT = "[%(levelname)s] %(filename)s:%(lineno)s -- %(message)s"
 LOGGER_LEVEL_CHOICES = ["debug", "info", "warning", "error", "critical"]
+LOGGER_NAMES = ['benchmark', 'common', 'fakes', 'fleet', 'load_balancer', 'proxy', 'recorder', 'sensor', 'server',
+                'terminal', '__main__']
+
+# extra of the per-message debug records, of which only a sample is logged if a sample rate is set
+SAMPLED = {'sampled': True}
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Queues the records as they are, so their messages are formatted by the writer thread rather than by the
+    logging one. The arguments of the records must not be modified after logging them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _SampleFilter(logging.Filter):
+    """
+    Keeps a random sample of the debug records marked as sampled, and every other record.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self._rate
 
 
 def setup_logger(
         log_level=LOGGER_LEVEL,
         log_format=LOGGER_FORMAT,
-        stream=LOGGER_STREAM, filename=None
+        stream=LOGGER_STREAM, filename=None,
+        sample_rate=None
 ):
+    """
+    Logs to the stream through a queue, written by a background thread, so logging never blocks on the stream.
+    :param sample_rate: fraction of the per-message debug records to log, all of them by default.
+    """
+    if sample_rate is not None and not 0 < sample_rate <= 1:
+        raise ValueError(f"Log sample rate {sample_rate} must be in (0, 1]")
+
     if log_level is None or str(log_level).lower() == 'none':
         return
 
@@ -54,10 +100,50 @@ def setup_logger(
                 'handlers': ['console_handler'],
                 'level': log_level,
                 'propagate': False
-            } for k in ['common', 'load_balancer', 'proxy', 'sensor', 'server', 'terminal', '__main__']
+            } for k in LOGGER_NAMES
         }
     }
     if filename is not os.devnull:
-        config_dict['loggers']['']['handlers'] = ['file_handler']
+        config_dict['loggers'][''] = {'handlers': ['file_handler'], 'level': log_level}
 
+    _stop_queue()
     logging.config.dictConfig(config_dict)
+    _start_queue([logging.getLogger(name) for name in LOGGER_NAMES], sample_rate)
+
+
+def _start_queue(loggers, sample_rate):
+    # the loggers share their handlers, which are moved behind a single queue
+    global _listener, _queue_handler
+    handlers = list(dict.fromkeys(handler for logger in loggers for handler in logger.handlers))
+    records = queue.SimpleQueue()
+    _queue_handler = _DeferredQueueHandler(records)
+    if sample_rate is not None and sample_rate < 1:
+        _queue_handler.addFilter(_SampleFilter(sample_rate))
+    for logger in loggers:
+        logger.handlers = [_queue_handler]
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_queue():
+    global _listener
+    if _listener is not None:
+        # writes the records left in the queue
+        _listener.stop()
+        _listener = None
+
+
+def _write_directly():
+    # forked processes, like the processing workers, do not inherit the writer thread
+    global _listener
+    if _listener is None:
+        return
+    for name in LOGGER_NAMES:
+        logger = logging.getLogger(name)
+        if _queue_handler in logger.handlers:
+            logger.handlers = list(_listener.handlers)
+    _listener = None
+
+
+atexit.register(_stop_queue)
+os.register_at_fork(after_in_child=_write_directly)
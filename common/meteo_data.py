@@ -1,49 +1,212 @@
 import dataclasses
+import json
+import math
+import struct
 from dataclasses import dataclass
+from enum import Enum
 from json import JSONEncoder, JSONDecoder, JSONDecodeError
+from operator import attrgetter
+from typing import Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-@dataclass
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/vnd.meteo.binary'
+
+
+@dataclass(slots=True)
 class RawMeteoData:
     temperature: float
     humidity: float
     timestamp: float
 
 
-@dataclass
+@dataclass(slots=True)
 class RawPollutionData:
     co2: float
     timestamp: float
 
 
-@dataclass
+@dataclass(slots=True)
 class Results:
     wellness_data: float
     wellness_timestamp: float
     pollution_data: float
     pollution_timestamp: float
+    # window size and hop in ms, 0 if not sent
+    window_size: float = 0.0
+    hop: float = 0.0
+    # statistics of the window, only sent if selected (see common.aggregates.STATISTICS)
+    wellness_count: Optional[float] = None
+    wellness_min: Optional[float] = None
+    wellness_max: Optional[float] = None
+    wellness_stddev: Optional[float] = None
+    wellness_p50: Optional[float] = None
+    wellness_p95: Optional[float] = None
+    wellness_p99: Optional[float] = None
+    pollution_count: Optional[float] = None
+    pollution_min: Optional[float] = None
+    pollution_max: Optional[float] = None
+    pollution_stddev: Optional[float] = None
+    pollution_p50: Optional[float] = None
+    pollution_p95: Optional[float] = None
+    pollution_p99: Optional[float] = None
+
+
+_RESULTS_OPTIONAL_FIELDS = tuple(f.name for f in dataclasses.fields(Results) if f.default is None)
 
 
 class MeteoEncoder(JSONEncoder):
     def default(self, o):
-        data = dataclasses.asdict(o)
-        data['type'] = o.__class__.__name__
-        return data
+        if type(o) in _JSON_TYPES.values():
+            return _to_json_dict(o)
+        return super().default(o)
 
 
 class MeteoDecoder(JSONDecoder):
     def decode(self, s, _w=object()):
-        data = super().decode(s)
+        return _from_json_dict(super().decode(s), s)
+
+
+_JSON_TYPES = {
+    'RawMeteoData': RawMeteoData,
+    'RawPollutionData': RawPollutionData,
+    'Results': Results,
+}
+
+
+def _to_json_dict(o) -> dict:
+    # built by hand instead of with dataclasses.asdict, which deep-copies every field
+    cls = type(o)
+    if cls is RawMeteoData:
+        return {'temperature': o.temperature, 'humidity': o.humidity, 'timestamp': o.timestamp,
+                'type': 'RawMeteoData'}
+    elif cls is RawPollutionData:
+        return {'co2': o.co2, 'timestamp': o.timestamp, 'type': 'RawPollutionData'}
+    elif cls is Results:
+        d = {'wellness_data': o.wellness_data, 'wellness_timestamp': o.wellness_timestamp,
+             'pollution_data': o.pollution_data, 'pollution_timestamp': o.pollution_timestamp,
+             'window_size': o.window_size, 'hop': o.hop}
+        for name in _RESULTS_OPTIONAL_FIELDS:
+            value = getattr(o, name)
+            if value is not None:
+                d[name] = value
+        d['type'] = 'Results'
+        return d
+    raise TypeError(f"Object of type {cls.__name__} is not JSON serializable")
+
+
+def _from_json_dict(data, s):
+    try:
+        data_type = data.pop('type')
+    except (KeyError, TypeError, AttributeError):
+        raise _decode_error("Missing type field", s)
+    try:
+        cls = _JSON_TYPES[data_type]
+    except (KeyError, TypeError):
+        raise _decode_error(f"Unknown type {data_type}", s)
+    try:
+        return cls(**data)
+    except TypeError as e:
+        raise _decode_error(f"Invalid {data_type} fields: {e}", s)
+
+
+def _decode_error(msg: str, s) -> JSONDecodeError:
+    return JSONDecodeError(msg, s if isinstance(s, str) else s.decode('utf-8', 'replace'), 0)
+
+
+class WireFormat(Enum):
+    Json = 'json'
+    Binary = 'binary'
+
+    @property
+    def content_type(self) -> str:
+        return JSON_CONTENT_TYPE if self == WireFormat.Json else BINARY_CONTENT_TYPE
+
+
+class MeteoBinaryCodec:
+    """
+    Fixed-layout binary codec: a one-byte type tag followed by the fields of the message packed as
+    little-endian float64 values, in declaration order. Optional fields that are not set are sent as NaN.
+    """
+
+    # type tag -> message class; tags must never be reused for a different layout
+    TYPES = {
+        1: RawMeteoData,
+        2: RawPollutionData,
+        5: Results,
+    }
+    # type tag -> message class and number of leading fields, of layouts that are only decoded
+    LEGACY_TYPES = {
+        3: (Results, 4),
+        4: (Results, 6),
+    }
+
+    def __init__(self):
+        self._encoders = {}
+        self._decoders = {}
+        for tag, cls in self.TYPES.items():
+            fields = dataclasses.fields(cls)
+            layout = struct.Struct(f'<B{len(fields)}d')
+            # index of the first optional field, they are always the last ones
+            optional = next((i for i, f in enumerate(fields) if f.default is None), None)
+            self._encoders[cls] = (tag, layout, attrgetter(*(f.name for f in fields)), optional)
+            self._decoders[tag] = (cls, layout, optional)
+        for tag, (cls, field_count) in self.LEGACY_TYPES.items():
+            self._decoders[tag] = (cls, struct.Struct(f'<B{field_count}d'), None)
+
+    def encode(self, o) -> bytes:
+        try:
+            tag, layout, getter, optional = self._encoders[type(o)]
+        except KeyError:
+            raise TypeError(f"Object of type {o.__class__.__name__} is not serializable")
+        if optional is not None:
+            return layout.pack(tag, *(math.nan if v is None else v for v in getter(o)))
+        return layout.pack(tag, *getter(o))
+
+    def decode(self, b: bytes):
+        if not b:
+            raise ValueError("Empty message")
         try:
-            data_type = data['type']
-        except (KeyError, TypeError):
-            raise JSONDecodeError("Missing type field", s, 0)
-        data.pop('type')
-        if data_type == 'RawMeteoData':
-            return RawMeteoData(**data)
-        elif data_type == 'RawPollutionData':
-            return RawPollutionData(**data)
-        elif data_type == 'Results':
-            return Results(**data)
-        else:
-            raise JSONDecodeError(f"Unknown type {data['type']}", s, 0)
+            cls, layout, optional = self._decoders[b[0]]
+        except KeyError:
+            raise ValueError(f"Unknown type tag {b[0]}")
+        if len(b) != layout.size:
+            raise ValueError(f"Invalid message size {len(b)} for type {cls.__name__}, expected {layout.size}")
+        if optional is not None:
+            values = layout.unpack(b)[1:]
+            return cls(*values[:optional], *(None if math.isnan(v) else v for v in values[optional:]))
+        return cls(*layout.unpack(b)[1:])
+
+
+_binary_codec = MeteoBinaryCodec()
+
+
+def encode_message(o, wire_format: WireFormat = WireFormat.Json) -> bytes:
+    """
+    Serializes a message in the given wire format. The content type of the format must be sent along
+    with the message (see WireFormat.content_type).
+    JSON messages are serialized with orjson when it is installed, which only changes their whitespace.
+    """
+    if wire_format == WireFormat.Binary:
+        return _binary_codec.encode(o)
+    if orjson is not None:
+        return orjson.dumps(_to_json_dict(o))
+    return json.dumps(_to_json_dict(o)).encode('utf-8')
+
+
+def decode_message(body: bytes, content_type: Optional[str] = None):
+    """
+    Deserializes a message of either wire format, based on its content type.
+    Messages without a content type are JSON, as sent before the binary format existed.
+    :raise ValueError: if the message cannot be decoded.
+    """
+    if content_type == BINARY_CONTENT_TYPE:
+        return _binary_codec.decode(body)
+    if content_type is None or content_type == JSON_CONTENT_TYPE:
+        data = orjson.loads(body) if orjson is not None else json.loads(body)
+        return _from_json_dict(data, body)
+    raise ValueError(f"Unknown content type {content_type}")
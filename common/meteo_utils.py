@@ -1,8 +1,15 @@
+import logging
+import math
+import os
 import random
+import struct
+import tempfile
 import time
+from typing import Optional
 
-from numpy import linspace, searchsorted
-from scipy.stats import norm
+from numpy import asarray, ceil, clip, float64, intp, linspace, memmap, ndarray, stack, where
+
+logger = logging.getLogger(__name__)
 
 # Approximated realistic ranges for air condition parameters
 MIN_TEMPERATURE = -10
@@ -21,6 +28,20 @@ OPTIMAL_HUMIDITY = 40
 MIN_PROCESS_TIME = 0.5
 MAX_PROCESS_TIME = 3.5
 
+# Number of points of each distribution table
+DISTRIBUTION_POINTS = 1000
+
+# Precomputed distribution tables file.
+# Layout: fixed-size little-endian header (magic, format version, number of points and the
+# (min, max, optimal) parameters of the temperature, co2 and humidity distributions), followed by
+# six float64 rows: temperature space, temperature values, co2 space, co2 values, humidity space
+# and humidity values.
+TABLES_PATH = os.environ.get('METEO_TABLES_PATH', os.path.join(os.path.dirname(__file__), 'distribution_tables.bin'))
+TABLES_MAGIC = b'METEODST'
+TABLES_VERSION = 1
+TABLES_HEADER_FORMAT = '<8sII9d'
+TABLES_HEADER_SIZE = 128
+
 
 class MeteoDataDetector:
     """
@@ -112,30 +133,37 @@ class MeteoDataProcessor:
 
         Attributes
         ----------
-        temperature_space : list
+        temperature_space : ndarray
             1000 equidistant values covering the accepted temperature range.
-        temperature_vals : list
+        temperature_vals : ndarray
             Normalize wellness values for each of the temperature space values.
-        co2_space : list
+        co2_space : ndarray
             1000 equidistant values covering the accepted co2 concentration range.
-        co2_vals : list
+        co2_vals : ndarray
             Normalize wellness values for each of the co2 space values.
-        humidity_space : list
+        humidity_space : ndarray
             1000 equidistant values covering the accepted humidity concentration range.
-        humidity_vals : list
+        humidity_vals : ndarray
             Normalize wellness values for each of the humidity space values.
         """
 
-    def __init__(self):
+    def __init__(self, tables_path: Optional[str] = TABLES_PATH):
         """
         Initializes distributions (space and values) for each of the air wellness parameters (temperature,
         co2 concentration and humidity percentage).
+        The distributions are memory mapped from the precomputed tables file, which is (re)built first if it is
+        missing or was built with different parameters. If tables_path is None, they are computed in memory.
+        :param tables_path: path of the precomputed distribution tables file.
         """
 
-        self.temperature_space, self.temperature_vals = _gen_distribution(MIN_TEMPERATURE, MAX_TEMPERATURE,
-                                                                          OPTIMAL_TEMPERATURE)
-        self.co2_space, self.co2_vals = _gen_distribution(MIN_CO2, MAX_CO2, OPTIMAL_CO2)
-        self.humidity_space, self.humidity_vals = _gen_distribution(MIN_HUMIDITY, MAX_HUMIDITY, OPTIMAL_HUMIDITY)
+        if tables_path is None:
+            tables = _gen_distribution_tables()
+        else:
+            tables = load_distribution_tables(tables_path)
+
+        (self.temperature_space, self.temperature_vals,
+         self.co2_space, self.co2_vals,
+         self.humidity_space, self.humidity_vals) = tables
 
     def process_meteo_data(self, meteo_data):
         """
@@ -173,12 +201,139 @@ class MeteoDataProcessor:
 
         return co2_wellness
 
+    def process_meteo_data_batch(self, temperatures, humidities) -> ndarray:
+        """
+        Vectorized version of process_meteo_data.
+        Processes a batch of temperature and humidity readings in a single call, returning the same air wellness
+        values the scalar method would return for each reading. The simulated execution time is applied once
+        per batch.
+        :param temperatures: array of temperature values within the accepted range.
+        :param humidities: array of humidity percentage values within the accepted range.
+        :return: array of air wellness values.
+        """
+
+        temperature_wellness = _values_from_distribution(self.temperature_space, self.temperature_vals,
+                                                         temperatures)
+        humidity_wellness = _values_from_distribution(self.humidity_space, self.humidity_vals, humidities)
+
+        # Harmonic mean
+        air_wellness = (2 / (1 / temperature_wellness + 1 / humidity_wellness)).round(2)
+
+        self._simulate_execution_time()
+
+        return air_wellness
+
+    def process_pollution_data_batch(self, co2s) -> ndarray:
+        """
+        Vectorized version of process_pollution_data.
+        Processes a batch of co2 quantifications in a single call, returning the same air pollution values
+        the scalar method would return for each reading. The simulated execution time is applied once per batch.
+        :param co2s: array of co2 concentration values within the accepted range.
+        :return: array of air pollution values.
+        """
+
+        co2_wellness = _values_from_distribution(self.co2_space, self.co2_vals, co2s).round(2)
+
+        self._simulate_execution_time()
+
+        return co2_wellness
 
     def _simulate_execution_time(self):
         time.sleep(random.uniform(MIN_PROCESS_TIME, MAX_PROCESS_TIME))
 
 
 
+def build_distribution_tables(path=TABLES_PATH):
+    """
+    Computes the distribution tables and saves them to a binary file that can be memory mapped.
+    The file is written atomically, so concurrent readers never see a partially written file.
+    :param path: path of the tables file.
+    :return: the path of the tables file.
+    """
+
+    tables = stack(_gen_distribution_tables()).astype('<f8')
+    header = struct.pack(TABLES_HEADER_FORMAT, TABLES_MAGIC, TABLES_VERSION, DISTRIBUTION_POINTS,
+                         *_distribution_params())
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(header.ljust(TABLES_HEADER_SIZE, b'\0'))
+        f.write(tables.tobytes())
+    os.replace(f.name, path)
+    logger.info(f"Saved distribution tables to {path}")
+    return path
+
+
+def load_distribution_tables(path=TABLES_PATH):
+    """
+    Memory maps the distribution tables from a binary file, so that several processes share the same pages.
+    The file is rebuilt if it is missing, has a different format version or was built with different parameters.
+    If it cannot be rebuilt (e.g. a read-only filesystem), the tables are computed in memory.
+    :param path: path of the tables file.
+    :return: temperature space, temperature values, co2 space, co2 values, humidity space, humidity values.
+    """
+
+    if not _valid_distribution_tables(path):
+        logger.info(f"Distribution tables at {path} are missing or outdated, rebuilding them")
+        try:
+            build_distribution_tables(path)
+        except OSError as e:
+            logger.warning(f"Failed to save distribution tables to {path}: {e}")
+            return _gen_distribution_tables()
+
+    tables = memmap(path, dtype='<f8', mode='r', offset=TABLES_HEADER_SIZE, shape=(6, DISTRIBUTION_POINTS))
+    return tuple(tables)
+
+
+def _valid_distribution_tables(path):
+    """
+    Checks whether a tables file exists and matches the current format version and distribution parameters.
+    :param path: path of the tables file.
+    :return: True if the file can be used as is.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(TABLES_HEADER_SIZE)
+            size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return False
+
+    if len(header) < TABLES_HEADER_SIZE:
+        return False
+
+    magic, version, points, *params = struct.unpack_from(TABLES_HEADER_FORMAT, header)
+    return (
+        magic == TABLES_MAGIC
+        and version == TABLES_VERSION
+        and points == DISTRIBUTION_POINTS
+        and tuple(params) == _distribution_params()
+        and size == TABLES_HEADER_SIZE + 6 * DISTRIBUTION_POINTS * 8
+    )
+
+
+def _distribution_params():
+    """
+    :return: (min, max, optimal) values of the temperature, co2 and humidity distributions.
+    """
+    return tuple(float(x) for x in (
+        MIN_TEMPERATURE, MAX_TEMPERATURE, OPTIMAL_TEMPERATURE,
+        MIN_CO2, MAX_CO2, OPTIMAL_CO2,
+        MIN_HUMIDITY, MAX_HUMIDITY, OPTIMAL_HUMIDITY,
+    ))
+
+
+def _gen_distribution_tables():
+    """
+    Generate the distributions of the three air wellness parameters.
+    :return: temperature space, temperature values, co2 space, co2 values, humidity space, humidity values.
+    """
+    return (
+        *_gen_distribution(MIN_TEMPERATURE, MAX_TEMPERATURE, OPTIMAL_TEMPERATURE),
+        *_gen_distribution(MIN_CO2, MAX_CO2, OPTIMAL_CO2),
+        *_gen_distribution(MIN_HUMIDITY, MAX_HUMIDITY, OPTIMAL_HUMIDITY),
+    )
+
+
 def _gen_distribution(min_val, max_val, opt_val):
     """
     Generate a skewed gaussian distribution.
@@ -190,7 +345,7 @@ def _gen_distribution(min_val, max_val, opt_val):
 
     location = opt_val
     scale = _get_scale(min_val, max_val)
-    x = linspace(min_val, max_val, 1000)
+    x = linspace(min_val, max_val, DISTRIBUTION_POINTS)
 
     p = _skew_norm_pdf(x, location, scale)
 
@@ -205,6 +360,9 @@ def _skew_norm_pdf(x, center, scale):
     :param scale: scale of the distribution.
     :return: frequencies for the skewed gaussian distribution in space x.
     """
+    # scipy is only needed to build the tables, so it is not imported at module load
+    from scipy.stats import norm
+
     t = (x - center) / scale
     return 2.0 * center * norm.pdf(t) * 0.5
 
@@ -225,11 +383,12 @@ def _normalize_data(data):
     """
     Normalize a list of values to their range.
     :param data: list of values.
-    :return: normalized values for data.
+    :return: normalized values for data (as an array, so it can be indexed with arrays of positions).
     """
-    min_val = min(data)
-    max_val = max(data)
-    return [(d - min_val) / (max_val - min_val) for d in data]
+    data = asarray(data)
+    min_val = data.min()
+    max_val = data.max()
+    return (data - min_val) / (max_val - min_val)
 
 
 def _value_from_distribution(space, values, x):
@@ -240,10 +399,62 @@ def _value_from_distribution(space, values, x):
     :param x: a value within the space of the distribution.
     :return: probability of value x in the distribution.
     """
-    position = searchsorted(space, [x])[0]
-    if position == len(space):
-        position -= 1
+    position = _position_in_space(space, x)
     value = values[position]
     if value == 0:
         value = 0.001
     return value
+
+
+def _values_from_distribution(space, values, xs):
+    """
+    Vectorized version of _value_from_distribution.
+    :param space: array of equidistant values within the space of the distribution.
+    :param values: array of probabilities for each of the entries in the space.
+    :param xs: array of values within the space of the distribution.
+    :return: array with the probability of each value of xs in the distribution.
+    """
+    result = values[_positions_in_space(space, xs)]
+    return where(result == 0, 0.001, result)
+
+
+def _position_in_space(space, x):
+    """
+    Get the position of a value in an equidistant space.
+    Equivalent to searchsorted(space, x) clipped to the last position, but computed directly from the
+    uniform spacing of the space instead of with a binary search.
+    :param space: list of equidistant values within the space of the distribution.
+    :param x: a value within the space of the distribution.
+    :return: position of x in the space.
+    """
+    last = len(space) - 1
+    start = space[0]
+    if not x <= space[last]:
+        return last
+    if x <= start:
+        return 0
+    position = min(math.ceil((x - start) / ((space[last] - start) / last)), last)
+    # correct the rounding error of the estimate against the actual space values
+    if space[position - 1] >= x:
+        position -= 1
+    elif space[position] < x:
+        position += 1
+    return position
+
+
+def _positions_in_space(space, xs):
+    """
+    Vectorized version of _position_in_space.
+    :param space: array of equidistant values within the space of the distribution.
+    :param xs: array of values within the space of the distribution.
+    :return: array with the position of each value of xs in the space.
+    """
+    last = len(space) - 1
+    start = space[0]
+    xs = asarray(xs, dtype=float64)
+    estimate = where(xs <= space[last], (xs - start) / ((space[last] - start) / last), last)
+    positions = clip(ceil(estimate), 0, last).astype(intp)
+    # correct the rounding error of the estimate against the actual space values
+    positions -= (positions > 0) & (space[positions - 1] >= xs)
+    positions += (positions < last) & (space[positions] < xs)
+    return positions
@@ -0,0 +1,252 @@
+import bisect
+import logging
+import math
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Tuple, Dict, List, Optional, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in s, from 100 us to 10 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# (suffix, labels, value) samples of a metric
+Samples = Iterable[Tuple[str, Tuple[Tuple[str, str], ...], float]]
+
+
+class Registry:
+    """
+    Metrics of a process, exposed in the Prometheus text format.
+    Metrics are registered when their module is imported, but only record anything once the registry is
+    enabled, so instrumented code costs a single attribute check per update when metrics are not exposed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics: Dict[str, '_Metric'] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> 'Counter':
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...] = (),
+            function: Optional[Callable[[], float]] = None,
+    ) -> 'Gauge':
+        """
+        :param function: computes the value of the gauge when exposed, instead of setting it.
+        """
+        return self._register(Gauge(self, name, documentation, labelnames, function))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> 'Histogram':
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def expose(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f"{metric.name}{suffix}{'{' + label_text + '}' if labels else ''} {_format(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self._registry = registry
+        self._labelnames = labelnames
+        self._children: Dict[Tuple[str, ...], '_Metric'] = {}
+
+    def labels(self, *values: str) -> '_Metric':
+        """
+        :return: the child metric of the label values, to keep and update instead of the parent.
+        """
+        if len(values) != len(self._labelnames):
+            raise ValueError(f"Expected values for labels {self._labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._child())
+        return child
+
+    def samples(self) -> Samples:
+        if not self._labelnames:
+            yield from self._own_samples(())
+            return
+        for values, child in list(self._children.items()):
+            yield from child._own_samples(tuple(zip(self._labelnames, values)))
+
+    def _child(self) -> '_Metric':
+        raise NotImplementedError
+
+    def _own_samples(self, labels: Tuple[Tuple[str, str], ...]) -> Samples:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(registry, name, documentation, labelnames)
+        self._value = 0.0
+
+    def inc(self, amount: float = 1):
+        if self._registry.enabled:
+            self._value += amount
+
+    def _child(self) -> 'Counter':
+        return Counter(self._registry, self.name, self.documentation)
+
+    def _own_samples(self, labels: Tuple[Tuple[str, str], ...]) -> Samples:
+        yield '', labels, self._value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(
+            self,
+            registry: Registry,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...] = (),
+            function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(registry, name, documentation, labelnames)
+        self._value = 0.0
+        self._function = function
+
+    def set(self, value: float):
+        if self._registry.enabled:
+            self._value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def _child(self) -> 'Gauge':
+        return Gauge(self._registry, self.name, self.documentation)
+
+    def _own_samples(self, labels: Tuple[Tuple[str, str], ...]) -> Samples:
+        yield '', labels, self._function() if self._function is not None else self._value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(
+            self,
+            registry: Registry,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(registry, name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # per bucket, not cumulative, the last one for the values above every bound
+        self._counts: List[int] = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float, count: int = 1):
+        if self._registry.enabled:
+            self._counts[bisect.bisect_left(self._buckets, value)] += count
+            self._sum += value * count
+
+    def _child(self) -> 'Histogram':
+        return Histogram(self._registry, self.name, self.documentation, buckets=self._buckets)
+
+    def _own_samples(self, labels: Tuple[Tuple[str, str], ...]) -> Samples:
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), list(self._counts)):
+            cumulative += count
+            yield '_bucket', labels + (('le', _format(bound)),), cumulative
+        yield '_sum', labels, self._sum
+        yield '_count', labels, cumulative
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        function: Optional[Callable[[], float]] = None,
+) -> Gauge:
+    return REGISTRY.gauge(name, documentation, labelnames, function)
+
+
+def histogram(
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+) -> Histogram:
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+def start_http_server(port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Enables the registry and serves its metrics at /metrics from a daemon thread.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+    registry.enabled = True
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on {host}:{port}/metrics")
+    return server
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
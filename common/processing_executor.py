@@ -0,0 +1,164 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from enum import Enum
+from typing import Optional, List, Tuple, Sequence
+
+from common import metrics
+from common.meteo_data import RawMeteoData, RawPollutionData
+from common.meteo_utils import MeteoDataProcessor
+from common.tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_WAIT_TIME = metrics.histogram('processing_executor_wait_seconds',
+                                       "Time the processing calls wait for an executor worker")
+PROCESS_TIME = metrics.histogram('processing_seconds', "Time spent processing readings in the executor")
+
+
+class ExecutorType(Enum):
+    Thread = 'thread'
+    Process = 'process'
+    Inline = 'inline'
+
+
+class ProcessingExecutor:
+    """
+    Runs the MeteoDataProcessor computations of the server on the configured backend.
+
+    - thread: a thread pool (the event loop's default one unless a number of workers is given).
+    - process: a process pool; each worker process builds its own MeteoDataProcessor once, so only the
+      readings and the results are pickled on each call.
+    - inline: directly on the event loop, only suitable for processing that does not block.
+    """
+
+    def __init__(
+            self,
+            processor: Optional[MeteoDataProcessor],
+            executor_type: Optional[ExecutorType] = None,
+            workers: Optional[int] = None,
+    ):
+        """
+        :param processor: processor of the thread and inline backends, not used by the process one.
+        """
+        self._type = executor_type or ExecutorType.Thread
+        self._executor: Optional[Executor] = None
+        if self._type == ExecutorType.Process:
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+            self._process_meteo_data = _worker_process_meteo_data
+            self._process_pollution_data = _worker_process_pollution_data
+            self._process_batch = _worker_process_batch
+        elif self._type in (ExecutorType.Thread, ExecutorType.Inline):
+            if processor is None:
+                raise ValueError(f"The {self._type.value} processing executor requires a processor")
+            if self._type == ExecutorType.Thread and workers:
+                self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._process_meteo_data = processor.process_meteo_data
+            self._process_pollution_data = processor.process_pollution_data
+            self._process_batch = functools.partial(_process_batch, processor)
+        else:
+            raise ValueError(f"Invalid executor type {executor_type}")
+        logger.info(f"Using {self._type.value} processing executor" + (f" with {workers} workers" if workers else ""))
+
+    @property
+    def executor_type(self) -> ExecutorType:
+        return self._type
+
+    async def process_meteo_data(self, raw_meteo_data: RawMeteoData, trace: Optional[Trace] = None) -> float:
+        return await self._run(self._process_meteo_data, raw_meteo_data, traces=(trace,) if trace else ())
+
+    async def process_pollution_data(
+            self,
+            raw_pollution_data: RawPollutionData,
+            trace: Optional[Trace] = None,
+    ) -> float:
+        return await self._run(self._process_pollution_data, raw_pollution_data, traces=(trace,) if trace else ())
+
+    async def process_batch(
+            self,
+            raw_meteo_data: List[RawMeteoData],
+            raw_pollution_data: List[RawPollutionData],
+            traces: Sequence[Trace] = (),
+    ) -> Tuple[List[float], List[float]]:
+        # only the readings are sent to the executor, not the whole messages
+        return await self._run(
+            self._process_batch,
+            [data.temperature for data in raw_meteo_data],
+            [data.humidity for data in raw_meteo_data],
+            [data.co2 for data in raw_pollution_data],
+            traces=traces,
+        )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn, *args, traces: Sequence[Trace] = ()):
+        """
+        :param traces: traces of the readings processed, whose processing start and end times are set.
+        """
+        if not metrics.REGISTRY.enabled:
+            if self._type == ExecutorType.Inline:
+                return fn(*args)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        submitted, submitted_at = time.monotonic(), time.time()
+        if self._type == ExecutorType.Inline:
+            result, started, finished = _timed(fn, *args)
+        else:
+            result, started, finished = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _timed, fn, *args)
+            EXECUTOR_WAIT_TIME.observe(started - submitted)
+        PROCESS_TIME.observe(finished - started)
+        for trace in traces:
+            # monotonic times converted to the wall clock of the traces
+            trace.processing_started_at = submitted_at + started - submitted
+            trace.processed_at = submitted_at + finished - submitted
+        return result
+
+
+def _timed(fn, *args):
+    # the monotonic clock is shared by the worker processes of the same host
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic()
+
+
+def _process_batch(
+        processor: MeteoDataProcessor,
+        temperatures: List[float],
+        humidities: List[float],
+        co2s: List[float],
+) -> Tuple[List[float], List[float]]:
+    wellness_data, pollution_data = [], []
+    if temperatures:
+        wellness_data = processor.process_meteo_data_batch(temperatures, humidities).tolist()
+    if co2s:
+        pollution_data = processor.process_pollution_data_batch(co2s).tolist()
+    return wellness_data, pollution_data
+
+
+# processor of the current worker process, built once by the pool initializer
+_worker_processor: Optional[MeteoDataProcessor] = None
+
+
+def _init_worker():
+    global _worker_processor
+    _worker_processor = MeteoDataProcessor()
+
+
+def _worker_process_meteo_data(raw_meteo_data: RawMeteoData) -> float:
+    return _worker_processor.process_meteo_data(raw_meteo_data)
+
+
+def _worker_process_pollution_data(raw_pollution_data: RawPollutionData) -> float:
+    return _worker_processor.process_pollution_data(raw_pollution_data)
+
+
+def _worker_process_batch(
+        temperatures: List[float],
+        humidities: List[float],
+        co2s: List[float],
+) -> Tuple[List[float], List[float]]:
+    return _process_batch(_worker_processor, temperatures, humidities, co2s)
@@ -0,0 +1,68 @@
+import bisect
+import hashlib
+from typing import List, Optional
+
+from common.constants import PROCESSING_QUEUE_NAME
+
+DEFAULT_VIRTUAL_NODES = 160
+
+
+def series_key(metric: str, sensor_id: Optional[str]) -> str:
+    """
+    :return: the key of the series of a metric of a sensor, or the metric itself if the sensor is unknown.
+    """
+    return f"{metric}:{sensor_id}" if sensor_id else metric
+
+
+def series_metric(key: str) -> str:
+    """
+    :return: the metric of a series key.
+    """
+    return key.split(':', 1)[0]
+
+
+def processing_queue_name(shard: int) -> str:
+    """
+    :return: the name of a shard of the processing queue.
+    """
+    return f"{PROCESSING_QUEUE_NAME}.{shard}"
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes. Every node is placed at virtual_nodes points of the ring
+    and a key belongs to the first node point after its hash, so adding or removing a node only moves
+    the keys of that node, spread evenly among the others.
+    """
+
+    def __init__(self, nodes: List[str], virtual_nodes: Optional[int] = None):
+        if not nodes:
+            raise ValueError("At least one node must be provided")
+        if len(set(nodes)) != len(nodes):
+            raise ValueError("Node names must be unique")
+        self._nodes = list(nodes)
+        points = sorted(
+            (self._hash(f"{node}#{i}"), n)
+            for n, node in enumerate(self._nodes)
+            for i in range(virtual_nodes or DEFAULT_VIRTUAL_NODES)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [n for _, n in points]
+
+    @property
+    def nodes(self) -> List[str]:
+        return self._nodes
+
+    def node(self, key: str) -> int:
+        """
+        :return: the index of the node of the key.
+        """
+        if len(self._nodes) == 1:
+            return 0
+        i = bisect.bisect(self._points, self._hash(key))
+        return self._owners[i % len(self._owners)]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # stable across processes, unlike hash()
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
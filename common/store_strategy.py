@@ -1,40 +1,773 @@
+import asyncio
+import math
+import time
 from abc import abstractmethod, ABC
-from typing import List, Tuple
+from dataclasses import dataclass, field
+from typing import List, Tuple, Dict, Optional, NamedTuple, Iterable, Callable
 
 from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+from common.aggregates import Aggregate, QuantileSketch, TimestampHistogram, DEFAULT_RELATIVE_ACCURACY
+from common.sharding import HashRing, series_metric
+
+# time in ms the per-window aggregates are kept for (at least two windows)
+DEFAULT_AGGREGATE_TTL = 5 * 60 * 1000
+
+# KEYS[1]: window aggregate hash, ARGV: count, sum, maximum timestamp and TTL in ms of the points to add
+_UPDATE_AGGREGATE_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], 'count', ARGV[1])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum', ARGV[2])
+local max_ts = tonumber(redis.call('HGET', KEYS[1], 'max_ts'))
+if not max_ts or tonumber(ARGV[3]) > max_ts then
+    redis.call('HSET', KEYS[1], 'max_ts', ARGV[3])
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum_sq', ARGV[5])
+local min = tonumber(redis.call('HGET', KEYS[1], 'min'))
+if not min or tonumber(ARGV[6]) < min then
+    redis.call('HSET', KEYS[1], 'min', ARGV[6])
+end
+local max = tonumber(redis.call('HGET', KEYS[1], 'max'))
+if not max or tonumber(ARGV[7]) > max then
+    redis.call('HSET', KEYS[1], 'max', ARGV[7])
+end
+-- quantile sketch and timestamp histogram buckets, as field and count pairs
+for i = 8, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+# time in s between updates of the last seen time of a series in its metric's series index
+SERIES_INDEX_REFRESH = 60
+
+# (resolution, retention) in ms of the default rollups, a retention of 0 keeps the rollups forever
+DEFAULT_ROLLUPS = [
+    (1000, 24 * 60 * 60 * 1000),
+    (60 * 1000, 30 * 24 * 60 * 60 * 1000),
+    (60 * 60 * 1000, 0),
+]
+# time in ms to wait for late points before rolling up a bucket
+DEFAULT_ROLLUP_LATENESS = 5000
+# maximum number of points or rollups read at once to roll them up, so a backlog is rolled up in chunks
+ROLLUP_CHUNK_SIZE = 10000
+# maximum number of series rolled up at the same time on each node
+MAINTAIN_CONCURRENCY = 16
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Retention of the raw data and of its rollups, all in ms.
+    Raw data older than raw_retention is trimmed once rolled up; each rollup resolution is kept for its
+    retention (0 keeps it forever) once rolled up into the next coarser resolution.
+    """
+    raw_retention: int
+    rollups: List[Tuple[int, int]] = field(default_factory=lambda: list(DEFAULT_ROLLUPS))
+    lateness: int = DEFAULT_ROLLUP_LATENESS
+
+    def __post_init__(self):
+        self.rollups = sorted(self.rollups)
+
+    @property
+    def kept_forever(self) -> bool:
+        """
+        :return: whether some level of the series is never trimmed.
+        """
+        return not self.raw_retention or any(not retention for _, retention in self.rollups)
+
+    @property
+    def horizon(self) -> int:
+        """
+        :return: time in ms after the last point of a series from which maintaining it changes nothing more,
+        every level being rolled up and the ones not kept forever trimmed.
+        """
+        retentions = [self.raw_retention] + [retention for _, retention in self.rollups]
+        # a bucket is only trimmed from a level once rolled up into the next one
+        return max(retentions) + max((res for res, _ in self.rollups), default=0) + self.lateness
+
+    def select_resolution(self, start: float, step: Optional[float] = None, now: Optional[float] = None) -> int:
+        """
+        Selects the coarsest resolution not coarser than step (in s) whose retention still covers start.
+        If none covers start, the finest one that does is used, and if none does, the one kept the longest.
+        :return: the resolution in ms, 0 for the raw data.
+        """
+        now = now or time.time()
+        levels = [(0, self.raw_retention)] + self.rollups
+        covering = [res for res, retention in levels if not retention or now - retention / 1000 <= start]
+        if not covering:
+            return max(levels, key=lambda x: x[1] or math.inf)[0]
+        fine_enough = [res for res in covering if res <= (step or 0) * 1000]
+        return fine_enough[-1] if fine_enough else covering[0]
+
+
+class Rollup(NamedTuple):
+    timestamp: float
+    min: float
+    mean: float
+    max: float
+    count: int
 
 
 class StoreStrategy(ABC):
+    @property
+    def retention(self) -> Optional[RetentionPolicy]:
+        """
+        :return: the retention policy applied by maintain(), None if the data is kept as stored.
+        """
+        return None
+
     @abstractmethod
     async def store(self, key: str, timestamp_ns: int, value: float) -> int:
         pass
 
     @abstractmethod
-    def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+    async def store_many(self, key: str, points: List[Tuple[int, float]]) -> int:
+        pass
+
+    @abstractmethod
+    async def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+        pass
+
+    @abstractmethod
+    async def get_many(self, keys: List[str], start: float, end: float) -> Dict[str, List[Tuple[float, float]]]:
+        pass
+
+    @abstractmethod
+    async def get_series(self, key: str, start: float, end: float, step: Optional[float] = None) -> List[Rollup]:
+        pass
+
+    @abstractmethod
+    async def maintain(
+            self,
+            keys: List[str],
+            now: Optional[float] = None,
+            last_seen: Optional[Dict[str, float]] = None
+    ):
+        """
+        :param last_seen: time each series was last seen at in its series index, if known.
+        """
         pass
 
 
 class SortedSetStoreStrategy(StoreStrategy):
-    def __init__(self, redis: Redis):
+    """
+    Stores each key in a sorted set scored by timestamp.
+    With a retention policy, maintain() rolls closed buckets up into one sorted set per resolution
+    ("<key>:rollup:<resolution>"), finest first and each from the previous one, tracking its progress in
+    "<key>:rollup:state", and then trims the data already rolled up and older than its retention.
+    """
+
+    def __init__(self, redis: Redis, retention: Optional[RetentionPolicy] = None):
         self._redis = redis
+        self._retention = retention
+
+    @property
+    def retention(self) -> Optional[RetentionPolicy]:
+        return self._retention
 
     async def store(self, key: str, timestamp_ns: int, value: float) -> int:
         # add the timestamp to the value to make it unique
         return await self._redis.zadd(key, {f"{value}:{timestamp_ns}": timestamp_ns / 1e9})
 
-    def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
-        res = self._redis.zrange(key, start, end, byscore=True, withscores=True)
+    async def store_many(self, key: str, points: List[Tuple[int, float]]) -> int:
+        if not points:
+            return 0
+        # single multi-member ZADD
+        return await self._redis.zadd(key, {
+            f"{value}:{timestamp_ns}": timestamp_ns / 1e9 for timestamp_ns, value in points
+        })
+
+    async def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+        res = await self._redis.zrange(key, start, end, byscore=True, withscores=True)
+        return self._parse(res)
+
+    async def get_many(self, keys: List[str], start: float, end: float) -> Dict[str, List[Tuple[float, float]]]:
+        # one ZRANGE per key, sent in a single round trip
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zrange(key, start, end, byscore=True, withscores=True)
+            res = await pipe.execute()
+        return {key: self._parse(x) for key, x in zip(keys, res)}
+
+    async def get_series(self, key: str, start: float, end: float, step: Optional[float] = None) -> List[Rollup]:
+        resolution = self._retention.select_resolution(start, step) if self._retention else 0
+        if not resolution:
+            return [Rollup(ts, value, value, value, 1) for value, ts in await self.get(key, start, end)]
+        res = await self._redis.zrange(_rollup_key(key, resolution), math.floor(start / (resolution / 1000))
+                                       * resolution / 1000, end, byscore=True)
+        rollups = [_parse_rollup(x) for x in res]
+        return await _with_raw_tail(self, key, rollups, resolution, start, end)
+
+    async def maintain(
+            self,
+            keys: List[str],
+            now: Optional[float] = None,
+            last_seen: Optional[Dict[str, float]] = None
+    ):
+        if self._retention is None:
+            return
+        now = now or time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(f"{key}:rollup:state")
+            res = await pipe.execute()
+        states = {key: {int(k): float(v) for k, v in state.items()} for key, state in zip(keys, res)}
+        # series idle since before every rolled up bucket have nothing left to roll up, only to trim
+        idle = [key for key in keys if self._is_rolled_up(states[key], (last_seen or {}).get(key))]
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in idle:
+                self._trim(pipe, key, states[key], now)
+            await pipe.execute()
+
+        semaphore = asyncio.Semaphore(MAINTAIN_CONCURRENCY)
+
+        async def maintain_series(key: str):
+            async with semaphore:
+                await self._maintain(key, states[key], now)
+
+        idle = set(idle)
+        await asyncio.gather(*(maintain_series(key) for key in keys if key not in idle))
+
+    def _is_rolled_up(self, state: Dict[int, float], last_seen: Optional[float]) -> bool:
+        if last_seen is None or len(state) < len(self._retention.rollups):
+            return False
+        # the last seen time of the index lags behind the last point by up to SERIES_INDEX_REFRESH
+        return last_seen + SERIES_INDEX_REFRESH < min(state.values())
+
+    async def _maintain(self, key: str, state: Dict[int, float], now: float):
+        policy = self._retention
+        state_key = f"{key}:rollup:state"
+
+        # roll up the closed buckets, each resolution from the previous one
+        source_until = now - policy.lateness / 1000
+        for i, (resolution, _) in enumerate(policy.rollups):
+            size = resolution / 1000
+            rolled_until = state.get(resolution, -math.inf)
+            until = math.floor(source_until / size) * size
+            source_key = key if i == 0 else _rollup_key(key, policy.rollups[i - 1][0])
+            while until > rolled_until:
+                # read a bounded chunk, of which only the complete buckets are rolled up
+                source = await self._read_source(source_key, i == 0, rolled_until, until, ROLLUP_CHUNK_SIZE)
+                chunk_until = until
+                if len(source) == ROLLUP_CHUNK_SIZE:
+                    chunk_until = math.floor(source[-1].timestamp / size) * size
+                    if chunk_until > rolled_until:
+                        source = [r for r in source if r.timestamp < chunk_until]
+                    else:
+                        # a single bucket holds more than a chunk
+                        chunk_until = chunk_until + size
+                        source = await self._read_source(source_key, i == 0, rolled_until, chunk_until)
+                rollups = _rollup(source, resolution)
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    if rollups:
+                        pipe.zadd(_rollup_key(key, resolution), {_format_rollup(r): r.timestamp for r in rollups})
+                    pipe.hset(state_key, str(resolution), chunk_until)
+                    await pipe.execute()
+                rolled_until = state[resolution] = chunk_until
+            source_until = min(until, state.get(resolution, -math.inf))
+
+        async with self._redis.pipeline(transaction=False) as pipe:
+            self._trim(pipe, key, state, now)
+            await pipe.execute()
+
+    def _trim(self, pipe, key: str, state: Dict[int, float], now: float):
+        # trim what has already been rolled up and is older than its retention
+        policy = self._retention
+        levels = [(key, policy.raw_retention)] + [(_rollup_key(key, r), ret) for r, ret in policy.rollups]
+        rolled_until = [state.get(r, -math.inf) for r, _ in policy.rollups] + [math.inf]
+        for (level_key, retention), until in zip(levels, rolled_until):
+            if retention:
+                pipe.zremrangebyscore(level_key, '-inf', f"({min(now - retention / 1000, until)}")
+        if not policy.kept_forever:
+            # the state of a series outlives its data by the horizon once it is no longer maintained
+            pipe.pexpire(f"{key}:rollup:state", policy.horizon)
+
+    async def _read_source(
+            self,
+            key: str,
+            raw: bool,
+            start: float,
+            end: float,
+            limit: Optional[int] = None
+    ) -> List[Rollup]:
+        """
+        :return: the raw points, as rollups of one point, or the rollups of the key in [start, end).
+        """
+        page = {'offset': 0, 'num': limit} if limit else {}
+        if raw:
+            points = await self._redis.zrange(key, start, f"({end}", byscore=True, withscores=True, **page)
+            return [Rollup(ts, value, value, value, 1) for value, ts in self._parse(points)]
+        res = await self._redis.zrange(key, start, f"({end}", byscore=True, **page)
+        return [_parse_rollup(x) for x in res]
+
+    @staticmethod
+    def _parse(res) -> List[Tuple[float, float]]:
         return [(float(x.split(b':')[0]), y) for x, y in res]
 
 
 class TimeSeriesStoreStrategy(StoreStrategy):
-    def __init__(self, redis: Redis):
+    """
+    Stores each key in a RedisTimeSeries series.
+    With a retention policy, maintain() sets the retention of the raw series and creates compaction rules
+    into one series per resolution and aggregation ("<key>:rollup:<resolution>:<aggregation>"), which
+    RedisTimeSeries then keeps up to date and trims on its own.
+    """
+
+    ROLLUP_AGGREGATIONS = ('min', 'avg', 'max', 'count')
+
+    def __init__(self, redis: Redis, retention: Optional[RetentionPolicy] = None):
+        self._redis = redis
         self._ts = redis.ts()
+        self._retention = retention
+        self._maintained = set()
+
+    @property
+    def retention(self) -> Optional[RetentionPolicy]:
+        return self._retention
 
     async def store(self, key: str, timestamp_ns: int, value: float) -> int:
         return await self._ts.add(key, int(timestamp_ns / 1e6), value)
 
-    def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+    async def store_many(self, key: str, points: List[Tuple[int, float]]) -> int:
+        if not points:
+            return 0
+        res = await self._ts.madd([(key, int(timestamp_ns / 1e6), value) for timestamp_ns, value in points])
+        # failed samples are returned as errors instead of timestamps
+        return sum(1 for x in res if not isinstance(x, Exception))
+
+    async def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+        start, end = int(start * 1e3), int(end * 1e3)  # convert to milliseconds
+        res = await self._ts.range(key, start, end)
+        return self._parse(res)
+
+    async def get_many(self, keys: List[str], start: float, end: float) -> Dict[str, List[Tuple[float, float]]]:
         start, end = int(start * 1e3), int(end * 1e3)  # convert to milliseconds
-        res = self._ts.range(key, start, end)
-        return [(float(x[1]), x[0]) for x in res]
+        # the TimeSeries pipeline is synchronous only, so TS.RANGE is sent through a core pipeline
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.execute_command('TS.RANGE', key, start, end)
+            res = await pipe.execute()
+        return {key: self._parse(x) for key, x in zip(keys, res)}
+
+    async def get_series(self, key: str, start: float, end: float, step: Optional[float] = None) -> List[Rollup]:
+        resolution = self._retention.select_resolution(start, step) if self._retention else 0
+        if not resolution:
+            return [Rollup(ts, value, value, value, 1) for value, ts in await self.get(key, start, end)]
+        start_ms, end_ms = int(start * 1e3), int(end * 1e3)
+        start_ms -= start_ms % resolution
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for aggregation in self.ROLLUP_AGGREGATIONS:
+                pipe.execute_command('TS.RANGE', _rollup_key(key, resolution, aggregation), start_ms, end_ms)
+            res = await pipe.execute(raise_on_error=False)
+        if any(isinstance(x, Exception) for x in res):
+            # rollup series not created yet
+            res = [[] for _ in self.ROLLUP_AGGREGATIONS]
+        rollups = [
+            Rollup(ts / 1e3, float(mn), float(mean), float(mx), int(float(count)))
+            for (ts, mn), (_, mean), (_, mx), (_, count) in zip(*res)
+        ]
+        return await _with_raw_tail(self, key, rollups, resolution, start, end)
+
+    async def maintain(
+            self,
+            keys: List[str],
+            now: Optional[float] = None,
+            last_seen: Optional[Dict[str, float]] = None
+    ):
+        if self._retention is None:
+            return
+        for key in keys:
+            if key not in self._maintained:
+                await self._create_rules(key)
+                self._maintained.add(key)
+
+    async def _create_rules(self, key: str):
+        policy = self._retention
+        try:
+            await self._ts.create(key, retention_msecs=policy.raw_retention)
+        except ResponseError:
+            # already created by the first sample
+            await self._ts.alter(key, retention_msecs=policy.raw_retention)
+        for resolution, retention in policy.rollups:
+            for aggregation in self.ROLLUP_AGGREGATIONS:
+                dest_key = _rollup_key(key, resolution, aggregation)
+                try:
+                    await self._ts.create(dest_key, retention_msecs=retention)
+                except ResponseError:
+                    await self._ts.alter(dest_key, retention_msecs=retention)
+                try:
+                    await self._ts.createrule(key, dest_key, aggregation, resolution)
+                except ResponseError:
+                    # the rule already exists
+                    pass
+
+    @staticmethod
+    def _parse(res) -> List[Tuple[float, float]]:
+        # timestamps are stored in milliseconds
+        return [(float(x[1]), x[0] / 1e3) for x in res]
+
+
+class AggregatingStoreStrategy(StoreStrategy):
+    """
+    Stores points with the wrapped strategy and also keeps per-window aggregates (count, sum, sum of
+    squares, extremes, maximum timestamp and the buckets of a quantile sketch) of every key, updated
+    atomically on write with a Lua script. Windows are aligned to multiples of the interval: window n
+    covers [n * interval, (n + 1) * interval). Reading a closed window then costs one hash per key
+    instead of a range scan over all its points.
+    Sketch buckets are stored as "p:<index>" and "n:<index>" fields for positive and negative values and
+    "z" for zeros, and are only bounded by the range of the values; readers collapse them if needed.
+    With a group function, the aggregates are kept per group of keys instead, e.g. per metric for the
+    series of every sensor.
+    """
+
+    def __init__(
+            self,
+            store: StoreStrategy,
+            redis: Redis,
+            interval: int,
+            ttl: Optional[int] = None,
+            relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+            group: Optional[Callable[[str], str]] = None,
+    ):
+        self._store = store
+        self._redis = redis
+        self._interval = interval
+        self._relative_accuracy = relative_accuracy
+        self._group = group
+        self._ttl = ttl or max(DEFAULT_AGGREGATE_TTL, 2 * interval)
+        self._update_aggregate = redis.register_script(_UPDATE_AGGREGATE_SCRIPT)
+
+    @property
+    def interval(self) -> int:
+        return self._interval
+
+    @property
+    def retention(self) -> Optional[RetentionPolicy]:
+        return self._store.retention
+
+    def window(self, timestamp: float) -> int:
+        return int(timestamp * 1000) // self._interval
+
+    def window_key(self, key: str, window: int) -> str:
+        return f"{key}:window:{self._interval}:{window}"
+
+    async def store(self, key: str, timestamp_ns: int, value: float) -> int:
+        res, _ = await asyncio.gather(
+            self._store.store(key, timestamp_ns, value),
+            self._update_aggregates(self._group(key) if self._group else key, [(timestamp_ns, value)]),
+        )
+        return res
+
+    async def store_many(self, key: str, points: List[Tuple[int, float]]) -> int:
+        if not points:
+            return 0
+        res, _ = await asyncio.gather(
+            self._store.store_many(key, points),
+            self._update_aggregates(self._group(key) if self._group else key, points),
+        )
+        return res
+
+    async def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+        return await self._store.get(key, start, end)
+
+    async def get_many(self, keys: List[str], start: float, end: float) -> Dict[str, List[Tuple[float, float]]]:
+        return await self._store.get_many(keys, start, end)
+
+    async def get_series(self, key: str, start: float, end: float, step: Optional[float] = None) -> List[Rollup]:
+        return await self._store.get_series(key, start, end, step)
+
+    async def maintain(
+            self,
+            keys: List[str],
+            now: Optional[float] = None,
+            last_seen: Optional[Dict[str, float]] = None
+    ):
+        await self._store.maintain(keys, now, last_seen)
+
+    async def get_aggregates(self, keys: List[str], window: int) -> Dict[str, Aggregate]:
+        """
+        :param keys: keys, or groups with a group function.
+        :return: the aggregate of the points of each key in the window.
+        """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(self.window_key(key, window))
+            res = await pipe.execute()
+        return {key: self._parse_aggregate(fields, window) for key, fields in zip(keys, res)}
+
+    async def _update_aggregates(self, key: str, points: List[Tuple[int, float]]):
+        # aggregate the points of each window first, so a batch costs one script call per window
+        windows: Dict[int, Aggregate] = {}
+        for timestamp_ns, value in points:
+            window = timestamp_ns // 1_000_000 // self._interval
+            aggregate = windows.get(window)
+            if aggregate is None:
+                aggregate = windows[window] = Aggregate(sketch=QuantileSketch(self._relative_accuracy),
+                                                        timestamps=self._timestamp_histogram(window))
+            aggregate.add(float(value), timestamp_ns / 1e9)
+            aggregate.timestamps.add(timestamp_ns / 1e9)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for window, aggregate in windows.items():
+                args = [aggregate.count, aggregate.sum, aggregate.last_timestamp, self._ttl,
+                        aggregate.sum_sq, aggregate.min, aggregate.max]
+                sketch = aggregate.sketch
+                for prefix, buckets in (('p', sketch.positive), ('n', sketch.negative)):
+                    for i, count in buckets.items():
+                        args += [f"{prefix}:{i}", count]
+                if sketch.zero_count:
+                    args += ['z', sketch.zero_count]
+                for i, count in enumerate(aggregate.timestamps.counts):
+                    if count:
+                        args += [f"t:{i}", count]
+                await self._update_aggregate(keys=[self.window_key(key, window)], args=args, client=pipe)
+            await pipe.execute()
+
+    def _timestamp_histogram(self, window: int) -> TimestampHistogram:
+        return TimestampHistogram(window * self._interval / 1000, (window + 1) * self._interval / 1000)
+
+    def _parse_aggregate(self, fields: Dict[bytes, bytes], window: int) -> Aggregate:
+        aggregate = Aggregate(sketch=QuantileSketch(self._relative_accuracy),
+                              timestamps=self._timestamp_histogram(window))
+        if not fields:
+            return aggregate
+        aggregate.count = int(fields[b'count'])
+        aggregate.sum = float(fields[b'sum'])
+        aggregate.last_timestamp = float(fields[b'max_ts'])
+        # windows written before the extended aggregates only have the count, sum and maximum timestamp
+        if b'sum_sq' in fields:
+            aggregate.sum_sq = float(fields[b'sum_sq'])
+            aggregate.min = float(fields[b'min'])
+            aggregate.max = float(fields[b'max'])
+        positive, negative, timestamps = {}, {}, {}
+        for name, count in fields.items():
+            if name.startswith(b'p:'):
+                positive[int(name[2:])] = int(count)
+            elif name.startswith(b'n:'):
+                negative[int(name[2:])] = int(count)
+            elif name.startswith(b't:'):
+                timestamps[int(name[2:])] = int(count)
+        aggregate.sketch.add_buckets(positive, negative, int(fields.get(b'z', 0)))
+        # windows written before the timestamp histograms have none
+        aggregate.timestamps.add_buckets(timestamps)
+        return aggregate
+
+
+class ShardedStoreStrategy(StoreStrategy):
+    """
+    Spreads keys across several Redis nodes with consistent hashing, with one store per node.
+    Series keys of a metric ("<metric>:<sensor id>", see common.sharding) are also recorded, with their
+    last seen time, in the "<metric>:series" sorted set of their node, so readers can list the series of
+    a metric. With per-node AggregatingStoreStrategy stores grouped by metric, every node keeps the
+    partial per-window aggregates of its series, which get_aggregates merges into fleet-wide ones.
+    """
+
+    def __init__(
+            self,
+            nodes: List[Redis],
+            store_factory: Callable[[Redis], StoreStrategy],
+            names: Optional[List[str]] = None,
+            virtual_nodes: Optional[int] = None,
+    ):
+        self._nodes = nodes
+        self._shards = [store_factory(node) for node in nodes]
+        self._ring = HashRing(names or [str(i) for i in range(len(nodes))], virtual_nodes)
+        # last seen time recorded in the series index of each series
+        self._indexed: Dict[str, float] = {}
+
+    @property
+    def shards(self) -> List[StoreStrategy]:
+        return self._shards
+
+    @property
+    def interval(self) -> Optional[int]:
+        """
+        :return: the window interval of the per-node aggregates, None if they are not kept.
+        """
+        shard = self._shards[0]
+        return shard.interval if isinstance(shard, AggregatingStoreStrategy) else None
+
+    @property
+    def retention(self) -> Optional[RetentionPolicy]:
+        return self._shards[0].retention
+
+    def window(self, timestamp: float) -> int:
+        return self._shards[0].window(timestamp)
+
+    def shard(self, key: str) -> int:
+        return self._ring.node(key)
+
+    async def store(self, key: str, timestamp_ns: int, value: float) -> int:
+        return await self.store_many(key, [(timestamp_ns, value)])
+
+    async def store_many(self, key: str, points: List[Tuple[int, float]]) -> int:
+        if not points:
+            return 0
+        shard = self.shard(key)
+        res, _ = await asyncio.gather(
+            self._shards[shard].store_many(key, points),
+            self._index(shard, key, max(timestamp_ns for timestamp_ns, _ in points) / 1e9),
+        )
+        return res
+
+    async def get(self, key: str, start: float, end: float) -> List[Tuple[float, float]]:
+        return await self._shards[self.shard(key)].get(key, start, end)
+
+    async def get_many(self, keys: List[str], start: float, end: float) -> Dict[str, List[Tuple[float, float]]]:
+        res = await asyncio.gather(*(
+            self._shards[shard].get_many(shard_keys, start, end) for shard, shard_keys in self._by_shard(keys)
+        ))
+        return {key: points for shard_res in res for key, points in shard_res.items()}
+
+    async def get_series(self, key: str, start: float, end: float, step: Optional[float] = None) -> List[Rollup]:
+        return await self._shards[self.shard(key)].get_series(key, start, end, step)
+
+    async def maintain(
+            self,
+            keys: List[str],
+            now: Optional[float] = None,
+            last_seen: Optional[Dict[str, float]] = None
+    ):
+        await asyncio.gather(*(
+            self._shards[shard].maintain(shard_keys, now, last_seen) for shard, shard_keys in self._by_shard(keys)
+        ))
+
+    async def series(self, metrics: List[str], since: float) -> Dict[str, List[str]]:
+        """
+        :return: the keys of the series of each metric seen since the given time, within SERIES_INDEX_REFRESH,
+        preceded by the metric key itself, where the points of unknown sensors are stored.
+        """
+        last_seen = await self.last_seen(metrics, since)
+        return {metric: [metric] + sorted(last_seen[metric]) for metric in metrics}
+
+    async def last_seen(self, metrics: List[str], since: float) -> Dict[str, Dict[str, float]]:
+        """
+        :return: the time each series of each metric seen since the given time, within SERIES_INDEX_REFRESH,
+        was last seen at in the series index.
+        """
+        async def node_series(node: Redis) -> List[List[Tuple[bytes, float]]]:
+            async with node.pipeline(transaction=False) as pipe:
+                for metric in metrics:
+                    pipe.zrange(f"{metric}:series", since - SERIES_INDEX_REFRESH, '+inf', byscore=True,
+                                withscores=True)
+                return await pipe.execute()
+
+        res = await asyncio.gather(*(node_series(node) for node in self._nodes))
+        return {
+            metric: {key.decode(): seen for node_res in res for key, seen in node_res[i]}
+            for i, metric in enumerate(metrics)
+        }
+
+    async def forget_series(self, metrics: List[str], until: float):
+        """
+        Removes the series last seen before the given time from the series index of each metric.
+        """
+        async def forget_node_series(node: Redis):
+            async with node.pipeline(transaction=False) as pipe:
+                for metric in metrics:
+                    pipe.zremrangebyscore(f"{metric}:series", '-inf', f"({until}")
+                await pipe.execute()
+
+        await asyncio.gather(*(forget_node_series(node) for node in self._nodes))
+
+    async def get_aggregates(self, metrics: List[str], window: int) -> Dict[str, Aggregate]:
+        """
+        :return: the aggregate of each metric in the window, merged from the partial aggregates of every node.
+        """
+        res = await asyncio.gather(*(shard.get_aggregates(metrics, window) for shard in self._shards))
+        aggregates = res[0]
+        for shard_res in res[1:]:
+            for metric, aggregate in shard_res.items():
+                aggregates[metric].merge(aggregate)
+        return aggregates
+
+    def _by_shard(self, keys: List[str]) -> List[Tuple[int, List[str]]]:
+        shards: Dict[int, List[str]] = {}
+        for key in keys:
+            shards.setdefault(self.shard(key), []).append(key)
+        return list(shards.items())
+
+    async def _index(self, shard: int, key: str, timestamp: float):
+        metric = series_metric(key)
+        if metric == key or timestamp - self._indexed.get(key, -math.inf) < SERIES_INDEX_REFRESH:
+            return
+        self._indexed[key] = timestamp
+        await self._nodes[shard].zadd(f"{metric}:series", {key: timestamp})
+
+
+def sharded_store_strategy(
+        nodes: List[Redis],
+        names: Optional[List[str]] = None,
+        retention: Optional[RetentionPolicy] = None,
+        aggregate_interval: Optional[int] = None,
+) -> ShardedStoreStrategy:
+    """
+    Creates a ShardedStoreStrategy of sorted sets over the given nodes, with per-metric window aggregates
+    of the given interval if any.
+    """
+    def store_factory(node: Redis) -> StoreStrategy:
+        store = SortedSetStoreStrategy(node, retention)
+        if aggregate_interval:
+            store = AggregatingStoreStrategy(store, node, aggregate_interval, group=series_metric)
+        return store
+
+    return ShardedStoreStrategy(nodes, store_factory, names)
+
+
+def _rollup_key(key: str, resolution: int, aggregation: Optional[str] = None) -> str:
+    return f"{key}:rollup:{resolution}" + (f":{aggregation}" if aggregation else "")
+
+
+def _format_rollup(r: Rollup) -> str:
+    # the bucket timestamp makes the member unique
+    return f"{r.min}:{r.mean}:{r.max}:{r.count}:{r.timestamp}"
+
+
+def _parse_rollup(member: bytes) -> Rollup:
+    mn, mean, mx, count, ts = member.split(b':')
+    return Rollup(float(ts), float(mn), float(mean), float(mx), int(count))
+
+
+def downsample(series: Iterable[Rollup], step: float) -> List[Rollup]:
+    """
+    Merges points or rollups, of one or several series, into buckets of step s aligned to the epoch.
+    """
+    return _rollup(series, int(step * 1000))
+
+
+def _rollup(source: Iterable[Rollup], resolution: int) -> List[Rollup]:
+    """
+    Merges points or finer rollups into buckets of the given resolution (in ms).
+    """
+    size = resolution / 1000
+    buckets: Dict[float, List] = {}
+    for r in source:
+        bucket = math.floor(r.timestamp / size) * size
+        b = buckets.get(bucket)
+        if b is None:
+            buckets[bucket] = [r.min, r.mean * r.count, r.max, r.count]
+        else:
+            b[0] = min(b[0], r.min)
+            b[1] += r.mean * r.count
+            b[2] = max(b[2], r.max)
+            b[3] += r.count
+    return [Rollup(ts, mn, total / count, mx, count) for ts, (mn, total, mx, count) in sorted(buckets.items())]
+
+
+async def _with_raw_tail(
+        store: StoreStrategy,
+        key: str,
+        rollups: List[Rollup],
+        resolution: int,
+        start: float,
+        end: float
+) -> List[Rollup]:
+    """
+    Completes rollups with the buckets not rolled up yet, computed from the raw data.
+    """
+    tail_start = rollups[-1].timestamp + resolution / 1000 if rollups else start
+    if tail_start > end:
+        return rollups
+    raw = await store.get(key, tail_start, end)
+    return rollups + _rollup((Rollup(ts, value, value, value, 1) for value, ts in raw), resolution)
@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+from typing import Optional, Dict
+
+from pika.spec import BasicProperties
+
+from common import metrics
+
+TRACE_ID_HEADER = 'trace_id'
+SENT_AT_HEADER = 'sent_at'
+
+# stages of a reading, from its publication by the sensor to its storage by the server
+STAGES = ('transit', 'decode', 'executor_wait', 'process', 'store', 'total')
+STAGE_TIME = metrics.histogram('trace_stage_seconds', "Latency of each stage of the traced readings", ('stage',))
+_STAGE_TIMES = {stage: STAGE_TIME.labels(stage) for stage in STAGES}
+# from the timestamp of the readings to the publication of the windows that include them
+WINDOW_DELAY = metrics.histogram('trace_window_delay_seconds', "Delay from each reading to its window's publication",
+                                 buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+
+
+def trace_headers(trace_id: str, sent_at: float) -> Dict[str, str | float]:
+    """
+    :return: the AMQP headers tracing a message.
+    """
+    return {TRACE_ID_HEADER: trace_id, SENT_AT_HEADER: sent_at}
+
+
+@dataclass(slots=True)
+class Trace:
+    """
+    Wall clock times, in s, of the stages of a traced reading in the server. The transit time depends on
+    the clocks of the sensor and the server being synchronized.
+    """
+    trace_id: str
+    sent_at: float
+    received_at: float
+    decoded_at: float = 0.0
+    processing_started_at: float = 0.0
+    processed_at: float = 0.0
+    stored_at: float = 0.0
+
+    @classmethod
+    def from_properties(cls, properties: BasicProperties, received_at: float) -> Optional['Trace']:
+        """
+        :return: the trace of a message, None if it has no trace headers.
+        """
+        headers = properties.headers
+        if not headers or TRACE_ID_HEADER not in headers:
+            return None
+        trace_id = headers[TRACE_ID_HEADER]
+        return cls(
+            trace_id.decode() if isinstance(trace_id, bytes) else trace_id,
+            float(headers.get(SENT_AT_HEADER, received_at)),
+            received_at,
+        )
+
+    def record(self):
+        """
+        Records the duration of the stages reached in the stage histograms.
+        """
+        previous = self.sent_at
+        for stage, at in (
+                ('transit', self.received_at),
+                ('decode', self.decoded_at),
+                ('executor_wait', self.processing_started_at),
+                ('process', self.processed_at),
+                ('store', self.stored_at),
+        ):
+            if at:
+                _STAGE_TIMES[stage].observe(at - previous)
+                previous = at
+        if self.stored_at:
+            _STAGE_TIMES['total'].observe(self.stored_at - self.sent_at)
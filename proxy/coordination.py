@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Optional, Set, Dict
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITIONS = 16
+DEFAULT_KEY_PREFIX = 'proxy'
+
+# renews the lease of a partition only if still held by the instance
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# releases the lease of a partition only if still held by the instance
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class WindowCoordinator:
+    """
+    Splits the windows among several proxy instances through Redis.
+    Windows are assigned to partitions round robin (window n belongs to partition n % partitions), and each
+    partition is owned by the instance holding its lease, a key with a TTL renewed every third of it.
+    Live instances heartbeat in a sorted set and each one claims up to its fair share of the partitions,
+    releasing the extra ones when instances join, so the partitions of an instance that dies are taken over
+    within the lease TTL plus one renewal. Before publishing a window, its owner also claims it with a
+    set-if-absent key, so a window is never published twice, even while a lease changes hands.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            instance_id: str,
+            lease_ttl: int,
+            partitions: Optional[int] = None,
+            key_prefix: Optional[str] = None,
+            claim_ttl: Optional[int] = None,
+    ):
+        """
+        :param lease_ttl: lease TTL in ms, shorter than the window interval to fail over within it.
+        :param claim_ttl: TTL in ms of the claims of published windows, 60 s or 10 leases by default.
+        """
+        self._redis = redis
+        self._instance_id = instance_id
+        self._lease_ttl = lease_ttl
+        self._partitions = partitions or DEFAULT_PARTITIONS
+        self._key_prefix = key_prefix or DEFAULT_KEY_PREFIX
+        self._claim_ttl = claim_ttl or max(60 * 1000, 10 * lease_ttl)
+        self._renew = redis.register_script(_RENEW_SCRIPT)
+        self._release = redis.register_script(_RELEASE_SCRIPT)
+        # owned partitions and the monotonic time until which their lease is known to be held
+        self._owned: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def instance_id(self) -> str:
+        return self._instance_id
+
+    @property
+    def lease_ttl(self) -> int:
+        return self._lease_ttl
+
+    @property
+    def owned_partitions(self) -> Set[int]:
+        now = time.monotonic()
+        return {partition for partition, until in self._owned.items() if until > now}
+
+    def partition(self, window: int) -> int:
+        return window % self._partitions
+
+    def owns(self, window: int) -> bool:
+        return self._owned.get(self.partition(window), 0) > time.monotonic()
+
+    def is_leader(self) -> bool:
+        """
+        :return: whether the instance holds the lease of partition 0, and so runs the work of a single instance.
+        """
+        return self._owned.get(0, 0) > time.monotonic()
+
+    async def claim(self, window: int) -> bool:
+        """
+        Claims the publication of a window, only once across all instances.
+        :return: whether the window was claimed by this instance.
+        """
+        return bool(await self._redis.set(f"{self._key_prefix}:published:{window}", self._instance_id,
+                                          nx=True, px=self._claim_ttl))
+
+    def start(self):
+        logger.info(f"Starting window coordination as instance {self._instance_id}")
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_done)
+
+    async def stop(self):
+        """
+        Releases the leases, so other instances take the partitions over without waiting for them to expire.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        owned, self._owned = list(self._owned), {}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for partition in owned:
+                await self._release(keys=[self._lease_key(partition)], args=[self._instance_id], client=pipe)
+            pipe.zrem(self._instances_key, self._instance_id)
+            await pipe.execute()
+        logger.info(f"Released partitions {sorted(owned)}")
+
+    def _on_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Window coordination failed: {task.exception()!r}")
+            self._owned = {}
+
+    @property
+    def _instances_key(self) -> str:
+        return f"{self._key_prefix}:instances"
+
+    def _lease_key(self, partition: int) -> str:
+        return f"{self._key_prefix}:lease:{partition}"
+
+    async def _run(self):
+        while True:
+            try:
+                await self._rebalance()
+            except Exception as e:
+                # the leases expire on their own if they can no longer be renewed
+                logger.error(f"Error coordinating windows: {e!r}")
+            await asyncio.sleep(self._lease_ttl / 3000)
+
+    async def _rebalance(self):
+        started = time.monotonic()
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(self._instances_key, {self._instance_id: now})
+            pipe.zremrangebyscore(self._instances_key, '-inf', now - self._lease_ttl / 1000)
+            pipe.zrange(self._instances_key, 0, -1)
+            for partition in self._owned:
+                await self._renew(keys=[self._lease_key(partition)], args=[self._instance_id, self._lease_ttl],
+                                  client=pipe)
+            res = await pipe.execute()
+        instances = sorted(x.decode() for x in res[2])
+        # a lease is only trusted until it may have expired since the renewal was sent
+        until = started + self._lease_ttl / 1000
+        owned = {partition: until for partition, renewed in zip(self._owned, res[3:]) if renewed}
+        if lost := set(self._owned) - set(owned):
+            logger.warning(f"Lost partitions {sorted(lost)}")
+
+        share = math.ceil(self._partitions / max(len(instances), 1))
+        if len(owned) > share:
+            # leave the extra partitions to the instances that joined
+            extra = sorted(owned)[share:]
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for partition in extra:
+                    await self._release(keys=[self._lease_key(partition)], args=[self._instance_id], client=pipe)
+                    del owned[partition]
+                await pipe.execute()
+            logger.info(f"Released partitions {extra}")
+        elif len(owned) < share:
+            # try the free partitions starting at a different one on every instance, to avoid contention
+            offset = instances.index(self._instance_id) * share if self._instance_id in instances else 0
+            candidates = [(offset + i) % self._partitions for i in range(self._partitions)]
+            candidates = [partition for partition in candidates if partition not in owned]
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for partition in candidates:
+                    pipe.set(self._lease_key(partition), self._instance_id, nx=True, px=self._lease_ttl)
+                res = await pipe.execute()
+            acquired = [partition for partition, ok in zip(candidates, res) if ok]
+            # keep only up to the fair share, releasing the rest right away
+            needed = share - len(owned)
+            keep, extra = acquired[:needed], acquired[needed:]
+            for partition in keep:
+                owned[partition] = until
+            if extra:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    for partition in extra:
+                        await self._release(keys=[self._lease_key(partition)], args=[self._instance_id],
+                                            client=pipe)
+                    await pipe.execute()
+            if keep:
+                logger.info(f"Acquired partitions {sorted(keep)}")
+        self._owned = owned
@@ -1,13 +1,19 @@
 import logging
 import os
-from typing import Optional
+import uuid
+from typing import Optional, List, Tuple
 
 import click
-import redis as redis
-from pika import BlockingConnection, URLParameters
+import redis.asyncio as redis
 
+from common import metrics
+from common.aggregates import STATISTICS
 from common.log import setup_logger, LOGGER_LEVEL_CHOICES
-from proxy.tumbling_window import TumblingWindow
+from common.meteo_data import WireFormat
+from common.store_strategy import RetentionPolicy, DEFAULT_ROLLUPS, sharded_store_strategy
+from proxy.coordination import WindowCoordinator
+from proxy.query import QueryService
+from proxy.tumbling_window import TumblingWindow, CatchUpPolicy, DEFAULT_WINDOW_INTERVAL, DEFAULT_HISTORY_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -15,42 +21,142 @@ logger = logging.getLogger(__name__)
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
 @click.argument('rabbitmq-address', type=str, required=False, default=os.environ.get('RABBITMQ_ADDRESS'))
 @click.argument('redis-address', type=str, required=False,
-                default=os.environ.get("REDIS_ADDRESS"))
+                default=os.environ.get("REDIS_ADDRESS"))  # comma-separated to shard across several nodes
 @click.option('--debug', is_flag=True, help="Enable debug logging")
 @click.option('--log-level', type=click.Choice(LOGGER_LEVEL_CHOICES),
               default=os.environ.get('LOG_LEVEL', 'info'), help="Set the log level")
 @click.option('--interval', type=int, default=os.environ.get("INTERVAL"),
-              help="Set the default tumbling window interval in ms")
+              help="Set the window interval (the hop of hopping windows) in ms")
+@click.option('--window-size', type=int, default=os.environ.get("WINDOW_SIZE"),
+              help="Set the window size in ms, a multiple of the interval, for hopping windows")
+@click.option('--statistics', type=str, default=os.environ.get("WINDOW_STATISTICS", ','.join(STATISTICS)),
+              help=f"Set the comma-separated window statistics to publish, out of {','.join(STATISTICS)}")
+@click.option('--wire-format', type=click.Choice([e.value for e in WireFormat]),
+              default=os.environ.get("WIRE_FORMAT", WireFormat.Json.value), help="Set the results wire format")
+@click.option('--use-aggregates', is_flag=True,
+              default=os.environ.get("USE_AGGREGATES", "").lower() in ("1", "true", "yes"),
+              help="Read the per-window aggregates kept by the servers instead of scanning the raw data")
+@click.option('--raw-retention', type=int, default=os.environ.get("RAW_RETENTION"),
+              help="Keep the raw data for this many ms once rolled up, enables the retention and rollups")
+@click.option('--rollups', type=str, default=os.environ.get("ROLLUPS"),
+              help="Rollup resolutions and retentions in ms as res:retention,... (retention 0 keeps forever)")
+@click.option('--lateness', type=int, default=os.environ.get("WINDOW_LATENESS"),
+              help="Set the time in ms to wait after the end of a window for its late points")
+@click.option('--catch-up-policy', type=click.Choice([e.value for e in CatchUpPolicy]),
+              default=os.environ.get("CATCH_UP_POLICY", CatchUpPolicy.CatchUp.value),
+              help="Process the windows missed by an overrunning tick together, or skip them")
+@click.option('--coordinate', is_flag=True,
+              default=os.environ.get("PROXY_COORDINATION", "").lower() in ("1", "true", "yes"),
+              help="Split the windows with the other proxy instances through Redis")
+@click.option('--instance-id', type=str, default=os.environ.get("INSTANCE_ID", uuid.uuid4().hex),
+              help="Set the proxy instance id used for coordination")
+@click.option('--partitions', type=int, default=os.environ.get("PROXY_PARTITIONS"),
+              help="Set the number of window partitions split among the proxy instances")
+@click.option('--lease-ttl', type=int, default=os.environ.get("LEASE_TTL"),
+              help="Set the partition lease TTL in ms (half the interval by default)")
+@click.option('--query-port', type=int, default=os.environ.get("QUERY_PORT"),
+              help="Serve range queries over HTTP on this port (disabled by default)")
+@click.option('--query-cache-size', type=int, default=os.environ.get("QUERY_CACHE_SIZE"),
+              help="Set the number of query responses cached")
+@click.option('--history-size', type=int, default=os.environ.get("RESULTS_HISTORY_SIZE", DEFAULT_HISTORY_SIZE),
+              help="Keep about this many latest results in a Redis stream for new terminals (0 to disable)")
+@click.option('--metrics-port', type=int, default=os.environ.get("METRICS_PORT"),
+              help="Serve Prometheus metrics on this port (disabled by default)")
 def main(
         rabbitmq_address: str,
         redis_address: str,
         log_level: str,
         debug: bool = False,
         interval: Optional[int] = None,
+        window_size: Optional[int] = None,
+        statistics: str = ','.join(STATISTICS),
+        wire_format: str = WireFormat.Json.value,
+        use_aggregates: bool = False,
+        raw_retention: Optional[int] = None,
+        rollups: Optional[str] = None,
+        lateness: Optional[int] = None,
+        catch_up_policy: str = CatchUpPolicy.CatchUp.value,
+        coordinate: bool = False,
+        instance_id: Optional[str] = None,
+        partitions: Optional[int] = None,
+        lease_ttl: Optional[int] = None,
+        history_size: int = DEFAULT_HISTORY_SIZE,
+        query_port: Optional[int] = None,
+        query_cache_size: Optional[int] = None,
+        metrics_port: Optional[int] = None,
 ):
     setup_logger(log_level=logging.DEBUG if debug else log_level.upper())
 
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+
     if not rabbitmq_address:
         raise ValueError("RabbitMQ address must be provided")
 
     if not redis_address:
         raise ValueError("Redis address must be provided")
 
+    retention = None
+    if raw_retention:
+        retention = RetentionPolicy(raw_retention, _parse_rollups(rollups) if rollups else list(DEFAULT_ROLLUPS))
+        logger.info(f"Using retention policy {retention}")
+
     logger.info("Starting proxy server")
 
+    # the same nodes as the servers
+    redis_addresses = redis_address.split(',')
+    redis_clients = [redis.from_url(address, db=0) for address in redis_addresses]
+    store_strategy = sharded_store_strategy(
+        redis_clients,
+        redis_addresses,
+        retention=retention,
+        aggregate_interval=(interval or DEFAULT_WINDOW_INTERVAL) if use_aggregates else None,
+    )
+
+    coordinator = None
+    if coordinate:
+        # the leases are kept in the first node
+        coordinator = WindowCoordinator(redis_clients[0], instance_id,
+                                        lease_ttl or (interval or DEFAULT_WINDOW_INTERVAL) // 2, partitions)
+
+    query_service = None
+    if query_port:
+        query_service = QueryService(store_strategy, interval or DEFAULT_WINDOW_INTERVAL, query_port,
+                                     cache_size=query_cache_size)
+
     # Create the tumbling window
     tumbling_window = TumblingWindow(
-        redis.from_url(redis_address, db=0),
-        BlockingConnection(URLParameters(rabbitmq_address)),
-        interval
+        None,
+        rabbitmq_address,
+        interval,
+        store_strategy=store_strategy,
+        wire_format=WireFormat(wire_format),
+        use_aggregates=use_aggregates,
+        lateness=lateness,
+        catch_up_policy=CatchUpPolicy(catch_up_policy),
+        size=window_size,
+        statistics=[x for x in statistics.split(',') if x],
+        coordinator=coordinator,
+        # the history is kept in the first node
+        history=redis_clients[0] if history_size else None,
+        history_size=history_size,
+        query_service=query_service,
     )
 
     try:
         tumbling_window.run()
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt, shutting down")
+        tumbling_window.stop()
         exit(0)
 
 
+def _parse_rollups(rollups: str) -> List[Tuple[int, int]]:
+    try:
+        return [(int(res), int(retention)) for res, retention in (x.split(':') for x in rollups.split(','))]
+    except ValueError:
+        raise ValueError(f"Invalid rollups {rollups}, expected res:retention,...")
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from asyncio import StreamReader, StreamWriter
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, List
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from common.sharding import series_metric
+from common.store_strategy import StoreStrategy, ShardedStoreStrategy, Rollup, downsample
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_PORT = 8080
+DEFAULT_CACHE_SIZE = 256
+# range in s of the queries without a start
+DEFAULT_QUERY_RANGE = 60 * 60
+REQUEST_TIMEOUT = 10
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class SeriesCache:
+    """
+    LRU cache of query responses.
+    Responses are only final for ranges ending before the last closed window: the ones of ranges that
+    were still open when computed are dropped whenever a window closes, the others are kept until evicted.
+    """
+
+    def __init__(self, size: Optional[int] = None):
+        self._size = size or DEFAULT_CACHE_SIZE
+        # response and whether its range was closed, by query
+        self._entries: OrderedDict[Tuple, Tuple[bytes, bool]] = OrderedDict()
+        self.watermark = -math.inf
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, query: Tuple) -> Optional[bytes]:
+        entry = self._entries.get(query)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(query)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, query: Tuple, response: bytes, closed: bool):
+        """
+        :param closed: whether the range of the query was closed when its response started being computed.
+        """
+        self._entries[query] = (response, closed)
+        self._entries.move_to_end(query)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def window_closed(self, end: float):
+        """
+        :param end: end in s of the window closed, no more points are expected before it.
+        """
+        if end <= self.watermark:
+            return
+        self.watermark = end
+        for query in [query for query, (_, closed) in self._entries.items() if not closed]:
+            del self._entries[query]
+
+
+class QueryService:
+    """
+    HTTP service answering range queries over the stored series, GET /series/<key>?start=&end=&step=,
+    with start and end in s (the last hour by default) and an optional step in s to downsample to.
+    The key is either a series or a metric, whose per-sensor series are merged. The response lists the
+    [timestamp, min, mean, max, count] of each point or bucket, read from the coarsest rollups not coarser
+    than the step. Ranges are aligned to the step, or to the window interval, so that repeated queries, like
+    dashboards reloading the last hour, share their cached responses until the next window closes.
+    """
+
+    def __init__(
+            self,
+            store: StoreStrategy,
+            interval: int,
+            port: Optional[int] = None,
+            host: Optional[str] = None,
+            cache_size: Optional[int] = None,
+    ):
+        """
+        :param interval: window interval in ms.
+        """
+        self._store = store
+        self._interval = interval
+        self._port = port or DEFAULT_QUERY_PORT
+        self._host = host or '0.0.0.0'
+        self.cache = SeriesCache(cache_size)
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        logger.info(f"Serving queries on {self._host}:{self._port}")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+
+    def window_closed(self, end: float):
+        self.cache.window_closed(end)
+
+    async def query(self, key: str, start: Optional[float], end: Optional[float], step: Optional[float]) -> bytes:
+        """
+        :return: the JSON response to the query, from the cache when possible.
+        """
+        if step is not None and step < 0.001:
+            raise ValueError("Step must be at least 1 ms")
+        align = step or self._interval / 1000
+        end = math.ceil((end if end is not None else time.time()) / align) * align
+        start = math.floor((start if start is not None else end - DEFAULT_QUERY_RANGE) / align) * align
+        if start >= end:
+            raise ValueError("Start must be before end")
+        query = (key, start, end, step)
+        response = self.cache.get(query)
+        if response is None:
+            # a window closing while the series are read does not make the points read before final
+            closed = end <= self.cache.watermark
+            points = await self._get_series(key, start, end, step)
+            response = json.dumps({'key': key, 'start': start, 'end': end, 'step': step, 'points': points}).encode()
+            self.cache.put(query, response, closed)
+        return response
+
+    async def _get_series(self, key: str, start: float, end: float, step: Optional[float]) -> List[Rollup]:
+        if isinstance(self._store, ShardedStoreStrategy) and key == series_metric(key):
+            keys = (await self._store.series([key], start))[key]
+        else:
+            keys = [key]
+        res = await asyncio.gather(*(self._store.get_series(k, start, end, step) for k in keys))
+        # the end is exclusive, as for the windows
+        points = [r for series in res for r in series if start <= r.timestamp < end]
+        if step:
+            return downsample(points, step)
+        return sorted(points)
+
+    async def _handle(self, reader: StreamReader, writer: StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            # the headers are not needed
+            while await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT) not in (b'\r\n', b'\n', b''):
+                pass
+            status, body = await self._route(request_line.decode('latin-1'))
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def _route(self, request_line: str) -> Tuple[int, bytes]:
+        try:
+            method, target, _ = request_line.split(' ', 2)
+        except ValueError:
+            return 400, _error("Malformed request")
+        if method != 'GET':
+            return 405, _error(f"Method {method} not allowed")
+        url = urlsplit(target)
+        if not url.path.startswith('/series/') or not url.path[len('/series/'):]:
+            return 404, _error(f"Unknown path {url.path}")
+        key = unquote(url.path[len('/series/'):])
+        try:
+            params = _parse_params(parse_qs(url.query))
+            return 200, await self.query(key, **params)
+        except ValueError as e:
+            return 400, _error(str(e))
+        except Exception as e:
+            logger.error(f"Error querying series {key}: {e!r}")
+            return 500, _error("Error querying the series")
+
+
+def _parse_params(params: Dict[str, List[str]]) -> Dict[str, Optional[float]]:
+    try:
+        return {name: float(params[name][-1]) if name in params else None for name in ('start', 'end', 'step')}
+    except ValueError:
+        raise ValueError("start, end and step must be numbers")
+
+
+def _error(message: str) -> bytes:
+    return json.dumps({'error': message}).encode()
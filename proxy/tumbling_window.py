@@ -1,73 +1,505 @@
-import json
+import asyncio
+import bisect
+import itertools
 import logging
+import math
 import time
-from typing import Tuple, Optional
+from asyncio import AbstractEventLoop, Task
+from collections import Counter
+from dataclasses import dataclass, replace
+from enum import Enum
+from typing import Optional, List, Dict, Tuple
 
-from pika import BlockingConnection
-from redis import Redis
+from pika import URLParameters, BasicProperties
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.channel import Channel
+from redis.asyncio import Redis
 
-from common.constants import RESULT_EXCHANGE_NAME
-from common.meteo_data import Results, MeteoEncoder
-from common.store_strategy import StoreStrategy, SortedSetStoreStrategy
+from common import metrics
+from common.aggregates import Aggregate, TimestampHistogram, STATISTICS
+from common.constants import RESULT_EXCHANGE_NAME, RESULTS_STREAM_NAME
+from common.meteo_data import Results, WireFormat, encode_message
+from common.store_strategy import (
+    StoreStrategy, AggregatingStoreStrategy, ShardedStoreStrategy, RetentionPolicy, SERIES_INDEX_REFRESH,
+    sharded_store_strategy
+)
+from common.tracing import WINDOW_DELAY
+from proxy.coordination import WindowCoordinator
+from proxy.query import QueryService
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_WINDOW_INTERVAL = 2000
+# time in ms to wait after the end of a window for its late points
+DEFAULT_WINDOW_LATENESS = 1000
+DEFAULT_HISTORY_SIZE = 1000
 STARTUP_DELAY = 5
+WINDOW_KEYS = ['wellness', 'pollution']
+
+FETCH_TIME = metrics.histogram('proxy_fetch_seconds', "Time spent reading the panes of the windows from Redis")
+WINDOW_POINTS = metrics.histogram('proxy_window_points', "Points aggregated in each published window",
+                                  buckets=(1, 10, 100, 1000, 10000, 100000, 1000000))
+WINDOWS_PUBLISHED = metrics.counter('proxy_windows_published_total', "Windows published")
+TICK_DELAY = metrics.histogram('proxy_tick_delay_seconds', "Delay of the window ticks past their deadline")
+TICK_OVERRUNS = metrics.counter('proxy_tick_overruns_total', "Ticks that woke up after the following deadline")
+
+
+class CatchUpPolicy(Enum):
+    CatchUp = 'catch-up'
+    Skip = 'skip'
+
+
+@dataclass
+class TickStats:
+    """
+    Scheduling statistics of the window ticks, delays and durations in s past each window's deadline.
+    A tick overruns when it wakes up after the deadline of the following window.
+    """
+    ticks: int = 0
+    overruns: int = 0
+    caught_up_windows: int = 0
+    skipped_windows: int = 0
+    last_delay: float = 0.0
+    max_delay: float = 0.0
+    last_duration: float = 0.0
+    max_duration: float = 0.0
 
 
 class TumblingWindow:
+    """
+    Publishes the mean, last timestamp and the selected statistics (see STATISTICS) of the stored data over
+    windows of the given size every interval, each window combined from the interval-long panes it spans.
+    """
+
     def __init__(
             self,
             redis: Redis,
-            rabbitmq: BlockingConnection,
+            rabbitmq_address: str,
             interval: Optional[int] = None,
             store_strategy: Optional[StoreStrategy] = None,
             exchange_name: Optional[str] = None,
+            wire_format: Optional[WireFormat] = None,
+            use_aggregates: bool = False,
+            retention: Optional[RetentionPolicy] = None,
+            lateness: Optional[int] = None,
+            catch_up_policy: Optional[CatchUpPolicy] = None,
+            size: Optional[int] = None,
+            statistics: Optional[List[str]] = None,
+            coordinator: Optional[WindowCoordinator] = None,
+            history: Optional[Redis] = None,
+            history_size: Optional[int] = None,
+            query_service: Optional[QueryService] = None,
     ):
         logger.info("Initializing TumblingWindow")
         self._interval = interval or DEFAULT_WINDOW_INTERVAL
-        self._store = store_strategy or SortedSetStoreStrategy(redis)
-        self._rabbitmq = rabbitmq
+        self._size = size or self._interval
+        if self._size % self._interval:
+            raise ValueError(f"Window size {self._size} must be a multiple of the interval {self._interval}")
+        self._panes_per_window = self._size // self._interval
+        # aggregate of each key of the panes read, kept until no following window includes them
+        self._panes: Dict[int, Dict[str, Aggregate]] = {}
+        # histogram of the timestamps of the readings of each pane read, only kept while metrics are exposed
+        self._pane_timestamps: Dict[int, TimestampHistogram] = {}
+        # first pane of the windows of each pending task, no pane from the lowest of them on is dropped
+        self._pending_panes: Counter = Counter()
+        self._store = store_strategy or sharded_store_strategy(
+            [redis], retention=retention, aggregate_interval=self._interval if use_aggregates else None)
+        self._use_aggregates = use_aggregates
+        if use_aggregates and (not isinstance(self._store, (AggregatingStoreStrategy, ShardedStoreStrategy))
+                               or self._store.interval != self._interval):
+            raise ValueError("Window aggregates require a store keeping aggregates of the window interval")
+        # the fields of the results are those of the window keys
+        self._keys = WINDOW_KEYS
+        self._statistics = list(STATISTICS) if statistics is None else statistics
+        if unknown := set(self._statistics) - set(STATISTICS):
+            raise ValueError(f"Unknown statistics {unknown}")
+        self._lateness = lateness if lateness is not None else DEFAULT_WINDOW_LATENESS
+        self._catch_up_policy = catch_up_policy or CatchUpPolicy.CatchUp
+        self.stats = TickStats()
+        self._coordinator = coordinator
+        # windows that were due while not owned, in case their partition is taken over
+        self._unowned: List[int] = []
+        self._rabbitmq_address = rabbitmq_address
         self._exchange_name = exchange_name or RESULT_EXCHANGE_NAME
-        self._channel = rabbitmq.channel()
-        self._channel.exchange_declare(exchange=self._exchange_name, exchange_type='fanout')
+        self._wire_format = wire_format or WireFormat.Json
+        self._properties = BasicProperties(content_type=self._wire_format.content_type)
+        self._history = history
+        self._history_size = history_size or DEFAULT_HISTORY_SIZE
+        self._query_service = query_service
+        self._connection: Optional[AsyncioConnection] = None
+        self._ioloop: Optional[AbstractEventLoop] = None
+        self._channel: Optional[Channel] = None
+        self._ticker: Optional[Task] = None
+        # last window task, each window publishes after the previous one
+        self._last_window: Optional[Task] = None
+        self._maintenance: Optional[Task] = None
+        # whether every indexed series has been maintained once, and the end of the last windows maintained
+        self._swept = False
+        self._maintained_at = -math.inf
+        self._background_tasks = set()
+        self._closing = False
 
     def run(self):
         logger.info("Starting TumblingWindow")
-        last_time = time.time()
-        time.sleep(STARTUP_DELAY)
+        logger.info(f"Connecting to RabbitMQ at {self._rabbitmq_address}")
+        self._connection = AsyncioConnection(
+            parameters=URLParameters(self._rabbitmq_address),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_close
+        )
+        self._ioloop = self._connection.ioloop
+        self._ioloop.run_forever()
+        logger.info("TumblingWindow stopped")
+
+    def stop(self):
+        if not self._closing:
+            logger.info("Stopping TumblingWindow")
+            self._closing = True
+            if self._ticker is not None:
+                self._ticker.cancel()
+            if self._query_service is not None:
+                self._query_service.stop()
+            if self._coordinator is not None:
+                self._release_partitions()
+            if self._connection.is_open:
+                self._connection.close()
+                self._ioloop.run_forever()
+            else:
+                self._ioloop.stop()
+
+    def _release_partitions(self):
+        # hand the partitions over right away instead of waiting for their leases to expire
+        try:
+            if self._ioloop.is_running():
+                self._create_task(self._coordinator.stop())
+            else:
+                self._ioloop.run_until_complete(self._coordinator.stop())
+        except Exception as e:
+            logger.error(f"Error releasing the window partitions: {e!r}")
+
+    def _on_connection_open(self, connection: AsyncioConnection):
+        logger.info("Connected to RabbitMQ")
+        logger.info("Opening channel")
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection: AsyncioConnection, error: Exception):
+        logger.error(f"Failed to connect to RabbitMQ: {error}")
+        self._ioloop.stop()
+
+    def _on_connection_close(self, connection: AsyncioConnection, reason: Exception):
+        logger.info(f"Connection closed: {reason}")
+        self._channel = None
+        if self._ticker is not None:
+            self._ticker.cancel()
+        self._ioloop.stop()
+
+    def _on_channel_open(self, channel: Channel):
+        logger.info("Channel opened")
+        self._channel = channel
+        self._channel.add_on_close_callback(self._on_channel_close)
+        logger.info(f"Declaring exchange {self._exchange_name}")
+        self._channel.exchange_declare(exchange=self._exchange_name, exchange_type='fanout',
+                                       callback=self._on_exchange_declared)
+
+    def _on_channel_close(self, channel: Channel, reason: Exception):
+        logger.info(f"Channel closed: {reason}")
+        self._channel = None
+        if not self._closing and self._connection.is_open:
+            self._connection.close()
+
+    def _on_exchange_declared(self, frame):
+        logger.info(f"Exchange {self._exchange_name} declared")
+        if self._coordinator is not None:
+            self._coordinator.start()
+        if self._query_service is not None:
+            self._create_task(self._query_service.start())
+        self._ticker = asyncio.create_task(self._tick())
+        self._ticker.add_done_callback(self._on_ticker_done)
+
+    def _on_ticker_done(self, task: Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"TumblingWindow ticker failed: {task.exception()!r}")
+            self.stop()
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        interval = self._interval / 1000
+        lateness = self._lateness / 1000
+        await asyncio.sleep(STARTUP_DELAY)
+        # deadlines are kept in the loop's monotonic clock, so neither the time spent processing nor
+        # wall clock adjustments accumulate as drift; the offset only aligns windows to the epoch
+        offset = time.time() - loop.time()
+        # window n covers [n * interval, (n + 1) * interval) and is closed lateness after its end
+        window = math.floor((loop.time() + offset) / interval)
         while True:
-            time.sleep(self._interval / 1000)
-            end = last_time + self._interval / 1000
-            assert end <= time.time()
-            logger.debug(f"Running tumbling window from {last_time} to {end}")
-            wellness_data, wellness_timestamp = self._get_data('wellness', last_time, end)
-            pollution_data, pollution_timestamp = self._get_data('pollution', last_time, end)
-            results = Results(
-                wellness_data=wellness_data,
-                wellness_timestamp=wellness_timestamp,
-                pollution_data=pollution_data,
-                pollution_timestamp=pollution_timestamp,
-            )
-            last_time = end
-            self._send_results(results)
-
-    def _send_results(self, results: Results):
-        logger.debug(f"Sending results to exchange {self._exchange_name}")
+            deadline = (window + 1) * interval + lateness - offset
+            await asyncio.sleep(deadline - loop.time())
+            now = loop.time()
+            due = list(range(window, math.floor((now + offset - lateness) / interval)))
+            if not due:
+                # woke up a rounding error before the deadline
+                continue
+            window = due[-1] + 1
+            if self._query_service is not None:
+                # closed whether published by this instance or not
+                self._query_service.window_closed(window * interval)
+            self.stats.ticks += 1
+            self.stats.last_delay = now - deadline
+            self.stats.max_delay = max(self.stats.max_delay, self.stats.last_delay)
+            TICK_DELAY.observe(self.stats.last_delay)
+            if len(due) > 1:
+                self.stats.overruns += 1
+                TICK_OVERRUNS.inc()
+                if self._catch_up_policy == CatchUpPolicy.Skip:
+                    logger.warning(f"Tick overran by {now - deadline:.3f} s, skipping {len(due) - 1} windows")
+                    self.stats.skipped_windows += len(due) - 1
+                    due = due[-1:]
+                else:
+                    logger.warning(f"Tick overran by {now - deadline:.3f} s, catching up {len(due) - 1} windows")
+                    self.stats.caught_up_windows += len(due) - 1
+            if self._coordinator is not None:
+                retried, due = self._owned_windows(due)
+                if retried:
+                    logger.debug("Retrying windows %s", retried)
+                    # published before the due windows, but long past their deadline, so left out of the stats
+                    self._schedule_windows(retried, None)
+                if not due:
+                    continue
+            if logger.isEnabledFor(logging.DEBUG):
+                # a copy, as the records are formatted later, when the stats may have changed
+                logger.debug("Running windows %s, %s", due, replace(self.stats))
+            self._schedule_windows(due, (due[-1] + 1) * interval + lateness - offset)
+
+    def _owned_windows(self, due: List[int]) -> Tuple[List[int], List[int]]:
+        # windows of a partition taken over from a failed instance may have been left unpublished,
+        # so the recent ones are retried, the claims of published windows prevent duplicates
+        lookback = due[-1] - math.ceil(2 * self._coordinator.lease_ttl / self._interval) - 1
+        retried = [window for window in self._unowned if window > lookback]
+        self._unowned = [window for window in retried + due if not self._coordinator.owns(window)]
+        return ([window for window in retried if self._coordinator.owns(window)],
+                [window for window in due if self._coordinator.owns(window)])
+
+    def _schedule_windows(self, windows: List[int], deadline: Optional[float]):
+        # the panes are held from now on, not from when the task starts, which may be after the cleanup of
+        # a previous one
+        first = windows[0] - self._panes_per_window + 1
+        self._pending_panes[first] += 1
+        self._last_window = self._create_task(self._process_windows(windows, first, deadline, self._last_window))
+
+    def _create_task(self, coro) -> Task:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    @staticmethod
+    def _on_task_done(task: Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"TumblingWindow task failed: {task.exception()!r}")
+
+    async def _process_windows(self, windows: List[int], first: int, deadline: Optional[float],
+                               previous: Optional[Task]):
+        try:
+            if not await self._publish_windows(windows, previous):
+                return
+        finally:
+            self._pending_panes[first] -= 1
+            if not self._pending_panes[first]:
+                del self._pending_panes[first]
+        # only keep the panes of the following windows and of those still pending
+        kept = min([windows[-1] - self._panes_per_window + 2, *self._pending_panes])
+        for pane in [pane for pane in self._panes if pane < kept]:
+            del self._panes[pane]
+            self._pane_timestamps.pop(pane, None)
+        if deadline is not None:
+            self.stats.last_duration = asyncio.get_running_loop().time() - deadline
+            self.stats.max_duration = max(self.stats.max_duration, self.stats.last_duration)
+        # with a coordinator, the series are only maintained by the leader, not by every instance
+        leader = self._coordinator is None or self._coordinator.is_leader()
+        now = (windows[-1] + 1) * self._interval / 1000
+        if leader and self._maintenance_due(now) and (self._maintenance is None or self._maintenance.done()):
+            self._maintained_at = now
+            self._maintenance = self._create_task(self._maintain(self._keys, now))
+
+    async def _publish_windows(self, windows: List[int], previous: Optional[Task]) -> bool:
+        # window n is made of panes n - panes per window + 1 to n, read only if not already cached
+        needed = sorted({pane for window in windows for pane in range(window - self._panes_per_window + 1, window + 1)})
+        missing = [pane for pane in needed if pane not in self._panes]
+        try:
+            if missing:
+                started = time.perf_counter()
+                self._panes.update(zip(missing, await self._get_panes(self._keys, missing)))
+                FETCH_TIME.observe(time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"Error getting the panes {missing}: {e!r}")
+            return False
+        if previous is not None:
+            # publish in window order
+            await asyncio.wait([previous])
+        for window in windows:
+            # a window failing to publish does not hold back the following ones
+            try:
+                if self._coordinator is not None and not await self._coordinator.claim(window):
+                    logger.debug("Window %s already published by another instance", window)
+                    continue
+                await self._send_results(self._window_results(window))
+                WINDOWS_PUBLISHED.inc()
+                if self._pane_timestamps:
+                    self._observe_delays(window)
+            except Exception as e:
+                logger.error(f"Error publishing the window {window}: {e!r}")
+        return True
+
+    def _maintenance_due(self, now: float) -> bool:
+        retention = self._store.retention
+        if retention is None:
+            return False
+        # no bucket closes more often than the finest resolution, however short the windows
+        period = retention.rollups[0][0] / 1000 if retention.rollups else 0
+        return now - self._maintained_at >= period
+
+    async def _get_panes(self, keys: List[str], panes: List[int]) -> List[Dict[str, Aggregate]]:
+        if self._use_aggregates:
+            return await self._get_aggregates(keys, panes)
+        # read each run of consecutive panes at once
+        runs = [[panes[0]]]
+        for pane in panes[1:]:
+            if pane == runs[-1][-1] + 1:
+                runs[-1].append(pane)
+            else:
+                runs.append([pane])
+        res = await asyncio.gather(*(self._get_data(keys, run) for run in runs))
+        return [pane_data for run_data in res for pane_data in run_data]
+
+    def _window_results(self, window: int) -> Results:
+        aggregates = {key: Aggregate() for key in self._keys}
+        for pane in range(window - self._panes_per_window + 1, window + 1):
+            for key, aggregate in self._panes[pane].items():
+                aggregates[key].merge(aggregate)
+        wellness, pollution = aggregates['wellness'], aggregates['pollution']
+        WINDOW_POINTS.observe(sum(aggregate.count for aggregate in aggregates.values()))
+        return Results(
+            wellness_data=wellness.mean,
+            wellness_timestamp=wellness.last_timestamp,
+            pollution_data=pollution.mean,
+            pollution_timestamp=pollution.last_timestamp,
+            window_size=self._size,
+            hop=self._interval,
+            **{f"{key}_{name}": aggregates[key].statistic(name) for key in self._keys for name in self._statistics},
+        )
+
+    def _observe_delays(self, window: int):
+        published_at = time.time()
+        delays = sorted(
+            delay
+            for pane in range(window - self._panes_per_window + 1, window + 1) if pane in self._pane_timestamps
+            for delay in self._pane_timestamps[pane].delays(published_at)
+        )
+        if not delays:
+            return
+        for delay, count in delays:
+            WINDOW_DELAY.observe(delay, count)
+        if logger.isEnabledFor(logging.DEBUG):
+            ranks = list(itertools.accumulate(count for _, count in delays))
+            p50, p95 = (delays[bisect.bisect_left(ranks, q * ranks[-1])][0] for q in (0.5, 0.95))
+            logger.debug("Window %s published %.3f s (p50), %.3f s (p95), %.3f s (max) after its readings",
+                         window, p50, p95, delays[-1][0])
+
+    async def _send_results(self, results: Results):
+        if self._channel is None:
+            logger.warning("Channel closed, dropping results")
+            return
+        body = encode_message(results, self._wire_format)
+        properties = self._properties
+        if self._history is not None:
+            # appended before publishing, so a consumer reading the stream after binding its queue misses nothing
+            try:
+                entry_id = await self._history.xadd(RESULTS_STREAM_NAME, {
+                    'body': body,
+                    'content_type': self._wire_format.content_type,
+                }, maxlen=self._history_size, approximate=True)
+                properties = BasicProperties(content_type=self._wire_format.content_type,
+                                             message_id=entry_id.decode())
+            except Exception as e:
+                logger.error(f"Error appending results to the history: {e!r}")
+        logger.debug("Sending results to exchange %s", self._exchange_name)
         self._channel.basic_publish(
             exchange=self._exchange_name,
             routing_key='',
-            body=json.dumps(results, cls=MeteoEncoder).encode('utf-8')
+            body=body,
+            properties=properties
         )
 
-    def _get_data(self, key: str, start: float, end: float) -> Tuple[float, float]:
-        res = self._store.get(key, start, end)
-        logger.debug(f"Got data from redis for key {key}: {res}")
-        # returns a lis of tuples (key, score) where key is the value and score is the timestamp
-        if not res or len(res) == 0:
-            return 0, 0
-        last_time = max(res, key=lambda x: x[1])[1]
-        mean = sum([float(x[0]) for x in res]) / len(res)
-        logger.debug(f"Computed mean {mean} for key {key} from {start} to {end} with last time {last_time}")
-        return mean, last_time
+    async def _maintain(self, keys: List[str], now: float):
+        # roll up and trim the stored series, a failure must not stop the windows
+        retention = self._store.retention
+        try:
+            if isinstance(self._store, ShardedStoreStrategy):
+                # series idle for longer than the horizon have nothing left to roll up or trim, but all of them
+                # are swept on the first run, in case they went idle while no proxy was running
+                since = now - retention.horizon / 1000 if self._swept else -math.inf
+                last_seen = await self._store.last_seen(keys, since)
+                series = {s: seen for key in keys for s, seen in last_seen[key].items()}
+                await self._store.maintain(keys + sorted(series), now, series)
+            else:
+                await self._store.maintain(keys, now)
+            self._swept = True
+            if isinstance(self._store, ShardedStoreStrategy) and not retention.kept_forever:
+                # all the data of these series is gone
+                await self._store.forget_series(keys, now - retention.horizon / 1000 - SERIES_INDEX_REFRESH)
+        except Exception as e:
+            logger.error(f"Error maintaining the stored series: {e!r}")
+
+    async def _get_data(self, keys: List[str], panes: List[int]) -> List[Dict[str, Aggregate]]:
+        # fetch all the series of the keys and panes in a single round trip per node, then merge the
+        # points of each pane into one aggregate per key
+        interval = self._interval / 1000
+        start, end = panes[0] * interval, (panes[-1] + 1) * interval
+        series = await self._list_series(keys, start)
+        res = await self._store.get_many([s for key in keys for s in series[key]], start, end)
+        if logger.isEnabledFor(logging.DEBUG):
+            # the points themselves are far too many to log
+            logger.debug("Got panes %s data from redis: %s points of %s series",
+                         panes, sum(len(points) for points in res.values()), len(res))
+        data = [{key: Aggregate() for key in keys} for _ in panes]
+        pane_timestamps = [TimestampHistogram(pane * interval, (pane + 1) * interval) for pane in panes] \
+            if metrics.REGISTRY.enabled else None
+        for key in keys:
+            for key_series in series[key]:
+                points = res[key_series]
+                timestamps = [ts for _, ts in points]
+                bounds = [bisect.bisect_left(timestamps, pane * interval) for pane in panes[1:]]
+                for i, (lo, hi) in enumerate(zip([0] + bounds, bounds + [len(points)])):
+                    if hi > lo:
+                        data[i][key].merge(Aggregate.from_points(points[lo:hi]))
+                        if pane_timestamps is not None:
+                            for ts in timestamps[lo:hi]:
+                                pane_timestamps[i].add(ts)
+        if pane_timestamps is not None:
+            self._pane_timestamps.update(zip(panes, pane_timestamps))
+        return data
+
+    async def _list_series(self, keys: List[str], since: float) -> Dict[str, List[str]]:
+        """
+        :return: the series of each key, the per-sensor series when the store records them.
+        """
+        if isinstance(self._store, ShardedStoreStrategy):
+            return await self._store.series(keys, since)
+        return {key: [key] for key in keys}
+
+    async def _get_aggregates(self, keys: List[str], panes: List[int]) -> List[Dict[str, Aggregate]]:
+        res = await asyncio.gather(*(self._store.get_aggregates(keys, pane) for pane in panes))
+        logger.debug("Got panes %s aggregates from redis: %s", panes, res)
+        # the timestamps are kept per pane, as the aggregates of a window are merged across panes
+        for pane, aggregates in zip(panes, res):
+            timestamps = TimestampHistogram(pane * self._interval / 1000, (pane + 1) * self._interval / 1000)
+            for aggregate in aggregates.values():
+                if aggregate.timestamps is not None:
+                    timestamps.merge(aggregate.timestamps)
+                    aggregate.timestamps = None
+            if metrics.REGISTRY.enabled:
+                self._pane_timestamps[pane] = timestamps
+        return list(res)
+
@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import logging
+import random
+from asyncio import AbstractEventLoop, Task
+from typing import Optional, List
+
+from pika import URLParameters
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.channel import Channel
+
+from common.constants import PROCESSING_QUEUE_NAME, PROCESSING_EXCHANGE_TYPE
+from common.meteo_data import WireFormat
+from common.meteo_utils import MeteoDataDetector
+from sensor import Sensor, SensorType, create_sensor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL_COUNT = 4
+STATS_INTERVAL = 10
+
+
+class SensorFleet:
+    """
+    Runs a fleet of virtual sensors in a single process.
+    All the sensors share one asyncio connection and a few channels, and are driven by a single scheduler
+    that publishes each reading at an absolute deadline. Each sensor starts at a random phase within its
+    interval, so the fleet does not publish in bursts, and a late publish does not delay the following
+    ones. Readings more than one interval late are skipped instead of being sent in a burst.
+    """
+
+    def __init__(
+            self,
+            sensor_id_prefix: str,
+            rabbitmq_address: str,
+            size: int,
+            sensor_type: Optional[SensorType] = None,
+            interval: Optional[int] = None,
+            channel_count: Optional[int] = None,
+            queue_name: Optional[str] = None,
+            wire_format: Optional[WireFormat] = None,
+            exchange_name: Optional[str] = None,
+    ):
+        if size < 1:
+            raise ValueError("Fleet size must be at least 1")
+        logger.info(f"Initializing fleet of {size} sensors")
+        self._sensor_id_prefix = sensor_id_prefix
+        self._rabbitmq_address = rabbitmq_address
+        self._size = size
+        self._sensor_type = sensor_type
+        self._interval = interval
+        self._channel_count = min(channel_count or DEFAULT_CHANNEL_COUNT, size)
+        self._queue_name = queue_name or PROCESSING_QUEUE_NAME
+        self._wire_format = wire_format
+        self._exchange_name = exchange_name
+        self._connection: Optional[AsyncioConnection] = None
+        self._ioloop: Optional[AbstractEventLoop] = None
+        self._channels: List[Channel] = []
+        self._sensors: List[Sensor] = []
+        self._scheduler: Optional[Task] = None
+        self._closing = False
+
+    def run(self):
+        logger.info("Starting sensor fleet")
+        logger.info(f"Connecting to RabbitMQ at {self._rabbitmq_address}")
+        self._connection = AsyncioConnection(
+            parameters=URLParameters(self._rabbitmq_address),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_close
+        )
+        self._ioloop = self._connection.ioloop
+        self._ioloop.run_forever()
+
+    def stop(self):
+        if not self._closing:
+            logger.info("Stopping sensor fleet")
+            self._closing = True
+            if self._scheduler is not None:
+                self._scheduler.cancel()
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+                self._ioloop.run_forever()
+            elif self._ioloop is not None:
+                self._ioloop.stop()
+            logger.info("Sensor fleet stopped")
+
+    def _on_connection_open(self, connection: AsyncioConnection):
+        logger.info("Connected to RabbitMQ")
+        logger.info(f"Opening {self._channel_count} channels")
+        for _ in range(self._channel_count):
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection: AsyncioConnection, error: Exception):
+        logger.error(f"Failed to connect to RabbitMQ: {error}")
+        self._ioloop.stop()
+
+    def _on_connection_close(self, connection: AsyncioConnection, reason: Exception):
+        logger.info(f"Connection closed: {reason}")
+        self._channels = []
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+        self._ioloop.stop()
+
+    def _on_channel_open(self, channel: Channel):
+        self._channels.append(channel)
+        channel.add_on_close_callback(self._on_channel_close)
+        if len(self._channels) == self._channel_count:
+            if self._exchange_name:
+                logger.info(f"Declaring exchange {self._exchange_name}")
+                self._channels[0].exchange_declare(exchange=self._exchange_name,
+                                                   exchange_type=PROCESSING_EXCHANGE_TYPE,
+                                                   callback=self._on_exchange_declared)
+            else:
+                logger.info(f"Declaring queue {self._queue_name}")
+                self._channels[0].queue_declare(queue=self._queue_name, callback=self._on_queue_declared)
+
+    def _on_channel_close(self, channel: Channel, reason: Exception):
+        logger.info(f"Channel closed: {reason}")
+        if not self._closing and self._connection.is_open:
+            self._connection.close()
+
+    def _on_exchange_declared(self, frame):
+        logger.info(f"Exchange {self._exchange_name} declared")
+        self._start_sensors()
+
+    def _on_queue_declared(self, frame):
+        logger.info(f"Queue {self._queue_name} declared")
+        self._start_sensors()
+
+    def _start_sensors(self):
+        self._sensors = [
+            create_sensor(
+                f"{self._sensor_id_prefix}-{i}",
+                MeteoDataDetector(),
+                None,
+                self._sensor_type or random.choice(list(SensorType)),
+                self._interval,
+                self._queue_name,
+                channel=self._channels[i % self._channel_count],
+                wire_format=self._wire_format,
+                exchange_name=self._exchange_name,
+            ) for i in range(self._size)
+        ]
+        self._scheduler = asyncio.create_task(self._schedule())
+        self._scheduler.add_done_callback(self._on_scheduler_done)
+
+    def _on_scheduler_done(self, task: Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Sensor fleet scheduler failed: {task.exception()!r}")
+            self.stop()
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        # (deadline, sensor index) heap, starting at a random phase of each sensor's interval
+        deadlines = [(start + random.uniform(0, s.interval / 1000), i) for i, s in enumerate(self._sensors)]
+        heapq.heapify(deadlines)
+        target_rate = sum(1000 / s.interval for s in self._sensors)
+        logger.info(f"Running {self._size} sensors, target rate {target_rate:.1f} msg/s")
+
+        sent, skipped = 0, 0
+        next_stats = start + STATS_INTERVAL
+        while True:
+            # always yield to the event loop, so pika can flush the published messages
+            await asyncio.sleep(max(deadlines[0][0] - loop.time(), 0))
+            now = loop.time()
+            while deadlines[0][0] <= now:
+                deadline, i = deadlines[0]
+                sensor = self._sensors[i]
+                sensor.send_data(sensor.get_data())
+                sent += 1
+                interval = sensor.interval / 1000
+                deadline += interval
+                if deadline <= now - interval:
+                    # more than one interval behind, skip the missed readings instead of bursting
+                    missed = int((now - deadline) // interval)
+                    deadline += missed * interval
+                    skipped += missed
+                heapq.heapreplace(deadlines, (deadline, i))
+
+            if now >= next_stats:
+                elapsed = now - next_stats + STATS_INTERVAL
+                logger.info(f"Published {sent} messages in {elapsed:.1f}s ({sent / elapsed:.1f} msg/s, "
+                            f"target {target_rate:.1f} msg/s), skipped {skipped} late readings")
+                sent, skipped = 0, 0
+                next_stats = now + STATS_INTERVAL
@@ -7,8 +7,12 @@ from typing import Optional
 import click
 from pika import BlockingConnection, URLParameters
 
+from common import metrics
+from common.constants import PROCESSING_EXCHANGE_NAME
 from common.log import setup_logger, LOGGER_LEVEL_CHOICES
+from common.meteo_data import WireFormat
 from common.meteo_utils import MeteoDataDetector
+from fleet import SensorFleet
 from sensor import SensorType, create_sensor
 
 logger = logging.getLogger(__name__)
@@ -19,23 +23,71 @@ logger = logging.getLogger(__name__)
 @click.option('--debug', is_flag=True, help="Enable debug logging")
 @click.option('--log-level', type=click.Choice(LOGGER_LEVEL_CHOICES),
               default=os.environ.get("LOG_LEVEL", "info"), help="Set the log level")
+@click.option('--log-sample-rate', type=float, default=os.environ.get("LOG_SAMPLE_RATE"),
+              help="Log only this fraction of the per-message debug lines (all by default)")
 @click.option('--sensor-id', type=str, default=uuid.uuid4().hex, help="Set the sensor id")
 @click.option('--sensor-type', type=click.Choice([e.value for e in SensorType]),
-              default=os.environ.get("SENSOR_TYPE", random.choice(list(SensorType)).value), help="Set the sensor type")
+              default=os.environ.get("SENSOR_TYPE"),
+              help="Set the sensor type (random by default, mixed for a fleet)")
 @click.option('--interval', type=int, default=os.environ.get("INTERVAL"), help="Set the sensor interval in ms")
+@click.option('--fleet-size', type=int, default=os.environ.get("FLEET_SIZE"),
+              help="Run a fleet of this many virtual sensors in this process")
+@click.option('--fleet-channels', type=int, default=os.environ.get("FLEET_CHANNELS"),
+              help="Set the number of channels shared by the fleet sensors")
+@click.option('--wire-format', type=click.Choice([e.value for e in WireFormat]),
+              default=os.environ.get("WIRE_FORMAT", WireFormat.Json.value), help="Set the message wire format")
+@click.option('--sharded-queues', is_flag=True,
+              default=os.environ.get("SHARDED_QUEUES", "").lower() in ("1", "true", "yes"),
+              help="Publish through the consistent hash exchange to the sharded processing queues")
+@click.option('--metrics-port', type=int, default=os.environ.get("METRICS_PORT"),
+              help="Serve Prometheus metrics on this port (disabled by default)")
 def main(
         rabbitmq_address: str,
         sensor_id: str,
         sensor_type: str,
         debug: bool = False,
         log_level: str = 'info',
-        interval: Optional[int] = None
+        log_sample_rate: Optional[float] = None,
+        interval: Optional[int] = None,
+        fleet_size: Optional[int] = None,
+        fleet_channels: Optional[int] = None,
+        wire_format: str = WireFormat.Json.value,
+        sharded_queues: bool = False,
+        metrics_port: Optional[int] = None,
 ):
-    setup_logger(log_level=logging.DEBUG if debug else log_level.upper())
+    setup_logger(log_level=logging.DEBUG if debug else log_level.upper(), sample_rate=log_sample_rate)
+
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
 
     if not rabbitmq_address:
         raise ValueError("RabbitMQ address is required")
 
+    exchange_name = PROCESSING_EXCHANGE_NAME if sharded_queues else None
+
+    if fleet_size:
+        logger.info(f"Starting fleet {sensor_id} of {fleet_size} sensors of type {sensor_type or 'mixed'}")
+
+        fleet = SensorFleet(
+            sensor_id,
+            rabbitmq_address,
+            fleet_size,
+            SensorType(sensor_type) if sensor_type else None,
+            interval,
+            fleet_channels,
+            wire_format=WireFormat(wire_format),
+            exchange_name=exchange_name,
+        )
+
+        try:
+            fleet.run()
+        except KeyboardInterrupt:
+            logger.info("Received keyboard interrupt, shutting down")
+            fleet.stop()
+            exit(0)
+        return
+
+    sensor_type = sensor_type or random.choice(list(SensorType)).value
     logger.info(f"Starting sensor {sensor_id} of type {sensor_type}")
 
     sensor = create_sensor(
@@ -43,7 +95,9 @@ def main(
         MeteoDataDetector(),
         BlockingConnection(URLParameters(rabbitmq_address)),
         SensorType(sensor_type),
-        interval
+        interval,
+        wire_format=WireFormat(wire_format),
+        exchange_name=exchange_name,
     )
 
     logger.info("Starting sensor loop")
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import json
 import logging
 import random
 import time
@@ -8,16 +7,23 @@ from abc import ABC, abstractmethod
 from enum import Enum
 from typing import Optional
 
-from pika import BlockingConnection
+from pika import BlockingConnection, BasicProperties
+from pika.channel import Channel
 
-from common.constants import PROCESSING_QUEUE_NAME
-from common.meteo_data import RawMeteoData, RawPollutionData, MeteoEncoder
+from common import metrics
+from common.constants import PROCESSING_QUEUE_NAME, PROCESSING_EXCHANGE_TYPE
+from common.log import SAMPLED
+from common.meteo_data import RawMeteoData, RawPollutionData, WireFormat, encode_message
 from common.meteo_utils import MeteoDataDetector
+from common.tracing import trace_headers
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_INTERVAL = 1000
 
+PUBLISH_TIME = metrics.histogram('sensor_publish_seconds', "Time spent publishing each reading")
+MESSAGES_SENT = metrics.counter('sensor_messages_total', "Readings published")
+
 
 class SensorType(Enum):
     AirQuality = 'air_quality'
@@ -30,9 +36,12 @@ class Sensor(ABC):
             sensor_id: str,
             sensor_type: SensorType,
             detector: MeteoDataDetector,
-            rabbitmq: BlockingConnection,
+            rabbitmq: Optional[BlockingConnection],
             interval: Optional[int] = None,
             queue_name: Optional[str] = None,
+            channel: Optional[Channel] = None,
+            wire_format: Optional[WireFormat] = None,
+            exchange_name: Optional[str] = None,
     ):
         if not sensor_id:
             raise ValueError("Sensor id must be provided")
@@ -41,9 +50,22 @@ class Sensor(ABC):
         self._detector = detector
         self._interval = interval or DEFAULT_INTERVAL
         self._queue_name = queue_name or PROCESSING_QUEUE_NAME
+        self._wire_format = wire_format or WireFormat.Json
+        # readings are traced by sensor id and sequence number
+        self._sequence = 0
+        self._exchange_name = exchange_name or ''
+        # the exchange hashes the sensor id, so all the readings of a sensor go in order to the same queue
+        self._routing_key = sensor_id if exchange_name else self._queue_name
         self._rabbitmq = rabbitmq
-        self._channel = self._rabbitmq.channel()
-        self._channel.queue_declare(queue=self._queue_name)
+        if channel is None:
+            self._channel = self._rabbitmq.channel()
+            if exchange_name:
+                self._channel.exchange_declare(exchange=exchange_name, exchange_type=PROCESSING_EXCHANGE_TYPE)
+            else:
+                self._channel.queue_declare(queue=self._queue_name)
+        else:
+            # shared channel, the queue or exchange is declared by its owner
+            self._channel = channel
 
     @property
     def sensor_id(self) -> str:
@@ -53,17 +75,31 @@ class Sensor(ABC):
     def sensor_type(self) -> SensorType:
         return self._sensor_type
 
+    @property
+    def interval(self) -> int:
+        return self._interval
+
     @abstractmethod
     def get_data(self) -> RawMeteoData | RawPollutionData:
         pass
 
     def send_data(self, data: RawMeteoData | RawPollutionData):
-        logger.debug(f"Sending data {data} to queue {self._queue_name}")
+        logger.debug("Sending data %s to %s %s", data, self._exchange_name or 'queue', self._routing_key, extra=SAMPLED)
+        self._sequence += 1
+        properties = BasicProperties(
+            content_type=self._wire_format.content_type,
+            app_id=self._sensor_id,
+            headers=trace_headers(f"{self._sensor_id}-{self._sequence}", time.time()),
+        )
+        started = time.perf_counter()
         self._channel.basic_publish(
-            exchange='',
-            routing_key=self._queue_name,
-            body=json.dumps(data, cls=MeteoEncoder).encode('utf-8')
+            exchange=self._exchange_name,
+            routing_key=self._routing_key,
+            body=encode_message(data, self._wire_format),
+            properties=properties
         )
+        PUBLISH_TIME.observe(time.perf_counter() - started)
+        MESSAGES_SENT.inc()
 
     def run(self):
         while True:
@@ -80,11 +116,15 @@ class AirQualitySensor(Sensor):
             self,
             sensor_id: str,
             detector: MeteoDataDetector,
-            rabbitmq: BlockingConnection,
+            rabbitmq: Optional[BlockingConnection],
             interval: Optional[int] = None,
             queue_name: Optional[str] = None,
+            channel: Optional[Channel] = None,
+            wire_format: Optional[WireFormat] = None,
+            exchange_name: Optional[str] = None,
     ):
-        super().__init__(sensor_id, SensorType.AirQuality, detector, rabbitmq, interval, queue_name)
+        super().__init__(sensor_id, SensorType.AirQuality, detector, rabbitmq, interval, queue_name, channel,
+                         wire_format, exchange_name)
         logger.info(f"Initializing {self}")
 
     def get_data(self) -> RawMeteoData:
@@ -93,7 +133,7 @@ class AirQualitySensor(Sensor):
         humidity = air['humidity']
         temperature = air['temperature']
         data = RawMeteoData(temperature=temperature, humidity=humidity, timestamp=timestamp)
-        logger.debug(f"{self} obtained meteo data {data}")
+        logger.debug("%s obtained meteo data %s", self, data, extra=SAMPLED)
         return data
 
 
@@ -102,11 +142,15 @@ class PollutionSensor(Sensor):
             self,
             sensor_id: str,
             detector: MeteoDataDetector,
-            rabbitmq: BlockingConnection,
+            rabbitmq: Optional[BlockingConnection],
             interval: Optional[int] = None,
             queue_name: Optional[str] = None,
+            channel: Optional[Channel] = None,
+            wire_format: Optional[WireFormat] = None,
+            exchange_name: Optional[str] = None,
     ):
-        super().__init__(sensor_id, SensorType.Pollution, detector, rabbitmq, interval, queue_name)
+        super().__init__(sensor_id, SensorType.Pollution, detector, rabbitmq, interval, queue_name, channel,
+                         wire_format, exchange_name)
         logger.info(f"Initializing {self}")
 
     def get_data(self) -> RawPollutionData:
@@ -114,21 +158,26 @@ class PollutionSensor(Sensor):
         timestamp = time.time()
         co2 = pollution['co2']
         data = RawPollutionData(co2=co2, timestamp=timestamp)
-        logger.debug(f"{self} obtained pollution data {data}")
+        logger.debug("%s obtained pollution data %s", self, data, extra=SAMPLED)
         return data
 
 
 def create_sensor(
         sensor_id: str,
         detector: MeteoDataDetector,
-        rabbitmq: BlockingConnection,
+        rabbitmq: Optional[BlockingConnection],
         sensor_type: Optional[SensorType] = random.choice(list(SensorType)),
         interval: Optional[int] = None,
         queue_name: Optional[str] = None,
+        channel: Optional[Channel] = None,
+        wire_format: Optional[WireFormat] = None,
+        exchange_name: Optional[str] = None,
 ) -> Sensor:
     if sensor_type == SensorType.AirQuality:
-        return AirQualitySensor(sensor_id, detector, rabbitmq, interval, queue_name)
+        return AirQualitySensor(sensor_id, detector, rabbitmq, interval, queue_name, channel, wire_format,
+                                exchange_name)
     elif sensor_type == SensorType.Pollution:
-        return PollutionSensor(sensor_id, detector, rabbitmq, interval, queue_name)
+        return PollutionSensor(sensor_id, detector, rabbitmq, interval, queue_name, channel, wire_format,
+                               exchange_name)
     else:
         raise ValueError(f"Invalid sensor type {sensor_type}")
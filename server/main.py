@@ -1,11 +1,15 @@
 import logging
 import os
+from typing import Optional
 
 import click
 import redis.asyncio as redis
 
+from common import metrics
 from common.log import setup_logger, LOGGER_LEVEL_CHOICES
 from common.meteo_utils import MeteoDataProcessor
+from common.processing_executor import ExecutorType
+from common.store_strategy import sharded_store_strategy
 from server import Server
 
 logger = logging.getLogger(__name__)
@@ -14,17 +18,47 @@ logger = logging.getLogger(__name__)
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
 @click.argument('rabbitmq-address', type=str, required=False, default=os.environ.get('RABBITMQ_ADDRESS'))
 @click.argument('redis-address', type=str, required=False,
-                default=os.environ.get("REDIS_ADDRESS"))
+                default=os.environ.get("REDIS_ADDRESS"))  # comma-separated to shard across several nodes
 @click.option('--debug', is_flag=True, help="Enable debug logging")
 @click.option('--log-level', type=click.Choice(LOGGER_LEVEL_CHOICES),
               default=os.environ.get('LOG_LEVEL', 'info'), help="Set the log level")
+@click.option('--log-sample-rate', type=float, default=os.environ.get('LOG_SAMPLE_RATE'),
+              help="Log only this fraction of the per-message debug lines (all by default)")
+@click.option('--batch-size', type=int, default=os.environ.get("BATCH_SIZE"),
+              help="Process messages in batches of up to this size (disabled by default)")
+@click.option('--batch-timeout', type=int, default=os.environ.get("BATCH_TIMEOUT"),
+              help="Set the maximum time in ms to wait for a batch to fill")
+@click.option('--executor', type=click.Choice([e.value for e in ExecutorType]),
+              default=os.environ.get("EXECUTOR", ExecutorType.Thread.value), help="Set the processing executor")
+@click.option('--workers', type=int, default=os.environ.get("WORKERS"),
+              help="Set the number of processing workers of the executor")
+@click.option('--aggregate-interval', type=int, default=os.environ.get("AGGREGATE_INTERVAL"),
+              help="Also keep per-window aggregates for windows of this interval in ms")
+@click.option('--queue-shards', type=int, default=os.environ.get("QUEUE_SHARDS"),
+              help="Consume the readings from this many queues behind a consistent hash exchange")
+@click.option('--shards', type=str, default=os.environ.get("CONSUME_SHARDS"),
+              help="Set the comma-separated queue shards to consume (all by default)")
+@click.option('--metrics-port', type=int, default=os.environ.get("METRICS_PORT"),
+              help="Serve Prometheus metrics on this port (disabled by default)")
 def main(
         rabbitmq_address: str,
         redis_address: str,
         log_level: str,
         debug: bool = False,
+        log_sample_rate: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        batch_timeout: Optional[int] = None,
+        executor: str = ExecutorType.Thread.value,
+        workers: Optional[int] = None,
+        aggregate_interval: Optional[int] = None,
+        queue_shards: Optional[int] = None,
+        shards: Optional[str] = None,
+        metrics_port: Optional[int] = None,
 ):
-    setup_logger(log_level=logging.DEBUG if debug else log_level.upper())
+    setup_logger(log_level=logging.DEBUG if debug else log_level.upper(), sample_rate=log_sample_rate)
+
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
 
     if not rabbitmq_address:
         raise ValueError("RabbitMQ address must be provided")
@@ -34,11 +68,33 @@ def main(
 
     logger.info("Starting processing server")
 
-    # Create server
+    # series are spread across all the given nodes
+    redis_addresses = redis_address.split(',')
+    logger.info(f"Storing series in {len(redis_addresses)} Redis nodes")
+    if aggregate_interval:
+        logger.info(f"Keeping per-window aggregates of {aggregate_interval} ms")
+    store_strategy = sharded_store_strategy(
+        [redis.from_url(address, db=0) for address in redis_addresses],
+        redis_addresses,
+        aggregate_interval=aggregate_interval,
+    )
+
+    if queue_shards:
+        logger.info(f"Consuming {'shards ' + shards if shards else 'all'} of {queue_shards} queue shards")
+
+    # Create server, the workers of the process executor build their own processor
+    executor_type = ExecutorType(executor)
     server = Server(
-        MeteoDataProcessor(),
-        redis.from_url(redis_address, db=0),
-        rabbitmq_address
+        MeteoDataProcessor() if executor_type != ExecutorType.Process else None,
+        None,
+        rabbitmq_address,
+        store_strategy=store_strategy,
+        batch_size=batch_size,
+        batch_timeout=batch_timeout,
+        executor_type=executor_type,
+        workers=workers,
+        queue_shards=queue_shards,
+        shards=[int(shard) for shard in shards.split(',')] if shards else None,
     )
 
     try:
@@ -1,10 +1,11 @@
 import asyncio
-import json
+import functools
 import logging
 import os
-from asyncio import AbstractEventLoop
-from json import JSONDecodeError
-from typing import Optional
+import time
+from asyncio import AbstractEventLoop, Task, TimerHandle
+from collections import deque
+from typing import Optional, List, Tuple, Deque, Dict
 
 from pika import BlockingConnection, SelectConnection, URLParameters
 from pika.adapters.asyncio_connection import AsyncioConnection
@@ -12,37 +13,87 @@ from pika.channel import Channel
 from pika.spec import Basic, BasicProperties
 from redis.asyncio import Redis
 
-from common.constants import PROCESSING_QUEUE_NAME
-from common.meteo_data import RawMeteoData, RawPollutionData, MeteoDecoder
+from common import metrics
+from common.constants import PROCESSING_QUEUE_NAME, PROCESSING_EXCHANGE_NAME, PROCESSING_EXCHANGE_TYPE
+from common.log import SAMPLED
+from common.meteo_data import RawMeteoData, RawPollutionData, decode_message
 from common.meteo_utils import MeteoDataProcessor
-from common.store_strategy import StoreStrategy, SortedSetStoreStrategy
+from common.processing_executor import ProcessingExecutor, ExecutorType
+from common.sharding import series_key, processing_queue_name
+from common.store_strategy import StoreStrategy, sharded_store_strategy
+from common.tracing import Trace
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BATCH_TIMEOUT = 100
+
+MESSAGES = metrics.counter('server_messages_total', "Messages received, by type", ('type',))
+_METEO_MESSAGES = MESSAGES.labels('meteo')
+_POLLUTION_MESSAGES = MESSAGES.labels('pollution')
+_INVALID_MESSAGES = MESSAGES.labels('invalid')
+DECODE_TIME = metrics.histogram('server_decode_seconds', "Time spent decoding the messages")
+STORE_TIME = metrics.histogram('server_store_seconds', "Latency of the stores of processed data in Redis")
+BACKGROUND_TASKS = metrics.gauge('server_background_tasks', "Processing tasks in flight")
+
 
 class Server:
+    """
+    Processes the sensor readings of the processing queue and stores the results.
+    With queue_shards, the sensors publish through a consistent hash exchange onto that many queues, hashed by
+    sensor id so the readings of each sensor stay in order, and the server consumes only the given shards, so
+    several servers split the queues among them.
+    """
+
     def __init__(
             self,
-            processor: MeteoDataProcessor,
+            processor: Optional[MeteoDataProcessor],
             redis: Redis,
             rabbitmq_address: str,
             store_strategy: Optional[StoreStrategy] = None,
             queue_name: Optional[str] = None,
             prefetch_count: Optional[int] = None,
+            batch_size: Optional[int] = None,
+            batch_timeout: Optional[int] = None,
+            executor_type: Optional[ExecutorType] = None,
+            workers: Optional[int] = None,
+            queue_shards: Optional[int] = None,
+            shards: Optional[List[int]] = None,
     ):
         logger.info("Initializing Server")
-        self._processor = processor
-        self._store = store_strategy or SortedSetStoreStrategy(redis)
+        if shards and not queue_shards:
+            raise ValueError("The number of queue shards must be provided to consume some of them")
+        if queue_shards and any(not 0 <= shard < queue_shards for shard in shards or []):
+            raise ValueError(f"Shards must be between 0 and {queue_shards - 1}")
+        self._executor = ProcessingExecutor(processor, executor_type, workers)
+        self._store = store_strategy or sharded_store_strategy([redis])
         self._rabbitmq_address = rabbitmq_address
         self._connection: Optional[AsyncioConnection] = None
         self._ioloop: Optional[AbstractEventLoop] = None
         self._queue_name = queue_name or PROCESSING_QUEUE_NAME
-        self._prefetch_count = prefetch_count or min(32, ((os.cpu_count() or 1) + 4) * 2)
+        self._queue_shards = queue_shards
+        if queue_shards:
+            shards = sorted(set(shards or range(queue_shards)))
+            self._queue_names = [processing_queue_name(shard) for shard in shards]
+        else:
+            self._queue_names = [self._queue_name]
+        self._batch_size = batch_size or 1
+        self._batch_timeout = batch_timeout or DEFAULT_BATCH_TIMEOUT
+        if self._batch_size > 1:
+            # allow the next batch to be filled while the current one is being processed
+            self._prefetch_count = prefetch_count or self._batch_size * 2
+        else:
+            self._prefetch_count = prefetch_count or min(32, ((os.cpu_count() or 1) + 4) * 2)
         self._channel: Optional[Channel] = None
-        self._consumer_tag: Optional[str] = None
+        self._consumer_tags: List[str] = []
+        self._pending_bindings = 0
         self._closing = False
         self._consuming = False
         self._background_tasks = set()
+        BACKGROUND_TASKS.set_function(lambda: len(self._background_tasks))
+        # (delivery tag, data, sensor id, trace) of the messages of the batch
+        self._batch: List[Tuple[int, Optional[RawMeteoData | RawPollutionData], Optional[str], Optional[Trace]]] = []
+        self._batch_timer: Optional[TimerHandle] = None
+        self._pending_batches: Deque[Tuple[int, Task]] = deque()
 
     def run(self):
         logger.info("Starting server")
@@ -53,6 +104,7 @@ class Server:
         if not self._closing:
             logger.info("Stopping server")
             self._closing = True
+            self._executor.shutdown()
             if self._consuming:
                 self._stop_consuming()
                 self._ioloop.run_forever()
@@ -98,8 +150,13 @@ class Server:
         logger.info("Channel opened")
         self._channel = channel
         self._channel.add_on_close_callback(self._on_channel_close)
-        logger.info(f"Declaring queue {self._queue_name}")
-        self._channel.queue_declare(queue=self._queue_name, callback=self._on_queue_declared)
+        if self._queue_shards:
+            logger.info(f"Declaring exchange {PROCESSING_EXCHANGE_NAME}")
+            self._channel.exchange_declare(exchange=PROCESSING_EXCHANGE_NAME, exchange_type=PROCESSING_EXCHANGE_TYPE,
+                                           callback=self._on_exchange_declared)
+        else:
+            logger.info(f"Declaring queue {self._queue_name}")
+            self._channel.queue_declare(queue=self._queue_name, callback=self._on_queue_declared)
 
     def _on_channel_close(self, channel: Channel, reason: Exception):
         logger.info(f"Channel closed: {reason}")
@@ -109,14 +166,38 @@ class Server:
         logger.info(f"Queue {self._queue_name} declared")
         self._set_qos()
 
+    def _on_exchange_declared(self, frame):
+        logger.info(f"Exchange {PROCESSING_EXCHANGE_NAME} declared, declaring {self._queue_shards} queue shards")
+        # every server declares and binds all the shards, not only its own, so the sensors are hashed to the
+        # same queues whichever servers are running
+        self._pending_bindings = self._queue_shards
+        for shard in range(self._queue_shards):
+            queue_name = processing_queue_name(shard)
+            self._channel.queue_declare(queue=queue_name,
+                                        callback=functools.partial(self._on_shard_declared, queue_name))
+
+    def _on_shard_declared(self, queue_name: str, frame):
+        # the binding key of a consistent hash exchange is the weight of the queue in the hash ring
+        self._channel.queue_bind(queue_name, PROCESSING_EXCHANGE_NAME, routing_key='1',
+                                 callback=self._on_shard_bound)
+
+    def _on_shard_bound(self, frame):
+        self._pending_bindings -= 1
+        if not self._pending_bindings:
+            logger.info(f"Queue shards bound, consuming {', '.join(self._queue_names)}")
+            self._set_qos()
+
     def _set_qos(self):
+        # the prefetch count applies to each consumer, that is to each consumed queue
         logger.info(f"Setting QoS to {self._prefetch_count}")
         self._channel.basic_qos(prefetch_count=self._prefetch_count, callback=lambda _: self._start_consuming())
 
     def _start_consuming(self):
         logger.info("Starting consuming")
         self._channel.add_on_cancel_callback(self._on_consumer_cancelled)
-        self._consumer_tag = self._channel.basic_consume(self._queue_name, self._on_message)
+        # delivery tags are shared by all the consumers of the channel, so batches still ack in delivery order
+        self._consumer_tags = [self._channel.basic_consume(queue_name, self._on_message)
+                               for queue_name in self._queue_names]
         self._consuming = True
 
     def _on_consumer_cancelled(self, method_frame):
@@ -131,67 +212,196 @@ class Server:
             properties: BasicProperties,
             body: bytes
     ):
-        logger.debug(f"Received message #{method.delivery_tag} from {properties.app_id}: {body}")
+        logger.debug("Received message #%s from %s: %s", method.delivery_tag, properties.app_id, body, extra=SAMPLED)
+        started = time.perf_counter()
+        # the readings are only traced when the metrics are exposed
+        trace = Trace.from_properties(properties, time.time()) if metrics.REGISTRY.enabled else None
         try:
-            raw_meteo_data = json.loads(body, cls=MeteoDecoder)
-        except JSONDecodeError as e:
+            raw_meteo_data = decode_message(body, properties.content_type)
+        except ValueError as e:
             logger.warning(f"Failed to decode message {body}: {e}")
-            self._ack_message(method.delivery_tag)
+            _INVALID_MESSAGES.inc()
+            if self._batch_size > 1:
+                self._add_to_batch(method.delivery_tag, None, None, None)
+            else:
+                self._ack_message(method.delivery_tag)
             return
+        DECODE_TIME.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.decoded_at = time.time()
         if isinstance(raw_meteo_data, RawMeteoData):
-            task = asyncio.create_task(self._process_meteo_data(raw_meteo_data, method.delivery_tag))
+            _METEO_MESSAGES.inc()
+        elif isinstance(raw_meteo_data, RawPollutionData):
+            _POLLUTION_MESSAGES.inc()
+        else:
+            _INVALID_MESSAGES.inc()
+        if self._batch_size > 1:
+            if not isinstance(raw_meteo_data, (RawMeteoData, RawPollutionData)):
+                logger.warning(f"Received unknown message {body}")
+                raw_meteo_data = None
+            self._add_to_batch(method.delivery_tag, raw_meteo_data, properties.app_id, trace)
+        elif isinstance(raw_meteo_data, RawMeteoData):
+            task = asyncio.create_task(
+                self._process_meteo_data(raw_meteo_data, properties.app_id, method.delivery_tag, trace))
             self._background_tasks.add(task)
             task.add_done_callback(self._background_tasks.discard)
         elif isinstance(raw_meteo_data, RawPollutionData):
-            task = asyncio.create_task(self._process_pollution_data(raw_meteo_data, method.delivery_tag))
+            task = asyncio.create_task(
+                self._process_pollution_data(raw_meteo_data, properties.app_id, method.delivery_tag, trace))
             self._background_tasks.add(task)
             task.add_done_callback(self._background_tasks.discard)
         else:
             logger.warning(f"Received unknown message {body}")
 
-    def _ack_message(self, delivery_tag: int):
-        self._channel.basic_ack(delivery_tag)
-        logger.debug(f"Message #{delivery_tag} acknowledged")
+    def _ack_message(self, delivery_tag: int, multiple: bool = False):
+        self._channel.basic_ack(delivery_tag, multiple=multiple)
+        logger.debug("Message #%s acknowledged%s", delivery_tag, ' (multiple)' if multiple else '', extra=SAMPLED)
+
+    def _add_to_batch(
+            self,
+            delivery_tag: int,
+            data: Optional[RawMeteoData | RawPollutionData],
+            sensor_id: Optional[str],
+            trace: Optional[Trace],
+    ):
+        # undecodable and unknown messages are kept as None, so they are acknowledged with the batch
+        self._batch.append((delivery_tag, data, sensor_id, trace))
+        if len(self._batch) >= self._batch_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = self._ioloop.call_later(self._batch_timeout / 1000, self._flush_batch)
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        task = asyncio.create_task(self._process_batch(batch))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        self._pending_batches.append((batch[-1][0], task))
+        task.add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, _: Task):
+        # a multiple ack covers every earlier delivery, so batches are acknowledged in delivery order,
+        # once all the previous batches have finished
+        while self._pending_batches and self._pending_batches[0][1].done():
+            delivery_tag, task = self._pending_batches.popleft()
+            error = asyncio.CancelledError() if task.cancelled() else task.exception()
+            if error is not None:
+                logger.error(f"Failed to process batch up to message #{delivery_tag}, requeueing it: {error!r}")
+                self._channel.basic_nack(delivery_tag, multiple=True)
+            else:
+                self._ack_message(delivery_tag, multiple=True)
 
     def _stop_consuming(self):
         logger.info("Stopping consuming")
         if self._channel:
-            self._channel.basic_cancel(self._consumer_tag, self._on_cancel_ok)
+            for consumer_tag in list(self._consumer_tags):
+                self._channel.basic_cancel(consumer_tag, functools.partial(self._on_cancel_ok, consumer_tag))
 
-    def _on_cancel_ok(self, method_frame):
+    def _on_cancel_ok(self, consumer_tag: str, method_frame):
         logger.info(f"Cancel: {method_frame}")
-        self._consuming = False
-        self._close_channel()
+        self._consumer_tags.remove(consumer_tag)
+        if not self._consumer_tags:
+            self._consuming = False
+            self._close_channel()
 
     def _close_channel(self):
         logger.info("Closing channel")
         if self._channel:
             self._channel.close()
 
-    async def _process_meteo_data(self, raw_meteo_data: RawMeteoData, delivery_tag: int):
-        logger.debug(f"Processing raw meteo data {raw_meteo_data}")
-        loop = asyncio.get_event_loop()
-        # run blocking code in a thread pool
-        wellness_data = await loop.run_in_executor(None, self._processor.process_meteo_data, raw_meteo_data)
-        # wellness_data = await asyncio.to_thread(self._processor.process_meteo_data, raw_meteo_data)
-        logger.debug(f"Obtained wellness data \"{wellness_data}\"")
+    async def _process_meteo_data(
+            self,
+            raw_meteo_data: RawMeteoData,
+            sensor_id: Optional[str],
+            delivery_tag: int,
+            trace: Optional[Trace] = None
+    ):
+        logger.debug("Processing raw meteo data %s", raw_meteo_data, extra=SAMPLED)
+        # run blocking code in the configured executor
+        wellness_data = await self._executor.process_meteo_data(raw_meteo_data, trace)
+        logger.debug("Obtained wellness data \"%s\"", wellness_data, extra=SAMPLED)
         # convert timestamp to nanoseconds
-        if await self._store.store("wellness", int(raw_meteo_data.timestamp * 1e9), wellness_data):
-            logger.debug(f"Stored wellness data in redis")
+        key = series_key("wellness", sensor_id)
+        started = time.perf_counter()
+        stored = await self._store.store(key, int(raw_meteo_data.timestamp * 1e9), wellness_data)
+        STORE_TIME.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.stored_at = time.time()
+            trace.record()
+        if stored:
+            logger.debug("Stored wellness data in redis", extra=SAMPLED)
         else:
             logger.warning(f"Failed to store wellness data \"{wellness_data}\"")
         self._ack_message(delivery_tag)
 
-    async def _process_pollution_data(self, raw_pollution_data: RawPollutionData, delivery_tag: int):
-        logger.debug(f"Processing raw pollution data {raw_pollution_data}")
-        loop = asyncio.get_running_loop()
-        # run blocking code in a thread pool
-        pollution_data = await loop.run_in_executor(None, self._processor.process_pollution_data, raw_pollution_data)
-        # pollution_data = await asyncio.to_thread(self._processor.process_pollution_data, raw_pollution_data)
-        logger.debug(f"Obtained pollution data \"{pollution_data}\"")
+    async def _process_pollution_data(
+            self,
+            raw_pollution_data: RawPollutionData,
+            sensor_id: Optional[str],
+            delivery_tag: int,
+            trace: Optional[Trace] = None
+    ):
+        logger.debug("Processing raw pollution data %s", raw_pollution_data, extra=SAMPLED)
+        # run blocking code in the configured executor
+        pollution_data = await self._executor.process_pollution_data(raw_pollution_data, trace)
+        logger.debug("Obtained pollution data \"%s\"", pollution_data, extra=SAMPLED)
         # convert timestamp to nanoseconds
-        if await self._store.store("pollution", int(raw_pollution_data.timestamp * 1e9), pollution_data):
-            logger.debug(f"Stored pollution data in redis")
+        key = series_key("pollution", sensor_id)
+        started = time.perf_counter()
+        stored = await self._store.store(key, int(raw_pollution_data.timestamp * 1e9), pollution_data)
+        STORE_TIME.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.stored_at = time.time()
+            trace.record()
+        if stored:
+            logger.debug("Stored pollution data in redis", extra=SAMPLED)
         else:
             logger.warning(f"Failed to store pollution data \"{pollution_data}\"")
         self._ack_message(delivery_tag)
+
+    async def _process_batch(
+            self,
+            batch: List[Tuple[int, Optional[RawMeteoData | RawPollutionData], Optional[str], Optional[Trace]]]
+    ):
+        meteo = [(data, sensor_id) for _, data, sensor_id, _ in batch if isinstance(data, RawMeteoData)]
+        pollution = [(data, sensor_id) for _, data, sensor_id, _ in batch if isinstance(data, RawPollutionData)]
+        traces = [trace for _, data, _, trace in batch if trace is not None and data is not None]
+        raw_meteo_data = [data for data, _ in meteo]
+        raw_pollution_data = [data for data, _ in pollution]
+        logger.debug("Processing batch of %s messages up to #%s (%s meteo, %s pollution)", len(batch), batch[-1][0],
+                     len(raw_meteo_data), len(raw_pollution_data), extra=SAMPLED)
+        # run blocking code in the configured executor, once for the whole batch
+        wellness_data, pollution_data = await self._executor.process_batch(raw_meteo_data, raw_pollution_data, traces)
+        await asyncio.gather(
+            self._store_batch("wellness", meteo, wellness_data),
+            self._store_batch("pollution", pollution, pollution_data),
+        )
+        stored_at = time.time()
+        for trace in traces:
+            trace.stored_at = stored_at
+            trace.record()
+
+    async def _store_batch(
+            self,
+            metric: str,
+            raw_data: List[Tuple[RawMeteoData | RawPollutionData, Optional[str]]],
+            values: List[float]
+    ):
+        if not raw_data:
+            return
+        # group the points by series, converting timestamps to nanoseconds
+        series: Dict[str, List[Tuple[int, float]]] = {}
+        for (data, sensor_id), value in zip(raw_data, values):
+            series.setdefault(series_key(metric, sensor_id), []).append((int(data.timestamp * 1e9), value))
+        started = time.perf_counter()
+        stored = sum(await asyncio.gather(*(self._store.store_many(key, points) for key, points in series.items())))
+        STORE_TIME.observe(time.perf_counter() - started)
+        if stored == len(raw_data):
+            logger.debug("Stored %s %s data points of %s series in redis", stored, metric, len(series), extra=SAMPLED)
+        else:
+            logger.warning(f"Stored only {stored} of {len(raw_data)} {metric} data points")
@@ -1,34 +1,95 @@
 import logging
 import os
+import signal
+from typing import Optional
 
 import click
+import redis
 
+from common import metrics
 from common.log import setup_logger, LOGGER_LEVEL_CHOICES
-from terminal import Terminal
+from recorder import FileFormat, ResultsRecorder
 
 logger = logging.getLogger(__name__)
 
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
 @click.argument('rabbitmq-address', type=str, required=False, default=os.environ.get('RABBITMQ_ADDRESS'))
+@click.argument('redis-address', type=str, required=False,
+                default=os.environ.get("REDIS_ADDRESS"))  # to start the plot with the results history
 @click.option('--debug', is_flag=True, help="Enable debug logging")
 @click.option('--log-level', type=click.Choice(LOGGER_LEVEL_CHOICES),
               default=os.environ.get('LOG_LEVEL', 'info'), help="Set the log level")
+@click.option('--fps', type=int, default=os.environ.get("TERMINAL_FPS"),
+              help="Set the maximum number of plot redraws per second")
+@click.option('--backfill', type=int, default=os.environ.get("RESULTS_BACKFILL"),
+              help="Set the number of results read from the history at startup (the plotted results by default)")
+@click.option('--headless', is_flag=True,
+              default=os.environ.get("HEADLESS", "").lower() in ("1", "true", "yes"),
+              help="Record the results to files instead of plotting them")
+@click.option('--output-dir', type=str, default=os.environ.get("RESULTS_DIR", "results"),
+              help="Set the directory of the results files in headless mode")
+@click.option('--file-format', type=click.Choice([e.value for e in FileFormat]),
+              default=os.environ.get("RESULTS_FORMAT", FileFormat.default().value),
+              help="Set the format of the results files (parquet requires pyarrow)")
+@click.option('--buffer-size', type=int, default=os.environ.get("RESULTS_BUFFER_SIZE"),
+              help="Set the maximum number of results buffered before writing them")
+@click.option('--flush-interval', type=int, default=os.environ.get("RESULTS_FLUSH_INTERVAL"),
+              help="Set the maximum time in ms results are buffered before writing them")
+@click.option('--metrics-port', type=int, default=os.environ.get("METRICS_PORT"),
+              help="Serve Prometheus metrics on this port (disabled by default)")
 def main(
         rabbitmq_address: str,
+        redis_address: Optional[str],
         log_level: str,
         debug: bool = False,
+        fps: Optional[int] = None,
+        backfill: Optional[int] = None,
+        headless: bool = False,
+        output_dir: str = 'results',
+        file_format: Optional[str] = None,
+        buffer_size: Optional[int] = None,
+        flush_interval: Optional[int] = None,
+        metrics_port: Optional[int] = None,
 ):
     setup_logger(log_level=logging.DEBUG if debug else log_level.upper())
 
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+
     if rabbitmq_address is None:
         raise ValueError("RabbitMQ address is required")
 
+    if headless:
+        logger.info("Starting headless terminal")
+        recorder = ResultsRecorder(
+            rabbitmq_address,
+            output_dir,
+            FileFormat(file_format),
+            buffer_size,
+            flush_interval,
+        )
+        # stopping the container sends SIGTERM, close the files as on a keyboard interrupt
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            recorder.run()
+        except KeyboardInterrupt:
+            logger.info("Received keyboard interrupt, shutting down")
+            exit(0)
+        return
+
     logger.info("Starting load balancer")
 
+    # imported here, so the headless mode never loads matplotlib
+    from terminal import Terminal
+
     # Create Terminal
     terminal = Terminal(
-        rabbitmq_address
+        rabbitmq_address,
+        fps=fps,
+        # the history is kept in the first node
+        redis=redis.from_url(redis_address.split(',')[0], db=0) if redis_address else None,
+        backfill=backfill,
     )
 
     try:
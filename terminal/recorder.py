@@ -0,0 +1,199 @@
+import csv
+import dataclasses
+import gzip
+import io
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from enum import Enum
+from typing import List, Optional, Tuple
+
+from pika import BlockingConnection, URLParameters
+from pika.channel import Channel
+from pika.spec import Basic, BasicProperties
+
+from common.constants import RESULT_EXCHANGE_NAME
+from common.meteo_data import Results, decode_message
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 10000
+
+# time the results were received at, followed by every field of the results
+COLUMNS = ('received_timestamp',) + tuple(f.name for f in dataclasses.fields(Results))
+
+
+class FileFormat(Enum):
+    Csv = 'csv'
+    Parquet = 'parquet'
+
+    @property
+    def extension(self) -> str:
+        return 'csv.gz' if self == FileFormat.Csv else 'parquet'
+
+    @staticmethod
+    def default() -> 'FileFormat':
+        return FileFormat.Parquet if pq is not None else FileFormat.Csv
+
+
+class _CsvWriter:
+    """
+    Appends rows to a gzip compressed CSV file, one gzip member per write, so the file is readable at any time.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def write(self, rows: List[Tuple]):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not os.path.exists(self._path):
+            writer.writerow(COLUMNS)
+        writer.writerows(rows)
+        with gzip.open(self._path, 'at', newline='') as f:
+            f.write(buffer.getvalue())
+
+    def close(self):
+        pass
+
+
+class _ParquetWriter:
+    """
+    Writes rows to a Parquet file, one row group per write. The file is only readable once closed.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._schema = pyarrow.schema([(column, pyarrow.float64()) for column in COLUMNS])
+        self._writer: Optional[pq.ParquetWriter] = None
+
+    def write(self, rows: List[Tuple]):
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array(column, pyarrow.float64()) for column in zip(*rows)],
+            schema=self._schema,
+        )
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._path, self._schema, compression='zstd')
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ResultsRecorder:
+    """
+    Records the results published by the proxy to compressed columnar files, without any display.
+    Results are buffered in memory up to buffer_size rows or flush_interval ms, and then appended to the
+    file of the hour (UTC) they were received in, <directory>/date=YYYY-MM-DD/hour=HH/results-<id>.<ext>,
+    so the files roll over every hour. CSV files are gzip compressed, and Parquet files, which require
+    pyarrow, are only complete once the hour ends or the recorder stops.
+    """
+
+    def __init__(
+            self,
+            rabbitmq_address: str,
+            directory: str,
+            file_format: Optional[FileFormat] = None,
+            buffer_size: Optional[int] = None,
+            flush_interval: Optional[int] = None,
+            exchange_name: Optional[str] = None,
+    ):
+        logger.info("Initializing ResultsRecorder")
+        self._file_format = file_format or FileFormat.default()
+        if self._file_format == FileFormat.Parquet and pq is None:
+            raise ValueError("Recording to Parquet files requires pyarrow")
+        self._directory = directory
+        self._buffer_size = buffer_size or DEFAULT_BUFFER_SIZE
+        self._flush_interval = flush_interval or DEFAULT_FLUSH_INTERVAL
+        # tells apart the files of several recorders, or of restarts, within the same hour
+        self._id = uuid.uuid4().hex[:8]
+        self._exchange_name = exchange_name or RESULT_EXCHANGE_NAME
+        self._rabbitmq = BlockingConnection(URLParameters(rabbitmq_address))
+        self._channel = self._rabbitmq.channel()
+        self._channel.exchange_declare(exchange=self._exchange_name, exchange_type='fanout')
+        self._queue_name = self._channel.queue_declare(queue='', exclusive=True).method.queue
+        self._channel.queue_bind(exchange=self._exchange_name, queue=self._queue_name)
+        self._rows: List[Tuple] = []
+        self._partition: Optional[str] = None
+        self._writer: Optional[_CsvWriter | _ParquetWriter] = None
+
+    def receive_results(self, results: Results, received: Optional[float] = None):
+        received = received or time.time()
+        partition = datetime.fromtimestamp(received, timezone.utc).strftime('date=%Y-%m-%d/hour=%H')
+        if partition != self._partition:
+            self._roll(partition)
+        self._rows.append((received,) + tuple(getattr(results, column) for column in COLUMNS[1:]))
+        if len(self._rows) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        self._writer.write(rows)
+        logger.debug(f"Wrote {len(rows)} results to {self._partition}")
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        logger.info("Results files closed")
+
+    def _roll(self, partition: str):
+        # the buffered rows belong to the previous hour
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+        directory = os.path.join(self._directory, partition)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"results-{self._id}.{self._file_format.extension}")
+        logger.info(f"Recording results to {path}")
+        self._writer = _CsvWriter(path) if self._file_format == FileFormat.Csv else _ParquetWriter(path)
+        self._partition = partition
+
+    def _on_flush_timer(self):
+        self.flush()
+        self._rabbitmq.call_later(self._flush_interval / 1000, self._on_flush_timer)
+
+    def _on_message(
+            self,
+            channel: Channel,
+            method: Basic.Deliver,
+            properties: BasicProperties,
+            body: bytes
+    ):
+        logger.debug("Received message #%s from %s: %s", method.delivery_tag, properties.app_id, body)
+        try:
+            results = decode_message(body, properties.content_type)
+        except ValueError as e:
+            logger.warning(f"Failed to decode message {body}: {e}")
+            return
+        if isinstance(results, Results):
+            self.receive_results(results)
+        else:
+            logger.warning(f"Received unknown message {body}")
+
+    def run(self):
+        logger.info(f"Running ResultsRecorder, writing {self._file_format.value} files to {self._directory}")
+        self._channel.basic_consume(
+            queue=self._queue_name,
+            on_message_callback=self._on_message,
+            auto_ack=True
+        )
+        self._rabbitmq.call_later(self._flush_interval / 1000, self._on_flush_timer)
+        try:
+            self._channel.start_consuming()
+        finally:
+            self.close()
@@ -1,28 +1,56 @@
-import json
 import logging
+import time
 from collections import deque
 from datetime import datetime
-from json import JSONDecodeError
-from threading import Thread
-from typing import Deque, Tuple, Optional
+from threading import Thread, Lock
+from typing import Deque, Tuple, Optional, List
 
 import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.backend_bases import DrawEvent
+from matplotlib.lines import Line2D
+from matplotlib.ticker import FuncFormatter
 from pika import BlockingConnection, URLParameters
 from pika.channel import Channel
 from pika.spec import Basic, BasicProperties
+from redis import Redis
 
-from common.constants import RESULT_EXCHANGE_NAME
-from common.meteo_data import Results, MeteoDecoder
+from common import metrics
+from common.constants import RESULT_EXCHANGE_NAME, RESULTS_STREAM_NAME
+from common.meteo_data import Results, decode_message
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_FPS = 5
+# fraction of the shown time span left free on the right, so the axes only rescale every few results
+X_HEADROOM = 0.25
+Y_MARGIN = 0.1
+
+RENDER_TIME = metrics.histogram('terminal_render_seconds', "Time spent redrawing the plot", ('mode',))
+_FULL_RENDER_TIME = RENDER_TIME.labels('full')
+_BLIT_RENDER_TIME = RENDER_TIME.labels('blit')
+
 
 class Terminal:
+    """
+    Plots the results published by the proxy.
+    Results are received in a consumer thread, which only stores them. The plot is redrawn from the GUI
+    thread by a timer at up to fps frames per second, whatever the rate of results, by updating persistent
+    lines and blitting them over a cached background. The whole figure is only redrawn when the data goes
+    out of the axes limits, which leave some headroom for the next results.
+    With a Redis client, the plot starts with the latest results of the history stream kept by the proxy.
+    The results queue is bound before reading them, and the live results up to the last one read are
+    skipped by message id, so there is no gap and no duplicate between both.
+    """
+
     def __init__(
             self,
             rabbitmq_address: str,
             max_results: int = 50,
             exchange_name: Optional[str] = None,
+            fps: Optional[int] = None,
+            redis: Optional[Redis] = None,
+            backfill: Optional[int] = None,
     ):
         logger.info("Initializing Terminal")
         self._exchange_name = exchange_name or RESULT_EXCHANGE_NAME
@@ -32,29 +60,36 @@ class Terminal:
         self._queue_name = self._channel.queue_declare(queue='', exclusive=True).method.queue
         self._channel.queue_bind(exchange=self._exchange_name, queue=self._queue_name)
         self._max_results = max_results
-        self._wellness_data: Deque[Tuple[str, float]] = deque(maxlen=max_results)
-        self._pollution_data: Deque[Tuple[str, float]] = deque(maxlen=max_results)
+        self._redis = redis
+        self._backfill_count = backfill or max_results
+        # id of the last history entry read, as (ms, sequence)
+        self._last_entry: Optional[Tuple[int, int]] = None
+        self._fps = fps or DEFAULT_FPS
+        # (timestamp, value) tuples, appended by the consumer thread and read by the GUI thread
+        self._wellness_data: Deque[Tuple[float, float]] = deque(maxlen=max_results)
+        self._pollution_data: Deque[Tuple[float, float]] = deque(maxlen=max_results)
+        self._lock = Lock()
+        self._dirty = False
         self._fig, (self._ax1, self._ax2) = plt.subplots(2)
+        self._wellness_line = self._setup_axes(self._ax1, "Wellness data", "Wellness")
+        self._pollution_line = self._setup_axes(self._ax2, "Pollution data", "Pollution")
+        self._fig.tight_layout()
+        self._background = None
+        # time a full redraw was requested at, until it is done
+        self._full_render_started: Optional[float] = None
+        self._fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self._fig.canvas.mpl_connect('close_event', lambda _: self._stop_consuming())
+        self._timer = self._fig.canvas.new_timer(interval=1000 // self._fps)
+        self._timer.add_callback(self._update_plot)
 
     def receive_results(self, results: Results):
-        logger.debug(f"Received results: {results}")
-        if results.wellness_timestamp != 0:
-            self._wellness_data.append((
-                datetime.fromtimestamp(results.wellness_timestamp).strftime('%H:%M:%S.%f'),
-                results.wellness_data
-            ))
-        if results.pollution_timestamp != 0:
-            self._pollution_data.append((
-                datetime.fromtimestamp(results.pollution_timestamp).strftime('%H:%M:%S.%f'),
-                results.pollution_data
-            ))
-
-        if len(self._wellness_data) > self._max_results:
-            self._wellness_data.popleft()
-        if len(self._pollution_data) > self._max_results:
-            self._pollution_data.popleft()
-
-        self._update_plot()
+        logger.debug("Received results: %s", results)
+        with self._lock:
+            if results.wellness_timestamp != 0:
+                self._wellness_data.append((results.wellness_timestamp, results.wellness_data))
+            if results.pollution_timestamp != 0:
+                self._pollution_data.append((results.pollution_timestamp, results.pollution_data))
+            self._dirty = True
 
     def _on_message(
             self,
@@ -63,10 +98,14 @@ class Terminal:
             properties: BasicProperties,
             body: bytes
     ):
-        logger.debug(f"Received message #{method.delivery_tag} from {properties.app_id}: {body}")
+        logger.debug("Received message #%s from %s: %s", method.delivery_tag, properties.app_id, body)
+        if (self._last_entry is not None and properties.message_id
+                and _entry_id(properties.message_id) <= self._last_entry):
+            logger.debug("Skipping results %s, already read from the history", properties.message_id)
+            return
         try:
-            raw_meteo_data = json.loads(body, cls=MeteoDecoder)
-        except JSONDecodeError as e:
+            raw_meteo_data = decode_message(body, properties.content_type)
+        except ValueError as e:
             logger.warning(f"Failed to decode message {body}: {e}")
             return
         if isinstance(raw_meteo_data, Results):
@@ -74,40 +113,111 @@ class Terminal:
         else:
             logger.warning(f"Received unknown message {body}")
 
-    def _update_plot(self):
-        # clear the plot
-        self._ax1.clear()
-        self._ax2.clear()
-
-        # wellness data
-        self._ax1.set_title("Wellness data")
-        self._ax1.set_xlabel("Timestamp")
-        self._ax1.set_ylabel("Wellness")
-
-        w = self._wellness_data
-        logger.debug(f"Plotting wellness data: {w}")
-        self._ax1.plot([x[0] for x in w], [x[1] for x in w])
-
-        # pollution data
-        self._ax2.set_title("Pollution data")
-        self._ax2.set_xlabel("Timestamp")
-        self._ax2.set_ylabel("Pollution")
-
-        p = self._pollution_data
-        logger.debug(f"Plotting pollution data: {p}")
-        self._ax2.plot([x[0] for x in p], [x[1] for x in p])
-
-        # format the plot
-        self._ax1.set_xticklabels(self._ax1.get_xticklabels(), rotation=45, ha='right')
-        self._ax2.set_xticklabels(self._ax2.get_xticklabels(), rotation=45, ha='right')
-        plt.subplots_adjust(bottom=0.30)
-        plt.tight_layout()
+    def _backfill(self):
+        try:
+            entries = self._redis.xrevrange(RESULTS_STREAM_NAME, count=self._backfill_count)
+        except Exception as e:
+            logger.error(f"Error reading the results history: {e!r}")
+            return
+        for entry_id, fields in reversed(entries):
+            try:
+                results = decode_message(fields[b'body'], fields[b'content_type'].decode())
+            except (KeyError, ValueError) as e:
+                logger.warning(f"Failed to decode history entry {entry_id}: {e!r}")
+                continue
+            if isinstance(results, Results):
+                self.receive_results(results)
+        if entries:
+            self._last_entry = _entry_id(entries[0][0])
+        logger.info(f"Read {len(entries)} results from the history")
+
+    @staticmethod
+    def _setup_axes(ax: Axes, title: str, ylabel: str) -> Line2D:
+        ax.set_title(title)
+        ax.set_xlabel("Timestamp")
+        ax.set_ylabel(ylabel)
+        ax.xaxis.set_major_formatter(FuncFormatter(lambda x, _: datetime.fromtimestamp(x).strftime('%H:%M:%S')))
+        # set once, the ticks created when rescaling inherit it
+        plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
+        # animated lines are left out of the full redraws and blitted over the background instead
+        line, = ax.plot([], [], animated=True)
+        return line
+
+    def _on_draw(self, event: Optional[DrawEvent]):
+        # the figure was fully redrawn, e.g. resized or rescaled, cache it without the lines
+        canvas = self._fig.canvas
+        self._background = canvas.copy_from_bbox(self._fig.bbox)
+        self._ax1.draw_artist(self._wellness_line)
+        self._ax2.draw_artist(self._pollution_line)
+        if self._full_render_started is not None:
+            # from the request of the redraw, so it includes the wait for the GUI to idle
+            _FULL_RENDER_TIME.observe(time.perf_counter() - self._full_render_started)
+            self._full_render_started = None
 
-        self._fig.canvas.draw()
+    def _update_plot(self):
+        # called from the GUI thread by the timer, at most fps times per second
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            w = list(self._wellness_data)
+            p = list(self._pollution_data)
+        logger.debug("Plotting %s wellness and %s pollution results", len(w), len(p))
+        started = time.perf_counter()
+
+        rescaled = self._set_line_data(self._ax1, self._wellness_line, w)
+        rescaled = self._set_line_data(self._ax2, self._pollution_line, p) or rescaled
+
+        canvas = self._fig.canvas
+        if rescaled or self._background is None or not canvas.supports_blit:
+            # the axes changed, redraw everything, which also caches the new background
+            if self._full_render_started is None:
+                self._full_render_started = started
+            canvas.draw_idle()
+        else:
+            canvas.restore_region(self._background)
+            self._ax1.draw_artist(self._wellness_line)
+            self._ax2.draw_artist(self._pollution_line)
+            canvas.blit(self._fig.bbox)
+            canvas.flush_events()
+            _BLIT_RENDER_TIME.observe(time.perf_counter() - started)
+
+    @staticmethod
+    def _set_line_data(ax: Axes, line: Line2D, data: List[Tuple[float, float]]) -> bool:
+        """
+        :return: whether the axes limits had to change to fit the data.
+        """
+        if not data:
+            return False
+        xs = [x for x, _ in data]
+        ys = [y for _, y in data]
+        line.set_data(xs, ys)
+
+        rescaled = False
+        left, right = ax.get_xlim()
+        if xs[0] < left or xs[-1] > right:
+            span = max(xs[-1] - xs[0], 1)
+            ax.set_xlim(xs[0], xs[-1] + span * X_HEADROOM)
+            rescaled = True
+        bottom, top = ax.get_ylim()
+        low, high = min(ys), max(ys)
+        if low < bottom or high > top:
+            margin = (high - low) * Y_MARGIN or abs(high) * Y_MARGIN or 1
+            ax.set_ylim(low - margin, high + margin)
+            rescaled = True
+        return rescaled
+
+    def _stop_consuming(self):
+        self._timer.stop()
+        # the channel belongs to the consumer thread
+        self._rabbitmq.add_callback_threadsafe(self._channel.stop_consuming)
 
     def run(self):
         logger.info("Running Terminal")
 
+        if self._redis is not None:
+            self._backfill()
+
         self._channel.basic_consume(
             queue=self._queue_name,
             on_message_callback=self._on_message,
@@ -120,6 +230,14 @@ class Terminal:
         t = Thread(target=self._channel.start_consuming)
         t.start()
 
+        logger.debug(f"Redrawing up to {self._fps} times per second")
+        self._timer.start()
         plt.show()
 
         t.join()
+
+
+def _entry_id(entry_id: str | bytes) -> Tuple[int, int]:
+    # stream entry ids are <ms>-<sequence>, ordered by both
+    ms, seq = (entry_id.decode() if isinstance(entry_id, bytes) else entry_id).split('-')
+    return int(ms), int(seq)